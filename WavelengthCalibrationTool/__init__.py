@@ -1 +1,12 @@
-from .iidentify import InteractiveDispersionSolution
+import sys
+
+if sys.version_info < (3,7):
+    # Module level __getattr__ (PEP 562) is not supported, so import the interactive tool eagerly
+    from .iidentify import InteractiveDispersionSolution
+else:
+    def __getattr__(name):
+        """ Imports the interactive tool (and its GUI modules) only when it is accessed """
+        if name == 'InteractiveDispersionSolution':
+            from .iidentify import InteractiveDispersionSolution
+            return InteractiveDispersionSolution
+        raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
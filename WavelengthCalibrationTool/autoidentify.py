@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+""" This is a non-interactive tool to identify calibration lamp lines in a raw arc spectrum
+without any prior dispersion solution, by matching the pattern of the line spacings with a lamp line atlas.
+The output dispersion file can be used as the reference dispersion file of reidentify. """
+import argparse
+import logging
+from itertools import combinations
+from multiprocessing import Pool
+import numpy as np
+from .dispersion import get_fitted_function, create_dispersion_inputfile, load_fluxdata
+from .utils import DetectPeaks, MatchPeaksToPositions, StageTimer, setup_logging, write_timing_records, speed_of_light
+
+logger = logging.getLogger(__name__)
+
+def read_line_atlas(filename):
+    """ Reads the lamp line atlas text file of wavelengths (first column; any other columns are ignored).
+    Returns : array of wavelengths sorted in increasing order """
+    wavelengths = []
+    try :
+        with open(filename) as f:
+            for line in f:
+                line = line.rstrip().split('#')[0] # remove any comments
+                if not line.split() : continue
+                wavelengths.append(float(line.split()[0]))
+    except IOError:
+        print('ERROR: Cannot read line atlas file: {0}'.format(filename))
+        raise
+    return np.sort(wavelengths)
+
+class SpacingRatioIndex(object):
+    """ Sorted index of the quadruplets of neighbouring lines by the ratios of their spacings.
+    For each line i, the quadruplets (i,j,k,l) are formed with the next `neighbours` lines j < k < l, and the ratios
+    ((x_j - x_i)/(x_l - x_i), (x_k - x_i)/(x_l - x_i)) are invariant to any shift and scaling (ie. a linear dispersion) of x.
+    positions : sorted array of the line positions (pixels or wavelengths)
+    """
+    def __init__(self,positions,neighbours=5):
+        self.positions = np.asarray(positions,dtype=float)
+        Offsets = np.array(list(combinations(range(1,neighbours+1),3)),dtype=int).reshape(-1,3)
+        I = np.repeat(np.arange(len(self.positions)),len(Offsets))
+        quads = np.column_stack([I,I+np.tile(Offsets[:,0],len(self.positions)),
+                                 I+np.tile(Offsets[:,1],len(self.positions)),I+np.tile(Offsets[:,2],len(self.positions))])
+        quads = quads[quads[:,3] < len(self.positions)]
+        x = self.positions
+        Span = x[quads[:,3]]-x[quads[:,0]]
+        ratios = np.column_stack([(x[quads[:,1]]-x[quads[:,0]])/Span, (x[quads[:,2]]-x[quads[:,0]])/Span])
+        isort = np.argsort(ratios[:,0])
+        self.ratios = ratios[isort]
+        self.quads = quads[isort]
+
+    def __len__(self):
+        return len(self.ratios)
+
+    def query(self,ratios,tol):
+        """ Returns (query index, quads) of all the quadruplets with both the ratios within tol of each of the ratios """
+        ratios = np.asarray(ratios,dtype=float).reshape(-1,2)
+        # Binary search of the range of the first ratio, and then filter by the second ratio
+        Lo = np.searchsorted(self.ratios[:,0],ratios[:,0]-tol,side='left')
+        Hi = np.searchsorted(self.ratios[:,0],ratios[:,0]+tol,side='right')
+        Counts = Hi - Lo
+        QueryIdx = np.repeat(np.arange(len(ratios)),Counts)
+        # Index of each match within its range, added to the start of the range
+        QuadIdx = np.repeat(Lo,Counts) + np.arange(np.sum(Counts)) - np.repeat(np.cumsum(Counts)-Counts,Counts)
+        Match = np.abs(self.ratios[QuadIdx,1]-ratios[QueryIdx,1]) <= tol
+        return QueryIdx[Match], self.quads[QuadIdx[Match]]
+
+def vote_line_identifications(peak_positions,AtlasIndex,npixels,neighbours=4,ratio_tol=2e-3,
+                              dispersion_range=None,min_votes=2,max_candidates=3):
+    """ Returns the list of candidate (peak index, atlas line index) pairs of the most consistent identifications of the peaks,
+    best candidate first.
+    Every quadruplet of peaks is matched to the atlas quadruplets of same spacing ratios (in both the directions of dispersion),
+    and each match is a hypothesis of the linear dispersion (wavelength per pixel, and wavelength at the center pixel).
+    The hypotheses vote in coarse bins of the dispersion, and the bins are ranked by the votes in their 3x3 neighbourhood of bins.
+    For each of the best max_candidates (non overlapping) neighbourhoods, the pairs in its hypotheses are voted again, and 
+    each peak is identified with the atlas line with maximum votes (at least min_votes).
+    dispersion_range (optional) : (min, max) of the absolute wavelength per pixel to allow.
+    """
+    PeakIndex = SpacingRatioIndex(peak_positions,neighbours=neighbours)
+    atlas_wavl = AtlasIndex.positions
+    Dispersion, CenterWavl, PeakQuads, AtlasQuads = [], [], [], []
+    for direction in (1,-1):
+        # With decreasing wavelengths, the pixel quadruplet (a,b,c,d) is the wavelength quadruplet (l,k,j,i)
+        if direction > 0:
+            QueryIdx, Quads = AtlasIndex.query(PeakIndex.ratios,ratio_tol)
+        else:
+            QueryIdx, Quads = AtlasIndex.query(1-PeakIndex.ratios[:,::-1],ratio_tol)
+            Quads = Quads[:,::-1]
+        PQuads = PeakIndex.quads[QueryIdx]
+        Pa, Pd = peak_positions[PQuads[:,0]], peak_positions[PQuads[:,3]]
+        Wa, Wd = atlas_wavl[Quads[:,0]], atlas_wavl[Quads[:,3]]
+        d = (Wd-Wa)/(Pd-Pa)
+        Dispersion.append(d)
+        CenterWavl.append(Wa + d*((npixels-1)/2. - Pa))
+        PeakQuads.append(PQuads)
+        AtlasQuads.append(Quads)
+    Dispersion, CenterWavl, PeakQuads, AtlasQuads = map(np.concatenate,(Dispersion,CenterWavl,PeakQuads,AtlasQuads))
+    if dispersion_range is not None:
+        Allowed = (np.abs(Dispersion) >= min(dispersion_range)) & (np.abs(Dispersion) <= max(dispersion_range))
+        Dispersion, CenterWavl = Dispersion[Allowed], CenterWavl[Allowed]
+        PeakQuads, AtlasQuads = PeakQuads[Allowed], AtlasQuads[Allowed]
+    if len(Dispersion) == 0:
+        return []
+
+    # Coarse bins, since the local dispersion of a quadruplet differs from the mean dispersion of the non linear solution
+    Direction = np.sign(Dispersion).astype(int)
+    DispersionBin = np.floor(np.log(np.abs(Dispersion))/0.05).astype(int)
+    # Same wavelength width of the center bins for all the hypotheses, so that the bins of neighbouring dispersion bins
+    # are aligned, and hypotheses of proportional (dispersion, center) do not fall in the same bin
+    CenterBinWidth = np.median(np.abs(Dispersion))*0.05*npixels
+    CenterBin = np.floor(CenterWavl/CenterBinWidth).astype(int)
+    Bins, BinCounts = np.unique(np.column_stack([Direction,DispersionBin,CenterBin]),axis=0,return_counts=True)
+    # Votes of the 3x3 neighbourhood of each bin, since the votes of a solution are split across the bin edges
+    CountsDic = dict(zip(map(tuple,Bins),BinCounts))
+    NeighbourCounts = np.array([sum(CountsDic.get((d,i+di,j+dj),0) for di in (-1,0,1) for dj in (-1,0,1))
+                                for d,i,j in Bins])
+
+    Candidates = []
+    ChosenBins = []
+    for b in np.argsort(NeighbourCounts,kind='stable')[::-1]:
+        if len(Candidates) >= max_candidates:
+            break
+        d, i, j = Bins[b]
+        # Skip the bins whose neighbourhood overlaps with an already chosen candidate
+        if any((d == cd) and (abs(i-ci) <= 2) and (abs(j-cj) <= 2) for cd,ci,cj in ChosenBins):
+            continue
+        ChosenBins.append((d,i,j))
+        InBest = (Direction == d) & (np.abs(DispersionBin-i) <= 1) & (np.abs(CenterBin-j) <= 1)
+        logger.debug('Dispersion bin %s has %d votes, %d votes with neighbouring bins, of %d hypotheses',
+                     Bins[b], BinCounts[b], NeighbourCounts[b], len(Dispersion))
+
+        # Vote for the (peak, atlas line) pairs in the consistent hypotheses
+        Pairs = np.column_stack([PeakQuads[InBest].ravel(),AtlasQuads[InBest].ravel()])
+        Pairs, PairCounts = np.unique(Pairs,axis=0,return_counts=True)
+        # Best atlas line of each peak, and then the best peak of each atlas line
+        for column in (0,1):
+            isort = np.lexsort((-PairCounts,Pairs[:,column]))
+            Pairs, PairCounts = Pairs[isort], PairCounts[isort]
+            _, First = np.unique(Pairs[:,column],return_index=True)
+            Pairs, PairCounts = Pairs[First], PairCounts[First]
+        Pairs = Pairs[PairCounts >= min_votes]
+        # Reject the pairs more than 2% of the detector away from the median linear dispersion of the hypotheses.
+        # A least squares fit with sigma clipping can otherwise bend to fit a group of pairs shifted by a wrong quadruplet.
+        LinearDispersion = np.median(Dispersion[InBest])
+        Predicted = np.median(CenterWavl[InBest]) + LinearDispersion*(peak_positions[Pairs[:,0]] - (npixels-1)/2.)
+        Pairs = Pairs[np.abs(atlas_wavl[Pairs[:,1]] - Predicted) <= 0.02*npixels*np.abs(LinearDispersion)]
+        Candidates.append((Pairs[:,0], Pairs[:,1]))
+    return Candidates
+
+def refine_line_identifications(peak_positions,atlas_wavl,peak_idx,atlas_idx,npixels,method='l3',match_tol=2.,niter=3):
+    """ Fits the dispersion solution to the identified (peak, atlas line) pairs, and iteratively re-identifies all
+    the atlas lines which fall within match_tol pixels of a peak with the fitted solution.
+    Returns : (wavelengths, pixels) of the identified lines, and the fitted function of pixels scaled to -1 to 1 """
+    X = np.arange(npixels)
+    degree = int(method[1:]) if method[1:].isdigit() else 3
+    for iteration in range(niter+1):
+        if len(peak_idx) < 3:
+            return np.array([]), np.array([]), None
+        # Do not fit higher degree than the lines can constrain. The first iteration fits a linear solution,
+        # which unlike a higher degree polynomial, cannot bend to fit the few spurious identifications of the pattern matching
+        if iteration == 0:
+            fit_method = method[0]+'1' if method[1:].isdigit() else 'p1'
+        else:
+            fit_method = method[0]+str(min(degree,len(peak_idx)-2)) if method[1:].isdigit() else method
+        scaled_pixels = 2.*peak_positions[peak_idx]/(npixels-1.) - 1
+        disp_func, coeffs, Mask = get_fitted_function(scaled_pixels,atlas_wavl[atlas_idx],method=fit_method,
+                                                      return_coeff=True,sigma_to_clip=3,maxiter=5)
+        if iteration == niter:
+            break
+        # Pixel positions of all the atlas lines by inverting the solution
+        WavlPixarray = disp_func(2.*X/(npixels-1.) - 1)
+        if WavlPixarray[-1] < WavlPixarray[0]:
+            WavlPixarray, Xsorted = WavlPixarray[::-1], X[::-1]
+        else:
+            Xsorted = X
+        if np.any(np.diff(WavlPixarray) <= 0):
+            logger.info('Fitted dispersion solution is not monotonic')
+            return np.array([]), np.array([]), None
+        OnDetector = np.flatnonzero((atlas_wavl > WavlPixarray[0]) & (atlas_wavl < WavlPixarray[-1]))
+        AtlasPixels = np.interp(atlas_wavl[OnDetector],WavlPixarray,Xsorted)
+        # Wider tolerance in the first iteration of the linear solution
+        Matches = MatchPeaksToPositions(peak_positions,AtlasPixels,tol=match_tol*(niter-iteration))
+        peak_idx, atlas_idx = Matches[Matches >= 0], OnDetector[Matches >= 0]
+    return atlas_wavl[atlas_idx][Mask], peak_positions[peak_idx][Mask], disp_func
+
+def AutoIdentifyOrder(order,SpectrumY,SpectrumY_Var,AtlasIndex,args):
+    """ Identifies the lines of the atlas in a single order, and writes them to the output dispersion file.
+    This is a module level function so that it can be pickled and run in a process pool.
+    Returns : (number of lines identified, timing) where timing is the StageTimer record of the order.
+    """
+    timer = StageTimer(order=order)
+    logger.info('Identifying lines in Order: %s', order)
+    npixels = len(SpectrumY)
+    with timer.stage('peak_detection'):
+        Peaks = DetectPeaks(SpectrumY,Sigma=args.LineSigma,min_snr=args.MinPeakSNR,SpecY_Var=SpectrumY_Var)
+    # Use only the brightest peaks for the pattern matching
+    Brightest = np.sort(np.argsort(Peaks.snr)[::-1][:args.MaxPeaks])
+    timer.count('peaks_detected',len(Peaks.position))
+    with timer.stage('pattern_match'):
+        Candidates = vote_line_identifications(Peaks.position[Brightest],AtlasIndex,npixels,
+                                               neighbours=args.Neighbours,ratio_tol=args.RatioTolerance,
+                                               dispersion_range=args.DispersionRange,max_candidates=args.MaxCandidates)
+    # Refine each candidate identification, and keep the one which identifies the most lines.
+    # So a spurious candidate, or a candidate whose refinement fails, falls back to the next best candidate.
+    wavelengths, pixels, disp_func = [], [], None
+    for candidate, (peak_idx, atlas_idx) in enumerate(Candidates):
+        with timer.stage('refine'):
+            cand_wavelengths, cand_pixels, cand_disp_func = refine_line_identifications(Peaks.position,AtlasIndex.positions,
+                                                                                        Brightest[peak_idx],atlas_idx,npixels,
+                                                                                        method=args.ModelForDispersion,
+                                                                                        match_tol=args.MatchTolerance)
+        logger.info('Pattern matching candidate %d identified %d of %d brightest peaks, refined to %d lines',
+                    candidate, len(peak_idx), len(Brightest), len(cand_wavelengths))
+        if len(cand_wavelengths) > len(wavelengths):
+            wavelengths, pixels, disp_func = cand_wavelengths, cand_pixels, cand_disp_func
+    timer.count('candidates_tried',len(Candidates))
+    timer.count('lines_identified',len(wavelengths))
+    if len(wavelengths) < args.MinLines:
+        logger.warning('Failed to identify the lines in order %s. Only %d lines identified', order, len(wavelengths))
+        return len(wavelengths), timer.as_dict()
+
+    velocity_residue = speed_of_light*(wavelengths - disp_func(2.*pixels/(npixels-1.) - 1))/wavelengths
+    logger.info('Identified %d lines in order %s between %s and %s, Sigma V = %.2e m/s', len(wavelengths), order,
+                np.min(wavelengths), np.max(wavelengths), np.std(velocity_residue))
+    Outdisp_fname = args.OutDispTableFile.format(order)
+    with timer.stage('write_table'):
+        create_dispersion_inputfile(Outdisp_fname,wavelengths,comment='Auto-Identified',
+                                    pixels=pixels,sigma=[1]*len(wavelengths))
+    logger.info('Dispersion ASCII input file saved in file://%s', Outdisp_fname)
+    return len(wavelengths), timer.as_dict()
+
+def _autoidentify_order_star(order_args):
+    """ Unpacks the argument tuple for AutoIdentifyOrder to use with Pool.imap """
+    return AutoIdentifyOrder(*order_args)
+
+def parse_args(raw_args=None):
+    """ Parses the command line input arguments """
+    epilog_str=""" Use {0} in the filename if multiple orders are identified in a single run.
+    Dispersion tables can also be binary multi-order .npz tables, by using filename of the form table.npz[{0}].
+    A table.npz.lock file exists next to the table only while an order is being written to it. """
+    parser = argparse.ArgumentParser(description="Non-Interactive Automatic Line Identification Tool",
+                                     epilog=epilog_str)
+    parser.add_argument('SpectrumFluxFile', type=str,
+                        help="File containing the Spectrum's Flux array")
+    parser.add_argument('--fits_ext', type=int, default=0,
+                        help="Extension to load if the input flux file is fits")
+    parser.add_argument('--fits_ext_var', type=int,
+                        help="Extension of the variance array for the input flux fits file (optional)")
+    parser.add_argument('LineAtlasFile', type=str,
+                        help="Lamp line atlas file containing the Wavelengths in the first column")
+    parser.add_argument('OutDispTableFile', type=str,
+                        help="Output Filename to write the table of identified Wavelengths, Pixels, Error")
+    parser.add_argument('--WavelengthRange', type=float, nargs=2,
+                        help="Use only the atlas lines within this wavelength range")
+    parser.add_argument('--DispersionRange', type=float, nargs=2,
+                        help="Range of the absolute wavelength per pixel of the dispersion to search. Default is any.")
+    parser.add_argument('--LineSigma', type=float, default=1.5,
+                        help="Approximate sigma of the lines in pixels. Default is 1.5")
+    parser.add_argument('--MinPeakSNR', type=float, default=10.,
+                        help="Signal to noise ratio threshold of the lines to detect in the spectrum. Default is 10")
+    parser.add_argument('--MaxPeaks', type=int, default=200,
+                        help="Number of brightest detected lines to use for the pattern matching. Default is 200")
+    parser.add_argument('--Neighbours', type=int, default=4,
+                        help="Number of neighbouring detected lines to form the quadruplets of line spacings. Default is 4")
+    parser.add_argument('--AtlasNeighbours', type=int, default=12,
+                        help="Number of neighbouring atlas lines to form the quadruplets of line spacings. Should be larger than "
+                        "--Neighbours by the factor the atlas is denser than the detected lines. Default is 12")
+    parser.add_argument('--RatioTolerance', type=float, default=2e-3,
+                        help="Tolerance of the matching of the line spacing ratios. Default is 0.002")
+    parser.add_argument('--MaxCandidates', type=int, default=3,
+                        help="Number of best pattern matching candidates to try in turn, until one is refined to a "
+                        "valid dispersion solution. Default is 3")
+    parser.add_argument('--MatchTolerance', type=float, default=2.,
+                        help="Maximum distance in pixels of the detected line from the atlas line position. Default is 2")
+    parser.add_argument('--ModelForDispersion', type=str, default='l3',
+                        help="Model of the dispersion solution to fit to the identified lines. Default is l3")
+    parser.add_argument('--MinLines', type=int, default=8,
+                        help="Minimum number of lines to be identified to write the output dispersion file. Default is 8")
+    parser.add_argument('--orders', type=int, nargs='+',
+                        help="Identify only these orders (0 indexed) of the input flux file. Default is all orders.")
+    parser.add_argument('--loglevel', type=str, default='INFO', choices=['DEBUG','INFO','WARNING','ERROR'],
+                        help="Level of the diagnostic messages to show. Default is INFO")
+    parser.add_argument('--TimingFile', type=str,
+                        help="Append the wall time of each stage and the number of lines identified of every order "
+                        "to this file as one JSON object per line")
+    parser.add_argument('--jobs', type=int, default=1,
+                        help="Number of parallel processes to use for the orders. Default is 1.")
+    args = parser.parse_args(raw_args)
+    return args
+
+def main(raw_args=None):
+    """ Standalone Non-Interactive Automatic Line Identification Tool """
+    args = parse_args(raw_args)
+    setup_logging(args.loglevel)
+
+    SpectrumY_all = load_fluxdata(args.SpectrumFluxFile,fits_ext=args.fits_ext,lazy=True)
+    if args.fits_ext_var is not None:
+        SpectrumY_Var_all = load_fluxdata(args.SpectrumFluxFile,fits_ext=args.fits_ext_var,lazy=True)
+    else:
+        SpectrumY_Var_all = [None]*len(SpectrumY_all)
+
+    # Memory mapped input files, to be closed at the end
+    FluxFiles = [SpectrumY_all] + ([SpectrumY_Var_all] if args.fits_ext_var is not None else [])
+    try:
+        if len(SpectrumY_all.shape) < 2:  # If the spectrum is a 1D single order spectrum
+            SpectrumY_all = [SpectrumY_all[:]]  # Pack it into a single element list
+            SpectrumY_Var_all = [SpectrumY_Var_all[:] if args.fits_ext_var is not None else None]
+
+        # The atlas index is built only once for all the orders
+        atlas_wavl = read_line_atlas(args.LineAtlasFile)
+        if args.WavelengthRange is not None:
+            atlas_wavl = atlas_wavl[(atlas_wavl >= min(args.WavelengthRange)) & (atlas_wavl <= max(args.WavelengthRange))]
+        AtlasIndex = SpacingRatioIndex(atlas_wavl,neighbours=args.AtlasNeighbours)
+        logger.info('Indexed %d quadruplets of %d atlas lines', len(AtlasIndex), len(atlas_wavl))
+
+        orders_tofit = list(args.orders if args.orders is not None else range(len(SpectrumY_all)))
+        order_args = ((order, SpectrumY_all[order], SpectrumY_Var_all[order], AtlasIndex, args) for order in orders_tofit)
+        if args.jobs > 1:
+            pool = Pool(processes=args.jobs)
+            try:
+                results = list(pool.imap(_autoidentify_order_star, order_args))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [AutoIdentifyOrder(*oargs) for oargs in order_args]
+
+        if args.TimingFile:
+            write_timing_records(args.TimingFile,[timing for nlines, timing in results])
+    finally:
+        for fluxdata in FluxFiles:
+            fluxdata.close()
+
+if __name__ == "__main__":
+    main()
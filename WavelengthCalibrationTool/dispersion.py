@@ -0,0 +1,579 @@
+""" This module contains the non-interactive parts of the calibration: fitting of the dispersion solution, 
+reading and writing the dispersion files, re-fitting the lines in a spectrum and the flux/wavelength data files.
+It does not import any GUI or heavy modules at import time, so that the command line tools start quickly. """
+import sys
+import shutil
+import re
+import os
+import fcntl
+import logging
+from contextlib import contextmanager
+import numpy as np
+from .utils import NearestIndices, FitLinesToData, BuildLineModel, StageTimer, DetectPeaks, MatchPeaksToPositions
+
+logger = logging.getLogger(__name__)
+
+# Name, Vandermonde matrix function and the function to create the fitted function from coeffs,
+# of the polynomial fitting methods in get_fitted_function
+POLYNOMIAL_METHODS = {'p':('poly', lambda x,deg: np.vander(x,deg+1), np.poly1d),
+                      'c':('Chebyshev polynomial', np.polynomial.chebyshev.chebvander,
+                           lambda c: (lambda x : np.polynomial.chebyshev.chebval(x, c))),
+                      'l':('Legendre polynomial', np.polynomial.legendre.legvander,
+                           lambda c: (lambda x : np.polynomial.legendre.legval(x, c)))}
+
+def _fit_design_matrix(design,wavel,weights,method_name,deg):
+    """ Weighted linear least squares fit of the design matrix (Vandermonde) to wavel.
+    Same as the np.polyfit, chebfit or legfit with weights. Returns the coeffs """
+    A = design*weights[:,np.newaxis]
+    scale = np.sqrt(np.sum(A*A,axis=0))
+    scale[scale == 0] = 1
+    rcond = len(wavel)*np.finfo(float).eps
+    c, residuals, rank, sing_values = np.linalg.lstsq(A/scale,wavel*weights,rcond=rcond)
+    c = c/scale
+    logger.debug('Stats of the %s fit of degree %d', method_name, deg)
+    logger.debug('Coeffs : %s', c)
+    logger.debug('residuals:%s,  rank:%s, singular_values:%s, rcond:%s', residuals, rank, sing_values, rcond)
+    return c
+
+def _fit_spline(pixels,wavel,sigma,smooth):
+    """ Fits a cubic spline of smoothing parameter smooth. Returns the (spline, coeffs) """
+    import scipy.interpolate
+    isort = np.argsort(pixels)  # indices for sorting the input to spline funtion
+    output_object = scipy.interpolate.UnivariateSpline(pixels[isort],wavel[isort], w=1/sigma[isort],k=3, s=smooth, ext=0)
+    logger.debug('Stats of the Spline fit of smoothness %s', smooth)
+    logger.debug('Spline Knots :%s', output_object.get_knots())
+    logger.debug('Spline Coeffs :%s', output_object.get_coeffs())
+    logger.debug('residuals:%s', output_object.get_residual())
+    return output_object, output_object.get_coeffs()
+
+def get_fitted_function(pixels,wavel,sigma=None,method='c3',return_coeff=False,sigma_to_clip=False,maxiter=1):
+    """ Returns the fitted function f(pixels) = wavel .
+    Define all the methods to use for fitting here
+    pX : polynoial of X degree
+    cX : Chebyshev polynoial of X degree
+    lX : Legendre polynoial of X degree
+    sX : spline with smoothing parameter X
+    sigma_to_clip : If provided, the outliers beyond sigma_to_clip sigma in the residue are rejected and refitted.
+    maxiter (default=1): Maximum number of clipping and refitting iterations. Iterations stop earlier once 
+                         no new outliers are rejected. Rejected points are not added back in later iterations.
+    The diagnostics of the fits are logged in DEBUG level of the logger of this module.
+    """
+    output_object = None
+    pixels = np.array(pixels)
+    wavel = np.array(wavel)
+    sigma = np.ones(len(pixels)) if sigma is None else np.array(sigma)
+
+    if (method[0] in POLYNOMIAL_METHODS) and method[1:].isdigit():
+        # Use polynomial of X degree. The design matrix is created only once for all iterations
+        deg = int(method[1:])
+        method_name, vander, coeffs_to_function = POLYNOMIAL_METHODS[method[0]]
+        design = vander(pixels,deg)
+        weights = 1/sigma
+        def fit(Mask):
+            coeffs = _fit_design_matrix(design[Mask],wavel[Mask],weights[Mask],method_name,deg)
+            return coeffs_to_function(coeffs), coeffs
+
+    elif (method[0] == 's'):
+        # Use spline with smoothing parameter s*
+        if method[1:]:
+            smooth = float(method[1:])
+        else:
+            smooth = None
+        def fit(Mask):
+            return _fit_spline(pixels[Mask],wavel[Mask],sigma[Mask],smooth)
+
+    else:
+        print('Error: unknown fitting method {0}'.format(method))
+        raise NotImplementedError
+
+    Mask = np.ones(len(pixels),dtype=bool)
+    output_object, coeffs = fit(Mask)
+
+    if sigma_to_clip:
+        from astropy.stats import sigma_clip
+        # Iteratively do a sigma clipping filtering of the data points and refit
+        for iteration in range(maxiter):
+            residue = (wavel - output_object(pixels))/sigma
+            filtered_residue = sigma_clip(np.ma.masked_array(residue,mask=~Mask), sigma=sigma_to_clip)
+            NewMask = ~np.ma.getmaskarray(filtered_residue)
+            if np.array_equal(NewMask,Mask):
+                logger.debug('Sigma clipping converged after %d iterations', iteration)
+                break
+            Mask = NewMask
+            logger.info('Refitting after rejecting %d outliers', np.sum(~Mask))
+            output_object, coeffs = fit(Mask)
+
+    if return_coeff and sigma_to_clip:
+        return output_object, coeffs, Mask
+    elif return_coeff:
+        return output_object, coeffs
+    else:
+        return output_object
+
+# Columns of the binary multi-order dispersion table (.npz)
+# Wavelengths without a pixel position have pixel = NaN
+DISPTABLE_COLUMNS = ('order','wavelength','pixel','sigma','flag','comment')
+
+class WavelengthIndex(object):
+    """ Hash index of a list of wavelengths for constant time lookup of a wavelength within tolerance `tol`.
+    Wavelengths are hashed into bins of width tol, and a lookup checks the neighbouring bins as well. 
+    If a wavelength repeats, the index of its first occurrence is returned (like list.index). """
+    def __init__(self,wavelengths,tol=1e-6):
+        self.tol = tol
+        self.wavelengths = wavelengths
+        self._index = {}
+        for i,wavel in enumerate(wavelengths):
+            self._index.setdefault(self._key(wavel),[]).append(i)
+
+    def _key(self,wavel):
+        return int(np.floor(wavel/self.tol))
+
+    def find(self,wavel):
+        """ Returns the index of the first wavelength within tol of wavel, or None if there is none """
+        key = self._key(wavel)
+        matches = [i for k in (key-1,key,key+1) for i in self._index.get(k,[])
+                   if abs(self.wavelengths[i]-wavel) <= self.tol]
+        return min(matches) if matches else None
+
+def split_dispersion_table_name(filename):
+    """ Returns the (npz filename, order) if filename is of the form table.npz[order], else (None, None) """
+    npzbracket = re.search(r'^(.*\.npz)\[(\d+)\]$', filename)
+    if npzbracket is None:
+        return None, None
+    return npzbracket.group(1), int(npzbracket.group(2))
+
+def empty_dispersion_table():
+    """ Returns an empty binary dispersion table dictionary """
+    return {'order':np.array([],dtype=int), 'wavelength':np.array([],dtype=float),
+            'pixel':np.array([],dtype=float), 'sigma':np.array([],dtype=float),
+            'flag':np.array([],dtype=int), 'comment':np.array([],dtype=str)}
+
+def read_dispersion_table(npzfilename):
+    """ Reads the binary multi-order dispersion table (.npz).
+    Returns a dictionary of the column arrays in DISPTABLE_COLUMNS """
+    try :
+        with np.load(npzfilename,allow_pickle=False) as data:
+            return {col:data[col] for col in DISPTABLE_COLUMNS}
+    except IOError:
+        print('ERROR: Cannot read dispersion table: {0}'.format(npzfilename))
+        raise
+
+@contextmanager
+def dispersion_table_lock(npzfilename):
+    """ Holds an exclusive lock of the binary dispersion table npzfilename, so that the processes updating 
+    different orders of the same table do not lose each other's updates.
+    The table itself cannot be locked, since every write replaces it by a rename. So the lock is taken on a
+    table.npz.lock file next to it, which is removed when the lock is released. """
+    lockfilename = npzfilename+'.lock'
+    while True:
+        lockfile = open(lockfilename,'w')
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        # The previous holder could have removed the lock file while we waited for it; if so lock the new one
+        try:
+            if os.path.samestat(os.fstat(lockfile.fileno()),os.stat(lockfilename)):
+                break
+        except OSError:
+            pass
+        lockfile.close()
+    try:
+        yield
+    finally:
+        os.remove(lockfilename)  # Removed before releasing the lock, so that no one else can lock the removed file
+        lockfile.close()
+
+def write_dispersion_table(npzfilename,table):
+    """ Writes the binary multi-order dispersion table dictionary to npzfilename.
+    The file is first written to a temporary file and then moved, so that it is never left half written. """
+    tmpfilename = npzfilename+'.tmp'
+    with open(tmpfilename,'wb') as f:
+        np.savez(f,**{col:np.asarray(table[col]) for col in DISPTABLE_COLUMNS})
+    os.rename(tmpfilename,npzfilename)
+
+def convert_to_dispersion_table(disp_filenames,npzfilename):
+    """ Converts the list of per order Dispersion Input text files `disp_filenames` to a single binary
+    dispersion table npzfilename. Index in the list is used as the order number. """
+    table = empty_dispersion_table()
+    rows = {col:[] for col in DISPTABLE_COLUMNS}
+    for order, disp_filename in enumerate(disp_filenames):
+        wavelengths_without_pixels, (wavelengths,pixels,sigma) = read_dispersion_inputfile(disp_filename)
+        Nlines = len(wavelengths)+len(wavelengths_without_pixels)
+        rows['order'].append(np.full(Nlines,order,dtype=int))
+        rows['wavelength'].append(np.array(wavelengths+wavelengths_without_pixels,dtype=float))
+        rows['pixel'].append(np.array(pixels+[np.nan]*len(wavelengths_without_pixels),dtype=float))
+        rows['sigma'].append(np.array(sigma+[np.nan]*len(wavelengths_without_pixels),dtype=float))
+        rows['flag'].append(np.zeros(Nlines,dtype=int))
+        rows['comment'].append(np.array(['']*Nlines,dtype=str))
+    for col in DISPTABLE_COLUMNS:
+        if rows[col]:
+            table[col] = np.concatenate(rows[col])
+    write_dispersion_table(npzfilename,table)
+    return npzfilename
+
+def dispersion_inputfile_exists(filename):
+    """ Returns True if the Dispersion Input file (or the order in a binary table.npz[order]) exists """
+    npzfilename, order = split_dispersion_table_name(filename)
+    if npzfilename is None:
+        return os.path.isfile(filename)
+    if not os.path.isfile(npzfilename):
+        return False
+    return bool(np.any(read_dispersion_table(npzfilename)['order'] == order))
+
+def create_dispersion_inputfile(filename,wavelengths,comment='',pixels=None,sigma=None):
+    """ Creates a new Dispersion Input file with the wavelengths to fit (without pixel positions).
+    If the pixels (and sigma) of the wavelengths are also provided, they are written as already fitted lines.
+    The file is first written to a temporary file and then moved, so that it is never left half written.
+    If filename is of the form table.npz[order], the order is (re)created in the binary table, 
+    holding the dispersion_table_lock (a temporary table.npz.lock file) while updating it. """
+    Nlines = len(wavelengths)
+    pixels = np.full(Nlines,np.nan) if pixels is None else np.asarray(pixels,dtype=float)
+    if sigma is None:
+        sigma = np.where(np.isnan(pixels),np.nan,1.)  # default 1 pix as sigma
+    npzfilename, order = split_dispersion_table_name(filename)
+    if npzfilename is None:
+        tmpfilename = filename+'.tmp'
+        with open(tmpfilename,'w') as outdispfile:
+            outdispfile.write('# Wavelengths Pixel Sigma # comments\n')
+            for wavel,pix,w in zip(wavelengths,pixels,sigma):
+                if np.isnan(pix):
+                    outdispfile.write('{0} # {1}\n'.format(wavel,comment))
+                else:
+                    outdispfile.write('{0} {1} {2} # {3}\n'.format(wavel,pix,w,comment))
+        os.rename(tmpfilename,filename)
+        return filename
+
+    with dispersion_table_lock(npzfilename):  # Other processes could be writing other orders
+        if os.path.isfile(npzfilename):
+            table = read_dispersion_table(npzfilename)
+        else:
+            table = empty_dispersion_table()
+        Keep = table['order'] != order
+        new_rows = {'order':np.full(Nlines,order,dtype=int), 'wavelength':np.array(wavelengths,dtype=float),
+                    'pixel':np.array(pixels,dtype=float), 'sigma':np.array(sigma,dtype=float),
+                    'flag':np.zeros(Nlines,dtype=int), 'comment':np.array([comment]*Nlines,dtype=str)}
+        table = {col:np.concatenate([table[col][Keep],new_rows[col]]) for col in DISPTABLE_COLUMNS}
+        write_dispersion_table(npzfilename,table)
+    return filename
+
+def read_dispersion_inputfile(filename):
+    """ Reads the Dispersion Input text file.
+    If filename is of the form table.npz[order], the order is read from the binary dispersion table instead.
+    Returns a list of wavelengths without pixel ref
+    And a tuple of (wavelengths, pixels, sigma) containing lists"""
+    npzfilename, order = split_dispersion_table_name(filename)
+    if npzfilename is not None:
+        table = read_dispersion_table(npzfilename)
+        InOrder = table['order'] == order
+        NoPixel = np.isnan(table['pixel'])
+        wavelengths_without_pixels = table['wavelength'][InOrder & NoPixel].tolist()
+        sigma = np.where(np.isnan(table['sigma']),1,table['sigma'])  # default 1 pix as sigma
+        return wavelengths_without_pixels, (table['wavelength'][InOrder & ~NoPixel].tolist(),
+                                            table['pixel'][InOrder & ~NoPixel].tolist(),
+                                            sigma[InOrder & ~NoPixel].tolist())
+
+    wavelengths_without_pixels = []
+    wavelengths = []
+    pixels = []
+    sigma = []
+
+    try :
+        with open(filename) as f:
+            for line in f:
+                if line[0] == '#' : continue  # commented lines
+                line = line.rstrip().split('#')[0] # remove any inline comments
+                if len(line.split()) == 1:
+                    wavelengths_without_pixels.append(float(line))
+                elif len(line.split()) == 3:
+                    wavelengths.append(float(line.split()[0]))
+                    pixels.append(float(line.split()[1]))
+                    sigma.append(float(line.split()[2]))
+                elif len(line.split()) == 2:
+                    wavelengths.append(float(line.split()[0]))
+                    pixels.append(float(line.split()[1]))
+                    sigma.append(1) # default 1 pix as sigma
+    except IOError:
+        print('ERROR: Cannot read dispersion file: {0}'.format(filename))
+        raise
+
+    return wavelengths_without_pixels, (wavelengths,pixels,sigma)
+
+def writeto_dispersion_table(npzfilename,order,wavelengths,pixels,sigma,backupsuffix='.bak',wavel_tol=1e-6):
+    """ writes the fitted pixel positions of the order to the binary dispersion table.
+    Oldfile is backedup with .bak prefix, unless backupsuffix is None.
+    The dispersion_table_lock (a temporary table.npz.lock file) is held while updating the table. """
+    with dispersion_table_lock(npzfilename):  # Other processes could be writing other orders
+        if backupsuffix is not None:
+            shutil.copy(npzfilename,npzfilename+backupsuffix)
+        table = read_dispersion_table(npzfilename)
+        OrderRows = np.flatnonzero(table['order'] == order)
+        RowIndex = WavelengthIndex(table['wavelength'][OrderRows].tolist(),tol=wavel_tol)
+        new_rows = {col:[] for col in DISPTABLE_COLUMNS}
+        for wavel,pix,w in zip(wavelengths,pixels,sigma):
+            ind = RowIndex.find(wavel)
+            if ind is not None:
+                table['pixel'][OrderRows[ind]] = pix
+                table['sigma'][OrderRows[ind]] = w
+            else:
+                # Now append any remaining new lines
+                for col,value in zip(DISPTABLE_COLUMNS,(order,wavel,pix,w,0,'')):
+                    new_rows[col].append(value)
+        if new_rows['order']:
+            table = {col:np.concatenate([table[col],np.array(new_rows[col],dtype=table[col].dtype)])
+                     for col in DISPTABLE_COLUMNS}
+        write_dispersion_table(npzfilename,table)
+
+def writeto_dispersion_inputfile(filename,wavelengths,pixels,sigma,backupsuffix='.bak',wavel_tol=1e-6):
+    """ writes the fitted pixel positions to inputfile .
+    If filename is of the form table.npz[order], the order in the binary dispersion table is updated instead.
+    Old file lines are matched to the input wavelengths within wavel_tol using a hash index, 
+    and streamed line by line to a temporary file, which then replaces the old file.
+    Oldfile is backedup with .bak prefix, unless backupsuffix is None"""
+    npzfilename, order = split_dispersion_table_name(filename)
+    if npzfilename is not None:
+        return writeto_dispersion_table(npzfilename,order,wavelengths,pixels,sigma,
+                                        backupsuffix=backupsuffix,wavel_tol=wavel_tol)
+
+    tmpfilename = filename+'.tmp'
+    wavelength_index = WavelengthIndex(wavelengths,tol=wavel_tol)
+    already_addedinfile = np.zeros(len(wavelengths),dtype=bool)
+    with open(filename,'r') as oldfile, open(tmpfilename,'w') as newfile:
+        for line in oldfile:
+            try:
+                wavel = float(line.rstrip().split()[0])
+            except (ValueError, IndexError):
+                pass
+            else:
+                ind = wavelength_index.find(wavel)
+                if ind is not None:
+                    textindx = len(line.rstrip().split()[0])
+                    line = line[:textindx] +\
+                           ' {0} {1} #'.format(pixels[ind],sigma[ind]) +\
+                           line[textindx:]
+                    already_addedinfile[ind] = True
+            finally:
+                newfile.write(line)
+
+        # Now append any remaining new lines
+        for ind in range(len(wavelengths)):
+            if not already_addedinfile[wavelength_index.find(wavelengths[ind])]:
+                newfile.write('{0} {1} {2}\n'.format(wavelengths[ind],pixels[ind],sigma[ind]))
+
+    # Old backup will be overwritten
+    if backupsuffix is not None:
+        shutil.copy(filename,filename+backupsuffix)
+    os.rename(tmpfilename,filename)
+
+def FitNewLinesinSpectrum(SpectrumY,wavelengths_tofit,reference_lines,LineSigma=1.5,reference_pixshift=0,
+                          SpectrumY_Var=None, guess_function='c5', plot_pdf_output=None, timer=None,
+                          min_peak_snr=None, peak_match_tol=3.):
+    """ Fits gaussian at the wavelengths_tofit in the spectrum, without reading or writing any dispersion file.
+    reference_lines: tuple of (wavelengths, pixels, sigma) of already calibrated lines, used to calculate dispersion solution
+                     for the initial guess of the line positions.
+    min_peak_snr (optional): If provided, the lines are first detected in the whole spectrum (see DetectPeaks), and only the 
+                     wavelengths which have a detected line within peak_match_tol pixels of their predicted position are fitted,
+                     starting from the detected position. Wavelengths outside the spectrum are not fitted either.
+    See TryToFitNewLinesinSpectrum for the rest of the arguments.
+    Returns : (pix_fitted, sigma_fitted) lists of the fitted pixel positions and their sigma for each of the wavelengths_tofit.
+              These are NaN for the wavelengths not fitted due to min_peak_snr,
+              and for the lines whose fitted mean wandered outside their fitting window.
+    """
+    timer = StageTimer() if timer is None else timer
+    wavelengths_inp, pixels_inp, sigma_inp = reference_lines
+    wavelengths_tofit = list(wavelengths_tofit)
+    timer.start('guess_positions')
+    # Dispertion function
+    disp_func = get_fitted_function(pixels=np.array(pixels_inp)+reference_pixshift,
+                                    wavel=wavelengths_inp,
+                                    sigma=sigma_inp, method=guess_function)
+
+    XPixarray = np.arange(len(SpectrumY))
+    # Evaluate the dispersion function only once, and invert it for all the wavelengths together
+    WavlPixarray = disp_func(XPixarray)
+    Xpos_all = NearestIndices(WavlPixarray,wavelengths_tofit)
+    ToFit = np.ones(len(wavelengths_tofit),dtype=bool)
+    if (min_peak_snr is not None) and wavelengths_tofit:
+        with timer.stage('peak_detection'):
+            Peaks = DetectPeaks(SpectrumY,Sigma=LineSigma,min_snr=min_peak_snr,SpecY_Var=SpectrumY_Var)
+            Matches = MatchPeaksToPositions(Peaks.position,Xpos_all,tol=peak_match_tol)
+            OnDetector = (np.asarray(wavelengths_tofit) >= np.min(WavlPixarray)) & \
+                         (np.asarray(wavelengths_tofit) <= np.max(WavlPixarray))
+            ToFit = (Matches >= 0) & OnDetector
+            Xpos_all = Peaks.position[Matches[ToFit]]
+        logger.info('Fitting %d of %d lines which have a detected line within %s pixels (%d lines detected)', 
+                    np.sum(ToFit), len(ToFit), peak_match_tol, len(Peaks.position))
+        timer.count('lines_culled',np.sum(~ToFit))
+    wavelengths_tofit = [wavel for wavel,fit in zip(wavelengths_tofit,ToFit) if fit]
+    Ampl_init_all = []
+    if wavelengths_tofit:
+        # Initial amplitude is the max-min in a +-3 LineSigma window around each line
+        Lstart = np.maximum(np.rint(Xpos_all-3*LineSigma).astype(int),0)
+        Lend = np.rint(Xpos_all+3*LineSigma).astype(int)+1
+        WindowIdx = Lstart[:,np.newaxis] + np.arange(np.max(Lend-Lstart))[np.newaxis,:]
+        Valid = (WindowIdx < Lend[:,np.newaxis]) & (WindowIdx < len(SpectrumY))
+        WindowY = SpectrumY[np.clip(WindowIdx,0,len(SpectrumY)-1)]
+        Ampl_init_all = np.max(np.where(Valid,WindowY,-np.inf),axis=1) - \
+                        np.min(np.where(Valid,WindowY,np.inf),axis=1)
+
+    timer.stop('guess_positions')
+
+    pix_fitted = []
+    sigma_fitted = []
+    if wavelengths_tofit:
+        # Fit Guassian lines to all the lines simultaneously
+        with timer.stage('line_fit'):
+            LineFits = FitLinesToData(SpectrumY,Xpos_all,Ampl_init_all,
+                                      AmpisBkgSubtracted=False,Sigma = LineSigma, SpecY_Var = SpectrumY_Var)
+        pix_fitted = list(LineFits.mean)
+        # to be updated later with actual error. Lines whose fit wandered off the window are NaN
+        sigma_fitted = np.where(np.isfinite(LineFits.mean),1.,np.nan).tolist()
+        timer.count('lines_fitted',len(pix_fitted))
+        timer.count('lines_not_converged',np.sum(~np.asarray(LineFits.converged)))
+        timer.count('lines_outside_window',np.sum(~np.isfinite(LineFits.mean)))
+        if not np.all(np.isfinite(LineFits.mean)):
+            logger.info('Dropping %d lines whose fitted mean is outside the fitting window', np.sum(~np.isfinite(LineFits.mean)))
+
+    if plot_pdf_output is not None:
+        timer.start('plot')
+        import matplotlib.pyplot as plt
+        from matplotlib.backends.backend_pdf import PdfPages
+        pdfplots = PdfPages(plot_pdf_output)
+        for i,(wavel,Xpos) in enumerate(zip(wavelengths_tofit,Xpos_all)):
+            Model_fit = BuildLineModel(LineFits.amplitude[i],LineFits.mean[i],LineFits.stddev[i],
+                                       LineFits.slope[i],LineFits.intercept[i])
+            Lstart = max(int(np.rint(Xpos-3*LineSigma)),0)
+            Lend = int(np.rint(Xpos+3*LineSigma))+1
+            # Make the plots to save to the pdf file
+            fig = plt.figure(figsize=(6, 6))
+            plt.plot(XPixarray[Lstart:Lend],SpectrumY[Lstart:Lend],'.',color='k')
+            if SpectrumY_Var is not None:
+                plt.errorbar(XPixarray[Lstart:Lend],SpectrumY[Lstart:Lend],yerr=np.sqrt(SpectrumY_Var[Lstart:Lend]),color='k')
+            plt.plot(np.linspace(Lstart,Lend,(Lend-Lstart)*10),Model_fit(np.linspace(Lstart,Lend,(Lend-Lstart)*10)),color='r',label=str(Model_fit.mean_0.value))
+            plt.title('Wavl = {0}'.format(wavel))
+            plt.legend()
+            pdfplots.savefig()
+            plt.close()
+        pdfplots.close()
+        timer.stop('plot')
+    if not np.all(ToFit):
+        # Put back the lines which were not fitted as NaN
+        pix_all = np.full(len(ToFit),np.nan)
+        sigma_all = np.full(len(ToFit),np.nan)
+        pix_all[ToFit] = pix_fitted
+        sigma_all[ToFit] = sigma_fitted
+        pix_fitted, sigma_fitted = pix_all.tolist(), sigma_all.tolist()
+    return pix_fitted, sigma_fitted
+
+def TryToFitNewLinesinSpectrum(SpectrumY,disp_filename,LineSigma=1.5,reference_dispfile = None,reference_pixshift = 0,
+                               SpectrumY_Var = None, guess_function='c5', plot_pdf_output = None, timer = None,
+                               min_peak_snr = None, peak_match_tol = 3.):
+    """ Try to fit gaussian at the line wavelengths without pixel position in the disp_filename.
+    And add the fitted pixels values to the file.
+    If reference_dispfile is provided, data in that file will be used to claculate dispersion solution.
+    reference_pixshift (default= 0): Optional pixel shift to apply to pixel entires in `reference_dispfile`. Useful for correcting large shifts.
+    SpectrumY_Var (optional): Variance of the SpectrumY array if need to be considerd in line fitting.
+    guess_function (default='c5'): Polynomial model to use to interpolate existing solution for initial guess of new line positions.
+    plot_pdf_output (optional): Save the plots of the individual line fits in a multipage pdf file is a filename is provided.
+    timer (optional): StageTimer to record the wall time of each stage and the number of lines fitted.
+    min_peak_snr (optional): Fit only the lines detected above this SNR near their predicted position (see FitNewLinesinSpectrum).
+    peak_match_tol (default=3): Maximum distance in pixels of the detected line from the predicted position.
+    See FitNewLinesinSpectrum to fit the lines without the file round trips.
+    """
+    timer = StageTimer() if timer is None else timer
+    if reference_dispfile is None:  # use the entry in disp_filename itself
+        reference_dispfile = disp_filename
+        reference_pixshift = 0  # No pixel shift needed if reference file is not provided
+
+    timer.start('read_tables')
+    # First read the existing calibration
+    _ , reference_lines = read_dispersion_inputfile(reference_dispfile)
+    # Now read the wavelengths to calibrate
+    wavelengths_tofit, (_discard1,_discard2,_discard3) = read_dispersion_inputfile(disp_filename)
+    timer.stop('read_tables')
+    pix_fitted, sigma_fitted = FitNewLinesinSpectrum(SpectrumY,wavelengths_tofit,reference_lines,LineSigma=LineSigma,
+                                                     reference_pixshift=reference_pixshift,SpectrumY_Var=SpectrumY_Var,
+                                                     guess_function=guess_function,plot_pdf_output=plot_pdf_output,timer=timer,
+                                                     min_peak_snr=min_peak_snr,peak_match_tol=peak_match_tol)
+    # Write the fitted pixel positions
+    Fitted = np.isfinite(pix_fitted)
+    if np.any(Fitted):
+        with timer.stage('write_table'):
+            writeto_dispersion_inputfile(disp_filename,np.asarray(wavelengths_tofit)[Fitted].tolist(),
+                                         np.asarray(pix_fitted)[Fitted].tolist(),np.asarray(sigma_fitted)[Fitted].tolist())
+
+
+class LazyFluxData(object):
+    """ Lazy per-order view of a memory mapped multi-order flux array in a .npy or .fits file.
+    Only the orders which are accessed are read from the disk. 
+    The file is kept open until close() is called, or it is used as a context manager (with statement). """
+    def __init__(self,filename,fits_ext=0):
+        self.filename = filename
+        self._hdulist = None
+        if os.path.splitext(filename)[-1] == '.npy':
+            self._data = np.load(filename,mmap_mode='r')
+        elif os.path.splitext(filename)[-1] == '.fits':
+            from astropy.io import fits
+            self._hdulist = fits.open(filename,memmap=True)
+            self._data = self._hdulist[fits_ext].data
+        else:
+            raise ValueError('Unknown input file extension for file : {0}'.format(filename))
+        self.shape = self._data.shape
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self,index):
+        """ Returns an in memory copy of the requested order(s) """
+        return np.array(self._data[index])
+
+    def __iter__(self):
+        for order in range(len(self)):
+            yield self[order]
+
+    def close(self):
+        """ Closes the underlying file """
+        self._data = None
+        if self._hdulist is not None:
+            self._hdulist.close()
+            self._hdulist = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def load_fluxdata(filename,fits_ext=0,lazy=False):
+    """ Loads the flux data 
+    lazy : (bool, default False) If True returns a memory mapped LazyFluxData object 
+           which reads only the orders which are accessed. """
+    if lazy and (os.path.splitext(filename)[-1] in ['.npy','.fits']):
+        return LazyFluxData(filename,fits_ext=fits_ext)
+    if os.path.splitext(filename)[-1] == '.npy':
+        return np.load(filename)
+    elif os.path.splitext(filename)[-1] == '.fits':
+        from astropy.io import fits
+        return fits.getdata(filename,ext=fits_ext)
+    else:
+        print('Unknown input file extension for file : {0}'.format(filename))
+        sys.exit(1)
+
+def write_wavldata(output_filename,data,fits_headerDic=None,overwrite=False,fits_tables=None):
+    """ Writes the wavl solution data 
+    overwrite : (bool, default False) Overwrite an existing fits file. Existing .npy files are always overwritten.
+    fits_tables : (optional) Dictionary of {EXTNAME: numpy structured array} to write as binary table extensions of the fits file"""
+    if os.path.splitext(output_filename)[-1] == '.npy':
+        np.save(output_filename,data)
+    elif os.path.splitext(output_filename)[-1] == '.fits':
+        from astropy.io import fits
+        hdu = fits.PrimaryHDU(data)
+        if fits_headerDic is not None:
+            for key,value in fits_headerDic.items():
+                hdu.header[key] = value
+        hdulist = fits.HDUList([hdu])
+        if fits_tables is not None:
+            for extname,table in fits_tables.items():
+                hdulist.append(fits.BinTableHDU(table,name=extname))
+        hdulist.writeto(output_filename,overwrite=overwrite)
+    else:
+        print('Unknown output file extension for file : {0}'.format(output_filename))
+        sys.exit(1)
+    return output_filename
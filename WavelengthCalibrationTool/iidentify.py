@@ -1,23 +1,27 @@
 #!/usr/bin/env python
 """ This is an interactive tool to identify calibration lamp lines from line atlas """
-from .utils import NearestIndex, FitLineToData
+from .utils import NearestIndex, NearestIndices, FitLineToData, IncrementalPolynomialFit, setup_logging
+# Non-interactive parts are in dispersion module, imported here for backward compatibility
+from .dispersion import get_fitted_function, POLYNOMIAL_METHODS, DISPTABLE_COLUMNS, WavelengthIndex
+from .dispersion import split_dispersion_table_name, empty_dispersion_table, read_dispersion_table, write_dispersion_table
+from .dispersion import convert_to_dispersion_table, dispersion_inputfile_exists
+from .dispersion import create_dispersion_inputfile, read_dispersion_inputfile, writeto_dispersion_table
+from .dispersion import writeto_dispersion_inputfile, TryToFitNewLinesinSpectrum, LazyFluxData, load_fluxdata, write_wavldata
 import sys
-import shutil
 import uuid
-import time
 import readline
 import argparse
 import re
 import os
+import logging
 from multiprocessing import Process, Pipe
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.widgets import SpanSelector
-from matplotlib.backends.backend_pdf import PdfPages
-from astropy.io import fits
-from astropy.stats import sigma_clip
+from matplotlib.collections import LineCollection
 from termios import tcflush, TCIOFLUSH
-import scipy.interpolate
+
+logger = logging.getLogger(__name__)
 
 # For python 2, replace the input function with raw_input
 if sys.version_info < (3,0):
@@ -101,156 +105,18 @@ def SelectLinesInteractively(SpectrumX,SpectrumY,ExtraUserInput=None,comm_pipe=N
     # print('Identified Lines : {0}'.format(LinesConfirmedToReturn))
     return LinesConfirmedToReturn
 
-def get_fitted_function(pixels,wavel,sigma=None,method='c3',return_coeff=False,sigma_to_clip=False):
-    """ Returns the fitted function f(pixels) = wavel .
-    Define all the methods to use for fitting here
-    pX : polynoial of X degree
-    cX : Chebyshev polynoial of X degree
-    lX : Legendre polynoial of X degree
-    sX : spline with smoothing parameter X
-    """
-    output_object = None
-    pixels = np.array(pixels)
-    wavel = np.array(wavel)
-    sigma = np.array(sigma)
-
-    if (method[0] == 'p') and method[1:].isdigit():
-        # Use polynomial of p* degree.
-        deg = int(method[1:])
-        p,residuals,rank,sing_values,rcond = np.polyfit(pixels,wavel,deg,w=1/sigma,full=True)
-        print('Stats of the poly fit of degree {0}'.format(deg))
-        print('Poly Coeffs p: {0}'.format(p))
-        print('residuals:{0},  rank:{1}, singular_values:{2}, rcond:{3}'.format(residuals,
-                                                                                rank,sing_values,
-                                                                                rcond))
-        output_object = np.poly1d(p)
-        coeffs = p
-
-    elif (method[0] == 'c') and method[1:].isdigit():
-        # Use Chebyshev polynomial of c* degree.
-        deg = int(method[1:])
-        c, (residuals,rank,sing_values,rcond) = np.polynomial.chebyshev.chebfit(pixels,wavel,deg,w=1/sigma,full=True)
-        print('Stats of the Chebyshev polynomial fit of degree {0}'.format(deg))
-        print('Cheb Coeffs c: {0}'.format(c))
-        print('residuals:{0},  rank:{1}, singular_values:{2}, rcond:{3}'.format(residuals,
-                                                                                rank,sing_values,
-                                                                                rcond))
-        output_object = lambda x : np.polynomial.chebyshev.chebval(x, c)
-        coeffs = c
-
-    elif (method[0] == 'l') and method[1:].isdigit():
-        # Use Legendre polynomial of l* degree.
-        deg = int(method[1:])
-        c, (residuals,rank,sing_values,rcond) = np.polynomial.legendre.legfit(pixels,wavel,deg,w=1/sigma,full=True)
-        print('Stats of the Legendre polynomial fit of degree {0}'.format(deg))
-        print('Legendre Coeffs c: {0}'.format(c))
-        print('residuals:{0},  rank:{1}, singular_values:{2}, rcond:{3}'.format(residuals,
-                                                                                rank,sing_values,
-                                                                                rcond))
-        output_object = lambda x : np.polynomial.legendre.legval(x, c)
-        coeffs = c
-
-    elif (method[0] == 's'):
-        # Use spline with smoothing parameter s*
-        if method[1:]:
-            smooth = float(method[1:])
-        else:
-            smooth = None
-        isort = np.argsort(pixels)  # indices for sorting the input to spline funtion
-        output_object = scipy.interpolate.UnivariateSpline(pixels[isort],wavel[isort], w=1/sigma[isort],k=3, s=smooth, ext=0)
-        print('Stats of the Spline fit of smoothness {0}'.format(smooth))
-        print('Spline Knots :{0}'.format(output_object.get_knots()))
-        print('Spline Coeffs :{0}'.format(output_object.get_coeffs()))
-        print('residuals:{0}'.format(output_object.get_residual()))
-        coeffs = output_object.get_coeffs()
-
-    else:
-        print('Error: unknown fitting method {0}'.format(method))
-        raise NotImplementedError
-
-    if sigma_to_clip:
-        # Do a sigma clipping filtering of the data points
-        residue = (wavel - output_object(pixels))/sigma
-        filtered_residue = sigma_clip(residue, sigma=sigma_to_clip)
-        Mask = ~filtered_residue.mask
-        print('Refitting after rejecting {0} outliers'.format(np.sum(~Mask)))
-        output_object, coeffs = get_fitted_function(pixels[Mask],wavel[Mask],sigma=sigma[Mask],method=method,return_coeff=True,sigma_to_clip=False)
-
-    if return_coeff and sigma_to_clip:
-        return output_object, coeffs, Mask
-    elif return_coeff:
-        return output_object, coeffs
-    else:
-        return output_object
-
-def read_dispersion_inputfile(filename):
-    """ Reads the Dispersion Input text file.
-    Returns a list of wavelengths without pixel ref
-    And a tuple of (wavelengths, pixels, sigma) containing lists"""
-    wavelengths_without_pixels = []
-    wavelengths = []
-    pixels = []
-    sigma = []
-
-    try :
-        with open(filename) as f:
-            for line in f:
-                if line[0] == '#' : continue  # commented lines
-                line = line.rstrip().split('#')[0] # remove any inline comments
-                if len(line.split()) == 1:
-                    wavelengths_without_pixels.append(float(line))
-                elif len(line.split()) == 3:
-                    wavelengths.append(float(line.split()[0]))
-                    pixels.append(float(line.split()[1]))
-                    sigma.append(float(line.split()[2]))
-                elif len(line.split()) == 2:
-                    wavelengths.append(float(line.split()[0]))
-                    pixels.append(float(line.split()[1]))
-                    sigma.append(1) # default 1 pix as sigma
-    except IOError:
-        print('ERROR: Cannot read dispersion file: {0}'.format(filename))
-        raise
-
-    return wavelengths_without_pixels, (wavelengths,pixels,sigma)
-
-def writeto_dispersion_inputfile(filename,wavelengths,pixels,sigma,backupsuffix='.bak'):
-    """ writes the fitted pixel positions to inputfile .
-    Oldfile is backedup with .bak prefix"""
-    # First backup file # Old backup will be overwritten
-    shutil.move(filename,filename+backupsuffix)
-    
-    already_addedinfile = []
-    with open(filename+backupsuffix,'r') as oldfile, open(filename,'w') as newfile:
-        for line in oldfile:
-            try:
-                wavel = float(line.rstrip().split()[0])
-            except ValueError:
-                pass
-            else:
-                if wavel in wavelengths:
-                    ind = wavelengths.index(wavel)
-                    textindx = len(line.rstrip().split()[0])
-                    line = line[:textindx] +\
-                           ' {0} {1} #'.format(pixels[ind],sigma[ind]) +\
-                           line[textindx:]
-                    already_addedinfile.append(wavel)
-            finally:
-                newfile.write(line)
-
-        # Now append any remaining new lines
-        for wavel,pix,w in zip(wavelengths,pixels,sigma):
-            if wavel not in already_addedinfile:
-                newfile.write('{0} {1} {2}\n'.format(wavel,pix,w))
-
-def update_main_figure(fig_main,SpectrumY,wavltofit__wavl_pix_sigma):
+def update_main_figure(fig_main,SpectrumY,wavltofit__wavl_pix_sigma,disp_func=None):
     """ Updates the main plot of the latest dispersion fit.
+    disp_func (optional): Already fitted dispersion function (eg: IncrementalPolynomialFit) to plot. 
+                          If not provided, the lines are fitted again.
     Also returns the latest dispersion function used"""
-    print(wavltofit__wavl_pix_sigma[1])
+    logger.debug('%s',wavltofit__wavl_pix_sigma[1])
     wavelengths_inp,pixels_inp,sigma_inp = wavltofit__wavl_pix_sigma[1]
     wavelengths_tofit = wavltofit__wavl_pix_sigma[0]
-    disp_func = get_fitted_function(pixels=pixels_inp,
-                                    wavel=wavelengths_inp,
-                                    sigma=sigma_inp, method='c6')
+    if disp_func is None:
+        disp_func = get_fitted_function(pixels=pixels_inp,
+                                        wavel=wavelengths_inp,
+                                        sigma=sigma_inp, method='c6')
     fig_main.clf()
     ax = fig_main.add_subplot(111)
 
@@ -266,18 +132,22 @@ def update_main_figure(fig_main,SpectrumY,wavltofit__wavl_pix_sigma):
     #Colormap which is red when maximum
     colormap = plt.get_cmap('PuRd')
     pointYlevel = np.median(SpectrumY)
-    residuesW = [np.abs(w-disp_func(pix))/np.abs(disp_func(pix)-disp_func(pix+sig)) \
-                 for w,pix,sig in zip(wavelengths_inp,pixels_inp,sigma_inp)]
-
-    NresiduesW = np.array(residuesW)/max(residuesW)
-    print('RMS of residue: {0}'.format(np.sqrt(np.mean(np.power(residuesW,2)))))
-    print('RMS of Normalised residue: {0}'.format(np.sqrt(np.mean(np.power(NresiduesW,2)))))
-    print('Individual Normalised Residues of fit:')
-    print('Wavel  Pixel  Nresidue')
-    for w,pix,Nresid in zip(wavelengths_inp,pixels_inp,NresiduesW):
-        ax.plot([w,disp_func(pix)],[pointYlevel]*2,color=colormap(int(Nresid*255)))
-        ax.plot([w],[pointYlevel],'.',color=colormap(int(Nresid*255)))
-        print('{0}   {1}  {2}'.format(w,pix,Nresid))
+    wavelengths_inp = np.array(wavelengths_inp)
+    pixels_inp = np.array(pixels_inp)
+    fitted_wavl = disp_func(pixels_inp)
+    residuesW = np.abs(wavelengths_inp-fitted_wavl)/np.abs(fitted_wavl-disp_func(pixels_inp+np.array(sigma_inp)))
+
+    NresiduesW = residuesW/np.max(residuesW)
+    logger.info('RMS of residue: %s', np.sqrt(np.mean(np.power(residuesW,2))))
+    logger.info('RMS of Normalised residue: %s', np.sqrt(np.mean(np.power(NresiduesW,2))))
+    colors = colormap((NresiduesW*255).astype(int))
+    # Draw all the residue segments as a single collection
+    ax.add_collection(LineCollection([[(w,pointYlevel),(fw,pointYlevel)] for w,fw in zip(wavelengths_inp,fitted_wavl)],
+                                     colors=colors))
+    ax.scatter(wavelengths_inp,[pointYlevel]*len(wavelengths_inp),marker='.',color=colors)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Individual Normalised Residues of fit:\nWavel  Pixel  Nresidue\n%s',
+                     '\n'.join('{0}   {1}  {2}'.format(w,pix,Nresid) for w,pix,Nresid in zip(wavelengths_inp,pixels_inp,NresiduesW)))
 
     print('>>')
     ax.set_xlabel('Wavelength')
@@ -302,74 +172,28 @@ def AddlinesbyInteractiveSelection(SpectrumY,disp_filename,comm_pipe=None):
         writeto_dispersion_inputfile(disp_filename,wavl,pix,sigma)
 
 
-def TryToFitNewLinesinSpectrum(SpectrumY,disp_filename,LineSigma=1.5,reference_dispfile = None,reference_pixshift = 0,
-                               SpectrumY_Var = None, guess_function='c5', plot_pdf_output = None):
-    """ Try to fit gaussian at the line wavelengths without pixel position in the disp_filename.
-    And add the fitted pixels values to the file.
-    If reference_dispfile is provided, data in that file will be used to claculate dispersion solution.
-    reference_pixshift (default= 0): Optional pixel shift to apply to pixel entires in `reference_dispfile`. Useful for correcting large shifts.
-    SpectrumY_Var (optional): Variance of the SpectrumY array if need to be considerd in line fitting.
-    guess_function (default='c5'): Polynomial model to use to interpolate existing solution for initial guess of new line positions.
-    plot_pdf_output (optional): Save the plots of the individual line fits in a multipage pdf file is a filename is provided.
-    """
-    if reference_dispfile is None:  # use the entry in disp_filename itself
-        reference_dispfile = disp_filename
-        reference_pixshift = 0  # No pixel shift needed if reference file is not provided
-
-    # First read the existing calibration
-    _ , (wavelengths_inp,pixels_inp,sigma_inp) = read_dispersion_inputfile(reference_dispfile)
-    # Now read the wavelengths to calibrate
-    wavelengths_tofit, (_discard1,_discard2,_discard3) = read_dispersion_inputfile(disp_filename)
-    # Dispertion function
-    disp_func = get_fitted_function(pixels=np.array(pixels_inp)+reference_pixshift,
-                                    wavel=wavelengths_inp,
-                                    sigma=sigma_inp, method=guess_function)
-
-    pix_fitted = []
-    sigma_fitted = []
-    if plot_pdf_output is not None:
-        pdfplots = PdfPages(plot_pdf_output)
-    for wavel in wavelengths_tofit:
-        XPixarray = np.arange(len(SpectrumY))
-        Xpos = NearestIndex(disp_func(XPixarray),wavel)
-        Lstart = int(np.rint(Xpos-3*LineSigma))
-        Lend = int(np.rint(Xpos+3*LineSigma))+1
-        Ampl_init = np.max(SpectrumY[Lstart:Lend]) - \
-                    np.min(SpectrumY[Lstart:Lend])
-        # Fit a Guassian line
-        Model_fit = FitLineToData(XPixarray,SpectrumY,Xpos,Ampl_init,
-                                  AmpisBkgSubtracted=False,Sigma = LineSigma, SpecY_Var = SpectrumY_Var)
-        pix_fitted.append(Model_fit.mean_0.value)
-        sigma_fitted.append(1) # to be updated later with actual error
-        if plot_pdf_output is not None:
-            # Make the plots to save to the pdf file
-            fig = plt.figure(figsize=(6, 6))
-            plt.plot(XPixarray[Lstart:Lend],SpectrumY[Lstart:Lend],'.',color='k')
-            if SpectrumY_Var is not None:
-                plt.errorbar(XPixarray[Lstart:Lend],SpectrumY[Lstart:Lend],yerr=np.sqrt(SpectrumY_Var[Lstart:Lend]),color='k')
-            plt.plot(np.linspace(Lstart,Lend,(Lend-Lstart)*10),Model_fit(np.linspace(Lstart,Lend,(Lend-Lstart)*10)),color='r',label=str(Model_fit.mean_0.value))
-            plt.title('Wavl = {0}'.format(wavel))
-            plt.legend()
-            pdfplots.savefig()
-            plt.close()
-    if plot_pdf_output is not None:
-        pdfplots.close()
-    # Write the fitted pixel positions
-    if pix_fitted:
-        writeto_dispersion_inputfile(disp_filename,wavelengths_tofit,pix_fitted,sigma_fitted)
-
-
 def DisplayDispersionSolution(SpectrumY,disp_filename,comm_pipe=None):
     """ This keeps a window open with the plot of the latest dispersion solution.
     IMP: Needs to be run as a Process, and comminicated via Pipe """
     fig_main = plt.figure()
     ax = fig_main.add_subplot(111)
     ax.set_title('Press r to refresh the plot.')
+    # Degree 6 polynomial fit, which is only updated with the lines added or removed in the file.
+    # This is the same weighted least squares polynomial as the c6 fit of get_fitted_function.
+    IncFit = IncrementalPolynomialFit(6,domain=(0,len(SpectrumY)-1))
+    def refit():
+        disp_table = read_dispersion_inputfile(disp_filename)
+        wavelengths_inp,pixels_inp,sigma_inp = disp_table[1]
+        Nadded, Nremoved = IncFit.update(pixels_inp,wavelengths_inp,sigma_inp)
+        logger.debug('Updated the fit with %d new and %d removed lines',Nadded,Nremoved)
+        # Under determined fit is left to get_fitted_function as before
+        disp_func = IncFit if len(IncFit) > IncFit.deg else None
+        return update_main_figure(fig_main,SpectrumY,disp_table,disp_func=disp_func)
     # Define the function to run while key is pressed
-    disp_func_holder = [update_main_figure(fig_main,SpectrumY,read_dispersion_inputfile(disp_filename))]
+    disp_func_holder = [refit()]
     def on_key(event):
         if event.key == 'r' :
-            disp_func_holder[0] = update_main_figure(fig_main,SpectrumY,read_dispersion_inputfile(disp_filename))
+            disp_func_holder[0] = refit()
     cid = fig_main.canvas.mpl_connect('key_press_event', on_key)
     plt.show()
     disp_func = disp_func_holder[0]
@@ -379,14 +203,16 @@ def DisplayDispersionSolution(SpectrumY,disp_filename,comm_pipe=None):
         comm_pipe.send(tuple((None, disp_filename)))
     
 
-def StartInteractiveLineSelectionSubrocess(SpectrumY,disp_filename):
-    """ Starts a subprocess for Adding lines interactively """
+def StartInteractiveLineSelectionSubrocess(SpectrumY,disp_filename,IncFits=None):
+    """ Starts a subprocess for Adding lines interactively 
+    IncFits (optional): Dictionary of the IncrementalPolynomialFit of each degree from the previous calls with the same
+                        SpectrumY and disp_filename, to be updated with only the lines changed in disp_filename """
     parent_conn, child_conn = Pipe()
     fp = Process(target=AddlinesbyInteractiveSelection,args=(SpectrumY,disp_filename,child_conn))
     fp.start()
     Clientmsg = '>>'
     wavelengths_tofit, (wavelengths_inp,pixels_inp,sigma_inp) = read_dispersion_inputfile(disp_filename)
-    FullWavelengthArray = np.array(wavelengths_tofit + wavelengths_inp)
+    FullWavelengthArray = np.sort(np.array(wavelengths_tofit + wavelengths_inp))
 
     # if atlest 2 wavelegnths are alredy calibrated, we can predict default value form the line list
     disp_func = None
@@ -399,9 +225,12 @@ def StartInteractiveLineSelectionSubrocess(SpectrumY,disp_filename):
             pdeg = '6'
         else:
             pdeg = '3'
-        disp_func = get_fitted_function(pixels=pixels_inp,
-                                        wavel=wavelengths_inp,
-                                        sigma=sigma_inp, method='c'+pdeg)
+        if IncFits is None:
+            IncFits = {}
+        if int(pdeg) not in IncFits:
+            IncFits[int(pdeg)] = IncrementalPolynomialFit(int(pdeg),domain=(0,len(SpectrumY)-1))
+        disp_func = IncFits[int(pdeg)]
+        disp_func.update(pixels_inp,wavelengths_inp,sigma_inp)
 
     while Clientmsg:
         Clientmsg = parent_conn.recv()
@@ -415,7 +244,7 @@ def StartInteractiveLineSelectionSubrocess(SpectrumY,disp_filename):
                 pass
             else:
                 if disp_func is not None:
-                    DefaultValue = str(FullWavelengthArray[NearestIndex(FullWavelengthArray,disp_func(FittedValue))])
+                    DefaultValue = str(FullWavelengthArray[NearestIndices(FullWavelengthArray,[disp_func(FittedValue)])[0]])
                     PromptMsg = PromptMsg+'(Default:{0}):'.format(DefaultValue)
                     
             tcflush(sys.stdin, TCIOFLUSH) # Flush anythin in terminal buffer
@@ -438,9 +267,11 @@ def InteractiveDispersionSolution(SpectrumY,disp_filename=None):
 
     wavelengths_tofit, (wavelengths_inp,pixels_inp,sigma_inp) = read_dispersion_inputfile(disp_filename)
 
+    # Fits of the lines in disp_filename in this session, which are updated with the edits in later fit windows
+    IncFits = {}
     if len(wavelengths_inp) < 2:
         print('Not even two starting points to intiailise; Starting Interactive fit Window')
-        StartInteractiveLineSelectionSubrocess(SpectrumY,disp_filename)
+        StartInteractiveLineSelectionSubrocess(SpectrumY,disp_filename,IncFits=IncFits)
     # Plot main figure
     Mainparent_conn, Mainchild_conn = Pipe()
     Mp = Process(target=DisplayDispersionSolution,args=(SpectrumY,disp_filename,Mainchild_conn))
@@ -459,7 +290,7 @@ def InteractiveDispersionSolution(SpectrumY,disp_filename=None):
             DoneWithFitting = True
         elif usr_input == 'f':
             print('Starting Interactive fit Window')
-            StartInteractiveLineSelectionSubrocess(SpectrumY,disp_filename)
+            StartInteractiveLineSelectionSubrocess(SpectrumY,disp_filename,IncFits=IncFits)
         elif usr_input == 'l':
             print('Fitting lines which do not have pixel coordinates in the text file.')
             TryToFitNewLinesinSpectrum(SpectrumY,disp_filename)
@@ -481,43 +312,22 @@ def parse_args(raw_args=None):
                         help="File containing the table of Wavelengths, Pixels, Error")
     parser.add_argument('OutputWavlFile', type=str,
                         help="Output filename to write calibrated Wavelength array")
+    parser.add_argument('--loglevel', type=str, default='INFO', choices=['DEBUG','INFO','WARNING','ERROR'],
+                        help="Level of the diagnostic messages to show. DEBUG shows the details of every fit. Default is INFO")
     args = parser.parse_args(raw_args)
     return args
 
-def load_fluxdata(filename,fits_ext=0):
-    """ Loads the flux data """
-    if os.path.splitext(filename)[-1] == '.npy':
-        return np.load(filename)
-    elif os.path.splitext(filename)[-1] == '.fits':
-        return fits.getdata(filename,ext=fits_ext)
-    else:
-        print('Unknown input file extension for file : {0}'.format(filename))
-        sys.exit(1)
-
-def write_wavldata(output_filename,data,fits_headerDic=None):
-    """ Writes the wavl solution data """
-    if os.path.splitext(output_filename)[-1] == '.npy':
-        np.save(output_filename,data)
-    elif os.path.splitext(output_filename)[-1] == '.fits':
-        hdu = fits.PrimaryHDU(data)
-        if fits_headerDic is not None:
-            for key,value in fits_headerDic.items():
-                hdu.header[key] = value
-        hdu.writeto(output_filename)
-    else:
-        print('Unknown output file extension for file : {0}'.format(filename))
-        sys.exit(1)
-    return output_filename
-
 def main(raw_args=None):
     """ Standalone Interactive Line Identify Tool """
     args = parse_args(raw_args)
+    setup_logging(args.loglevel)
     extbracket = re.search('\[(\d+)\]$', os.path.splitext(args.SpectrumFluxFile)[-1])
     if extbracket is None:
         SpectrumY = load_fluxdata(args.SpectrumFluxFile)
     else:
         order = int(extbracket.group(1))
-        SpectrumY = load_fluxdata(args.SpectrumFluxFile[:-len('[{0}]'.format(order))])[order]
+        with load_fluxdata(args.SpectrumFluxFile[:-len('[{0}]'.format(order))],lazy=True) as FluxData:
+            SpectrumY = FluxData[order]
 
     disp_fname = args.DispTableFile
     Output_fname = args.OutputWavlFile
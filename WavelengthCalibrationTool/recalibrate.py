@@ -1,24 +1,25 @@
 #!/usr/bin/env python
 """ This is a non-interactive tool to re-calibrate wavelength solution based on
 an existing calibrated solution of the same lamp in same instrument."""
+import os
 import sys
 import argparse
 import numpy as np
-import scipy.interpolate as interp
-import scipy.optimize as optimize
 import logging
-from scipy.constants import speed_of_light
-from .utils import calculate_cov_matrix_fromscipylsq
-try:
-    from skimage import registration
-except ImportError:
-    logging.warning('Failed to import scikit-image module for fast phase_cross_correlation. Fast phase_cross_correlation function will not work without that.')
+from multiprocessing import Pool
+from .utils import calculate_cov_matrix_fromscipylsq, StageTimer, setup_logging, write_timing_records, phase_cross_correlation_1d
+from .utils import speed_of_light
+from .dispersion import load_fluxdata, write_wavldata
 
 try:
     from functools32 import partial
 except ModuleNotFoundError:
     from functools import partial
 
+logger = logging.getLogger(__name__)
+
+# Default initial values of the pixel shift, velocity shift and wavelength shift parameters of the l* methods
+LEGENDRE_INITIAL_PARAMS = {'v':1e-6,'p':1e-6,'w':1e-3}
 
 def scale_interval_m1top1(x,a,b,inverse_scale=False):
     """ Scales input x in interval a to b to the range -1 to 1 """
@@ -61,6 +62,96 @@ def TransformLegendreCoeffs(LC,PVWdic,normP=False):
 
     return T_LC
 
+def TransformLegendreCoeffsDerivatives(LC,PVWdic,paramstring,normP=False):
+    """ Returns the list of derivatives of the transformed Legendre coefficents T_LC (see TransformLegendreCoeffs)
+    with respect to each of the parameters in paramstring (subset of 'p','v','w') """
+    ldeg = len(LC)-1
+    e0 = np.zeros(ldeg+1)
+    e0[0] = 1
+    x = LC + PVWdic['w']*e0  # Wavl shift
+    TM_pix = np.array(LCTransformMatrixP(PVWdic['p'],deg=ldeg))
+    dTM_pix = np.array(LCTransformMatrixP(1,deg=ldeg)) - np.identity(ldeg+1)  # d TM_pix/dp
+    u = np.dot(TM_pix,x)  # Pixel shift
+    x_norm = np.linalg.norm(x)
+    u_norm = np.linalg.norm(u)
+    vfactor = 1+PVWdic['v']
+
+    def d_pixshifted(dx,du):
+        """ Returns the derivative of the pixel shifted (and optionally normalised) coeffs given derivatives of x and u """
+        if normP:
+            return du*x_norm/u_norm + u*np.dot(x,dx)/(x_norm*u_norm) - u*x_norm*np.dot(u,du)/u_norm**3
+        else:
+            return du
+
+    derivatives = []
+    for s in paramstring:
+        if s == 'v':
+            derivatives.append(u*x_norm/u_norm if normP else u)
+        elif s == 'w':
+            derivatives.append(vfactor*d_pixshifted(e0,np.dot(TM_pix,e0)))
+        elif s == 'p':
+            derivatives.append(vfactor*d_pixshifted(np.zeros(ldeg+1),np.dot(dTM_pix,x)))
+        else:
+            raise NotImplementedError('Unknown Legendre transform parameter {0}'.format(s))
+    return derivatives
+
+class ReferenceSpline(object):
+    """ Cubic B-spline representation of the reference spectrum flux at coordinates X.
+    Since the interpolating spline is linear in the data, the spline of the scaled flux
+    is just the scaled spline. Hence this is computed only once and reused in every
+    residual evaluation of the fit. """
+    def __init__(self,X,Flux):
+        import scipy.interpolate as interp
+        self.X = X
+        self.tck = interp.splrep(X, Flux)
+        self._splev = interp.splev
+
+    def __call__(self,Xnew,scale=1.,ext=0,der=0):
+        """ Returns the spline (or its derivative of order `der`) evaluated at Xnew, multiplied by scale """
+        return scale*self._splev(Xnew, self.tck, der=der, ext=ext)
+
+def get_reference_spline(X,Flux,RefCache=None,key=None):
+    """ Returns the ReferenceSpline of Flux at X.
+    If a dictionary RefCache is provided, the spline stored in it under `key` is reused,
+    else a new spline is created and stored in it. """
+    if RefCache is None:
+        return ReferenceSpline(X,Flux)
+    if key not in RefCache:
+        RefCache[key] = ReferenceSpline(X,Flux)
+    return RefCache[key]
+
+def get_reference_legendre_coeffs(RefWavl,ldeg,RefCache=None):
+    """ Returns the Legendre coefficents of degree ldeg fitted to RefWavl on a -1 to 1 pixel grid.
+    If a dictionary RefCache is provided, the coefficents stored in it are reused. """
+    key = ('LCRef',ldeg)
+    if (RefCache is not None) and (key in RefCache):
+        return RefCache[key]
+    grid = np.linspace(-1,1,len(RefWavl))
+    LCRef = np.polynomial.legendre.legfit(grid,RefWavl,deg=ldeg)
+    if RefCache is not None:
+        RefCache[key] = LCRef
+    return LCRef
+
+def prepare_reference_cache(RefSpectrum,method='p3',scalepixel=True):
+    """ Returns a dictionary with all the reference spectrum quantities (splines, Legendre coefficents)
+    ReCalibrateDispersionSolution needs for the input method. This can be passed as `RefCache` to
+    repeated calls with the same RefSpectrum to avoid recomputing them. """
+    RefCache = {}
+    RefFlux = RefSpectrum[:,1]
+    RefWavl = RefSpectrum[:,0]
+    if method[0] in ['p','c']:
+        if scalepixel:
+            scaledWavl = scale_interval_m1top1(RefWavl,a=min(RefWavl),b=max(RefWavl))
+        else:
+            scaledWavl = RefWavl
+        get_reference_spline(scaledWavl,RefFlux,RefCache=RefCache,key=('scaled',scalepixel))
+    else:
+        get_reference_spline(RefWavl,RefFlux,RefCache=RefCache,key=('wavl',))
+    if method[0] == 'l':
+        ldeg = int(''.join([s for s in  method[1:] if s.isdigit()]))
+        get_reference_legendre_coeffs(RefWavl,ldeg,RefCache=RefCache)
+    return RefCache
+
 def update_coeffs_with_defaults(coeffs,defaultParamDic=None):
     """ Returns the updated coeffs list with the values in defaultParamDic """
     if defaultParamDic:
@@ -76,7 +167,7 @@ def update_coeffs_with_defaults(coeffs,defaultParamDic=None):
                     except AttributeError: # if coeffs is a numpy array or tuple
                         coeffs = np.concatenate([coeffs, [defaultParamDic[key]]])
                 else:
-                    print('Missing number of coefficents ({0}) to add/insert default coeff {1} from {2}'.format(len(coeffs),key,defaultParamDic))
+                    logger.warning('Missing number of coefficents (%d) to add/insert default coeff %s from %s', len(coeffs), key, defaultParamDic)
                     raise
     return coeffs
     
@@ -86,6 +177,7 @@ def transformed_spectrum(FluxSpec, *params, **kwargs):
            method: 'p' for normal polynomial
                    'c' for chebyshev  (default)
            WavlCoords : Coordinates to fit the transformation; (default: pixel coords)
+           RefSpline : Precomputed ReferenceSpline of FluxSpec at WavlCoords (optional)
     """
     
     if 'WavlCoords' in kwargs:
@@ -103,8 +195,10 @@ def transformed_spectrum(FluxSpec, *params, **kwargs):
     else:
         defaultParamDic = None
 
-    # First paramete is the flux scaling
-    scaledFlux = FluxSpec*params[0]
+    if 'RefSpline' in kwargs:
+        RefSpline = kwargs['RefSpline']
+    else:
+        RefSpline = None
 
     # Remaing parameters for defining the ploynomial drift of coordinates
     if len(params[1:]) == 1:  # Zero offset coeff only
@@ -125,23 +219,76 @@ def transformed_spectrum(FluxSpec, *params, **kwargs):
     elif method == 'x': # (w + w v/c +P dw/dp) combined shift
         Xtransformed = Xoriginal*(1+coeffs[0]/speed_of_light) + coeffs[1]*np.gradient(Xoriginal)
     else:
-        print('method {0} is not implemented'.format(method))
+        logger.error('method %s is not implemented', method)
         return None
         
     # interpolate the original spectrum to new coordinates
-    tck = interp.splrep(Xoriginal, scaledFlux)
-    return interp.splev(Xtransformed, tck,ext=3)
+    # First paramete is the flux scaling
+    if RefSpline is None:
+        RefSpline = ReferenceSpline(Xoriginal, FluxSpec)
+    return RefSpline(Xtransformed, scale=params[0], ext=3)
+
+
+def transformed_spectrum_jacobian(FluxSpec, *params, **kwargs):
+    """ Returns the analytic Jacobian (N,len(params)) of transformed_spectrum with respect to params.
+    Takes the same **kwargs as transformed_spectrum.
+    d/dscale = S(X'), d/dc_k = scale * S'(X') * dX'/dc_k , where S is the reference spline and X' the transformed coordinates
+    """
+    if 'WavlCoords' in kwargs:
+        Xoriginal = kwargs['WavlCoords']
+    else:
+        Xoriginal = np.arange(len(FluxSpec))
+
+    method = kwargs.get('method','c')
+    defaultParamDic = kwargs.get('defaultParamDic',None)
+    RefSpline = kwargs.get('RefSpline',None)
+
+    if len(params[1:]) == 1:  # Zero offset coeff only
+        coeffs =  params[1:] + (1,)  # Add fixed 1 slope
+    else:   
+        coeffs =  params[1:]
+    if defaultParamDic:
+        coeffs = update_coeffs_with_defaults(coeffs,defaultParamDic)
+
+    Nparams = len(params[1:])
+    if method == 'p':
+        Xtransformed = np.polynomial.polynomial.polyval(Xoriginal, coeffs)
+        dX = np.polynomial.polynomial.polyvander(Xoriginal, Nparams-1)
+    elif method == 'c':
+        Xtransformed = np.polynomial.chebyshev.chebval(Xoriginal, coeffs)
+        dX = np.polynomial.chebyshev.chebvander(Xoriginal, Nparams-1)
+    elif method == 'v':
+        Xtransformed = Xoriginal*(1+coeffs[0]/speed_of_light)
+        dX = (Xoriginal/speed_of_light)[:,np.newaxis]
+    elif method == 'x':
+        Xtransformed = Xoriginal*(1+coeffs[0]/speed_of_light) + coeffs[1]*np.gradient(Xoriginal)
+        dX = np.column_stack([Xoriginal/speed_of_light, np.gradient(Xoriginal)])[:,:Nparams]
+    else:
+        logger.error('method %s is not implemented', method)
+        return None
+
+    if defaultParamDic:
+        # Coefficents overridden by the defaults do not depend on the parameters
+        for key in defaultParamDic:
+            if key < Nparams:
+                dX[:,key] = 0
+
+    if RefSpline is None:
+        RefSpline = ReferenceSpline(Xoriginal, FluxSpec)
+    dSpline = RefSpline(Xtransformed, scale=params[0], der=1)
+    # transformed_spectrum uses constant extrapolation (ext=3) outside the reference coordinates
+    dSpline[(Xtransformed < np.min(Xoriginal)) | (Xtransformed > np.max(Xoriginal))] = 0
+    return np.column_stack([RefSpline(Xtransformed, ext=3), dSpline[:,np.newaxis]*dX])
 
 
-def errorfunc_tominimise(params,method='l',Reg=0,RefSpectrum=None,DataToFit=None,sigma=None,defaultParamDic=None,**kwargs ):
+def errorfunc_tominimise(params,method='l',Reg=0,RefSpectrum=None,DataToFit=None,sigma=None,defaultParamDic=None,RefSpline=None,**kwargs ):
     """ Error function to minimise to fit model.
     Currently implemented for only the regularised fitting of Legendre coefficent transform
     Reg is the Regularisation coefficent for LASSO regularisation.
     defaultParamDic: is the dictionary of the deafult values for all the parameters which can include parameters not being fitted.
-                      For example: for method=l , defaultParamDic = {'v':0,'p':0,'w':0}"""
+                      For example: for method=l , defaultParamDic = {'v':0,'p':0,'w':0}
+    RefSpline: Precomputed ReferenceSpline of RefSpectrum at WavlCoords (optional)"""
     
-    # First paramete is the flux scaling
-    scaledFlux = RefSpectrum*params[0]
     if method == 'l':
         grid = np.linspace(-1,1,len(RefSpectrum))
         if 'WavlCoords' in kwargs:
@@ -170,19 +317,63 @@ def errorfunc_tominimise(params,method='l',Reg=0,RefSpectrum=None,DataToFit=None
 
         Xtransformed = np.polynomial.legendre.legval(grid,LCnew) 
     else:
-        print('method {0} is not implemented'.format(method))
+        logger.error('method %s is not implemented', method)
         return None
 
     # interpolate the original spectrum to new coordinates
-    tck = interp.splrep(Xoriginal, scaledFlux)
-    PredictedSpectrum = interp.splev(Xtransformed, tck)
+    # First paramete is the flux scaling
+    if RefSpline is None:
+        RefSpline = ReferenceSpline(Xoriginal, RefSpectrum)
+    PredictedSpectrum = RefSpline(Xtransformed, scale=params[0])
     if sigma is None:
         sigma=1
     return  np.concatenate(((PredictedSpectrum-DataToFit)/sigma,np.sqrt(Reg*np.abs(params[1:]))))
 
     
 
-def ReCalibrateDispersionSolution(SpectrumY,RefSpectrum,method='p3',initial_guess=None,sigma=None,cov=False,Reg=0,defaultParamDic=None,scalepixel=True):
+def errorfunc_jacobian(params,method='l',Reg=0,RefSpectrum=None,DataToFit=None,sigma=None,defaultParamDic=None,RefSpline=None,**kwargs ):
+    """ Returns the analytic Jacobian of errorfunc_tominimise with respect to params.
+    Takes the same arguments as errorfunc_tominimise. """
+    if method == 'l':
+        grid = np.linspace(-1,1,len(RefSpectrum))
+        Xoriginal = kwargs.get('WavlCoords',None)
+        LCRef = kwargs['LCRef']
+        if Xoriginal is None:
+            Xoriginal = np.polynomial.legendre.legval(grid,LCRef) 
+        paramstring = kwargs['paramstofit']
+        if defaultParamDic is None:
+            PVWdic = {'v':0,'p':0,'w':0}
+        else:
+            PVWdic = defaultParamDic
+        for i,s in enumerate(paramstring):
+            PVWdic[s] = params[i+1]
+
+        normP = False
+        if ('p' in paramstring) and ('v' in paramstring):
+            normP = True  # Break degeneracy with v by normalising pixel shift
+        LCnew = TransformLegendreCoeffs(LCRef,PVWdic,normP=normP)
+        Xtransformed = np.polynomial.legendre.legval(grid,LCnew) 
+        dX = np.column_stack([np.polynomial.legendre.legval(grid,dLC) for dLC in 
+                              TransformLegendreCoeffsDerivatives(LCRef,PVWdic,paramstring,normP=normP)])
+    else:
+        logger.error('method %s is not implemented', method)
+        return None
+
+    if RefSpline is None:
+        RefSpline = ReferenceSpline(Xoriginal, RefSpectrum)
+    if sigma is None:
+        sigma=1
+    jac_data = np.column_stack([RefSpline(Xtransformed), RefSpline(Xtransformed, scale=params[0], der=1)[:,np.newaxis]*dX])
+    jac_data = jac_data/np.reshape(sigma,(-1,1)) if np.ndim(sigma) else jac_data/sigma
+
+    # Jacobian of the LASSO regularisation terms sqrt(Reg*|p|)
+    absp = np.abs(params[1:])
+    jac_reg = np.zeros((len(params)-1,len(params)))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        jac_reg[:,1:] = np.diag(np.where(absp > 0, np.sqrt(Reg)*np.sign(params[1:])/(2*np.sqrt(absp)), 0))
+    return np.concatenate((jac_data,jac_reg))
+
+def ReCalibrateDispersionSolution(SpectrumY,RefSpectrum,method='p3',initial_guess=None,sigma=None,cov=False,Reg=0,defaultParamDic=None,scalepixel=True,RefCache=None,analytic_jac=True,timer=None,auto_init=True):
     """ Recalibrate the dispertion solution of SpectrumY using 
     RefSpectrum by fitting the relative drift using the input method.
     Input:
@@ -192,9 +383,18 @@ def ReCalibrateDispersionSolution(SpectrumY,RefSpectrum,method='p3',initial_gues
        initial_guess: (list, optional) Optional initial guess of the coeffients for the distortion model
        sigma: See sigma arg of scipy.optimize.curve_fit ; it is the inverse weights for residuals
        cov: (bool, default False) Set cov=True to return an estimate of the covarience matrix of parameters 
+            (for p0 and c0, the row and column of the fixed slope 1 coeffient are nan)
        Reg: Regularisation parameter for LASSO (Currently implemented only for multi parameter Legendre polynomials) 
        defaultParamDic: Default values for parameters in a multi parameter model. Example for l* methods. 
        scalepixel: (bool, default True) scale input coordinates to -1 to 1, NOTE: Currently this scaling done only for method = p* and c*.
+       RefCache: (dict, optional) Cache of the precomputed reference quantities of RefSpectrum (see prepare_reference_cache).
+                   Pass the same dictionary in repeated calls with the same RefSpectrum to reuse them instead of recomputing.
+       analytic_jac: (bool, default True) Use the analytic Jacobian of the model in the optimizer instead of finite differences.
+                     (Not used for the l* methods with more than one shift parameter, which are nearly degenerate)
+       timer: (StageTimer, optional) To record the wall time of the fit and the number of function and jacobian evaluations.
+       auto_init: (bool, default True) If initial_guess is not provided, seed the shift parameters of the method from the 
+                  cross correlation of SpectrumY with the reference (see crosscorrelation_initial_guess).
+                  Else the fixed default initial guesses of the method are used.
       Available methods: 
                pN : Fits a Nth order polynomial distortion  
                cN : Fits a Nth order Chebyshev polynomial distortion 
@@ -212,6 +412,12 @@ def ReCalibrateDispersionSolution(SpectrumY,RefSpectrum,method='p3',initial_gues
         fitted_drift : the fitted calibration drift coeffients 
                     (IMP: These coeffs is for the method and scaling done inside this function)
     """
+    import scipy.optimize as optimize
+    timer = StageTimer() if timer is None else timer
+    if (initial_guess is None) and auto_init:
+        with timer.stage('initial_guess'):
+            initial_guess = crosscorrelation_initial_guess(SpectrumY,RefSpectrum,method,scalepixel=scalepixel)
+    timer.start('drift_fit')
     RefFlux = RefSpectrum[:,1]
     RefWavl = RefSpectrum[:,0]
 
@@ -221,6 +427,9 @@ def ReCalibrateDispersionSolution(SpectrumY,RefSpectrum,method='p3',initial_gues
             scaledWavl = scale_interval_m1top1(RefWavl,a=min(RefWavl),b=max(RefWavl))
         else:
             scaledWavl = RefWavl
+        RefSpline = get_reference_spline(scaledWavl,RefFlux,RefCache=RefCache,key=('scaled',scalepixel))
+    else:
+        RefSpline = get_reference_spline(RefWavl,RefFlux,RefCache=RefCache,key=('wavl',))
 
     if (method[0] == 'p') and method[1:].isdigit():
         # Use polynomial of p* degree.
@@ -233,10 +442,14 @@ def ReCalibrateDispersionSolution(SpectrumY,RefSpectrum,method='p3',initial_gues
             p0 = [1,0,1]+[0]*(deg-1)
         else:
             p0 = [1,0]
-        poly_transformedSpectofit = partial(transformed_spectrum,method='p',WavlCoords=scaledWavl,defaultParamDic=defaultParamDic)
-        popt, pcov = optimize.curve_fit(poly_transformedSpectofit, RefFlux, SpectrumY, p0=p0,sigma=sigma)
-        if deg < 1: # Append slope 1 coeff
+        poly_transformedSpectofit = partial(transformed_spectrum,method='p',WavlCoords=scaledWavl,RefSpline=RefSpline,defaultParamDic=defaultParamDic)
+        poly_jac = partial(transformed_spectrum_jacobian,method='p',WavlCoords=scaledWavl,RefSpline=RefSpline,defaultParamDic=defaultParamDic)
+        popt, pcov, infodict, _, _ = optimize.curve_fit(poly_transformedSpectofit, RefFlux, SpectrumY, p0=p0,sigma=sigma,
+                                                        jac=poly_jac if analytic_jac else None, full_output=True)
+        timer.count('nfev',infodict['nfev'])
+        if deg < 1: # Append slope 1 coeff, which is fixed (NaN covariance)
             popt = np.concatenate([popt, [1]])
+            pcov = np.pad(pcov,((0,1),(0,1)),constant_values=np.nan)
 
         # Overide any default params
         coeffs = popt[1:]
@@ -258,10 +471,14 @@ def ReCalibrateDispersionSolution(SpectrumY,RefSpectrum,method='p3',initial_gues
             p0 = [1,0,1]+[0]*(deg-1)
         else:
             p0 = [1,0]
-        cheb_transformedSpectofit = partial(transformed_spectrum,method='c',WavlCoords=scaledWavl,defaultParamDic=defaultParamDic)
-        popt, pcov = optimize.curve_fit(cheb_transformedSpectofit, RefFlux, SpectrumY, p0=p0,sigma=sigma)
-        if deg < 1: # Append slope 1 coeff
+        cheb_transformedSpectofit = partial(transformed_spectrum,method='c',WavlCoords=scaledWavl,RefSpline=RefSpline,defaultParamDic=defaultParamDic)
+        cheb_jac = partial(transformed_spectrum_jacobian,method='c',WavlCoords=scaledWavl,RefSpline=RefSpline,defaultParamDic=defaultParamDic)
+        popt, pcov, infodict, _, _ = optimize.curve_fit(cheb_transformedSpectofit, RefFlux, SpectrumY, p0=p0,sigma=sigma,
+                                                        jac=cheb_jac if analytic_jac else None, full_output=True)
+        timer.count('nfev',infodict['nfev'])
+        if deg < 1: # Append slope 1 coeff, which is fixed (NaN covariance)
             popt = np.concatenate([popt, [1]])
+            pcov = np.pad(pcov,((0,1),(0,1)),constant_values=np.nan)
 
         # Overide any default params
         coeffs = popt[1:]
@@ -279,8 +496,11 @@ def ReCalibrateDispersionSolution(SpectrumY,RefSpectrum,method='p3',initial_gues
             p0 = initial_guess
         else:
             p0 = [1,100]
-        vel_transformedSpectofit = partial(transformed_spectrum,method='v',WavlCoords=RefWavl,defaultParamDic=defaultParamDic)
-        popt, pcov = optimize.curve_fit(vel_transformedSpectofit, RefFlux, SpectrumY, p0=p0,sigma=sigma)
+        vel_transformedSpectofit = partial(transformed_spectrum,method='v',WavlCoords=RefWavl,RefSpline=RefSpline,defaultParamDic=defaultParamDic)
+        vel_jac = partial(transformed_spectrum_jacobian,method='v',WavlCoords=RefWavl,RefSpline=RefSpline,defaultParamDic=defaultParamDic)
+        popt, pcov, infodict, _, _ = optimize.curve_fit(vel_transformedSpectofit, RefFlux, SpectrumY, p0=p0,sigma=sigma,
+                                                        jac=vel_jac if analytic_jac else None, full_output=True)
+        timer.count('nfev',infodict['nfev'])
         # Now we shall use the transformation obtained for scaled Ref Wavl coordinates
         # to transform the calibrated wavelength array.
         wavl_sln = RefWavl *(1+ popt[1]/speed_of_light)
@@ -292,8 +512,11 @@ def ReCalibrateDispersionSolution(SpectrumY,RefSpectrum,method='p3',initial_gues
             p0 = initial_guess
         else:
             p0 = [1,100,0]
-        velp_transformedSpectofit = partial(transformed_spectrum,method='x',WavlCoords=RefWavl,defaultParamDic=defaultParamDic)
-        popt, pcov = optimize.curve_fit(velp_transformedSpectofit, RefFlux, SpectrumY, p0=p0,sigma=sigma)
+        velp_transformedSpectofit = partial(transformed_spectrum,method='x',WavlCoords=RefWavl,RefSpline=RefSpline,defaultParamDic=defaultParamDic)
+        velp_jac = partial(transformed_spectrum_jacobian,method='x',WavlCoords=RefWavl,RefSpline=RefSpline,defaultParamDic=defaultParamDic)
+        popt, pcov, infodict, _, _ = optimize.curve_fit(velp_transformedSpectofit, RefFlux, SpectrumY, p0=p0,sigma=sigma,
+                                                        jac=velp_jac if analytic_jac else None, full_output=True)
+        timer.count('nfev',infodict['nfev'])
         # Now we shall use the transformation obtained for scaled Ref Wavl coordinates
         # to transform the calibrated wavelength array.
         wavl_sln = RefWavl *(1+ popt[1]/speed_of_light) + popt[2]*np.gradient(RefWavl)
@@ -312,22 +535,30 @@ def ReCalibrateDispersionSolution(SpectrumY,RefSpectrum,method='p3',initial_gues
 
         # Legendre coefficents for the polynomial
         grid = np.linspace(-1,1,len(RefWavl))
-        LCRef = np.polynomial.legendre.legfit(grid,RefWavl,deg=ldeg)
+        LCRef = get_reference_legendre_coeffs(RefWavl,ldeg,RefCache=RefCache)
         
-        Initp={'v':1e-6,'p':1e-6,'w':1e-3}
         # Initial estimate of the parameters to fit  [0 for each parameter to fit]
         if initial_guess is not None:
             p0 = initial_guess
         else:
-            p0 = [1]+[Initp[s] for s in paramstring]  # 1 is for scaling, rest are the parameters
+            p0 = [1]+[LEGENDRE_INITIAL_PARAMS[s] for s in paramstring]  # 1 is for scaling, rest are the parameters
         x_scaledic = {'v':1e-7,'p':1e-6,'w':1e-3}  # Approximate scales of the parameters
         x_scale = [1.] + [x_scaledic[s] for s in paramstring]  # 1 is for scaling, rest are the parameters
         l_errorfunc_tominimise = partial(errorfunc_tominimise,method='l',Reg=Reg,paramstofit=paramstring,
                                          WavlCoords=RefWavl,RefSpectrum=RefFlux,DataToFit=SpectrumY,sigma=sigma,
-                                         LCRef=LCRef,defaultParamDic=PVWdic) 
-        fitoutput = optimize.least_squares(l_errorfunc_tominimise,p0,x_scale=x_scale,ftol=None,xtol=1e-10)
+                                         LCRef=LCRef,defaultParamDic=PVWdic,RefSpline=RefSpline) 
+        l_jac = partial(errorfunc_jacobian,method='l',Reg=Reg,paramstofit=paramstring,
+                        WavlCoords=RefWavl,RefSpectrum=RefFlux,DataToFit=SpectrumY,sigma=sigma,
+                        LCRef=LCRef,defaultParamDic=PVWdic,RefSpline=RefSpline) 
+        # The shift parameters of the multi parameter models are nearly degenerate. With the exact Jacobian the optimizer
+        # keeps walking along the degenerate valley (till max_nfev) to unphysical shifts, so use finite differences for them.
+        use_l_jac = analytic_jac and (len(paramstring) == 1)
+        fitoutput = optimize.least_squares(l_errorfunc_tominimise,p0,jac=l_jac if use_l_jac else '2-point',
+                                           x_scale=x_scale,ftol=None,xtol=1e-10)
         popt = fitoutput['x'] 
-        print('Fitting {0} terminated in status number {1}'.format(paramstring,fitoutput['status']))
+        timer.count('nfev',fitoutput['nfev'])
+        timer.count('njev',fitoutput['njev'] if fitoutput['njev'] is not None else 0)
+        logger.info('Fitting %s terminated in status number %s', paramstring, fitoutput['status'])
         if cov :
             pcov = calculate_cov_matrix_fromscipylsq(fitoutput)
         # Now we shall use the transformation obtained for scaled Ref Wavl coordinates
@@ -353,41 +584,269 @@ def ReCalibrateDispersionSolution(SpectrumY,RefSpectrum,method='p3',initial_gues
         else:
             wavl_sln = transformed_scaledWavl
 
+    timer.stop('drift_fit')
+    logger.debug('Fitted drift of method %s : %s', method, popt)
     if cov :
         return wavl_sln, popt, pcov
     else:
         return wavl_sln, popt
         
 
+def _recalibrate_one_exposure(SpectrumY_sigma,RefSpectrum,**kwargs):
+    """ Calls ReCalibrateDispersionSolution on a (SpectrumY, sigma) tuple. Used by the process pool in ReCalibrateDispersionSolutionBatch """
+    SpectrumY, sigma = SpectrumY_sigma
+    if kwargs.get('defaultParamDic'):
+        kwargs['defaultParamDic'] = dict(kwargs['defaultParamDic'])  # Each exposure gets its own copy
+    return ReCalibrateDispersionSolution(SpectrumY,RefSpectrum,sigma=sigma,**kwargs)
+
+def ReCalibrateDispersionSolutionBatch(SpectrumY_stack,RefSpectrum,method='p3',initial_guess=None,sigma=None,cov=False,Reg=0,
+                                       defaultParamDic=None,scalepixel=True,analytic_jac=True,auto_init=True,jobs=1):
+    """ Recalibrate the dispertion solution of a stack of exposures against the same RefSpectrum.
+    All the reference spectrum precomputation is done only once and shared by all the exposures.
+    Input:
+       SpectrumY_stack: 2D array (Nexposures, Npixels) of Un-calibrated Spectrum Flux arrays
+       RefSpectrum: Wavelength Calibrated reference spectrum (Flux vs wavelegnth array:(N,2))
+       sigma: (optional) 2D array (Nexposures, Npixels) or a single 1D array for all exposures
+       jobs: (int, default 1) Number of parallel processes to fit the exposures
+       See ReCalibrateDispersionSolution for the rest of the arguments.
+    Returns:
+        wavl_slns : 2D array (Nexposures, Npixels) of output wavelength solutions
+        fitted_drifts : 2D array (Nexposures, Nparams) of fitted calibration drift coeffients
+        pcovs : 3D array (Nexposures, Nparams, Nparams) of covariance matrices (only if cov=True)
+    """
+    SpectrumY_stack = np.atleast_2d(SpectrumY_stack)
+    if (sigma is None) or (np.ndim(sigma) < 2):
+        sigma_stack = [sigma]*len(SpectrumY_stack)
+    else:
+        sigma_stack = sigma
+
+    RefCache = prepare_reference_cache(RefSpectrum,method=method,scalepixel=scalepixel)
+    recalibrate_func = partial(_recalibrate_one_exposure,RefSpectrum=RefSpectrum,method=method,initial_guess=initial_guess,
+                               cov=cov,Reg=Reg,defaultParamDic=defaultParamDic,scalepixel=scalepixel,
+                               RefCache=RefCache,analytic_jac=analytic_jac,auto_init=auto_init)
+    if jobs > 1:
+        pool = Pool(processes=jobs)
+        try:
+            results = pool.map(recalibrate_func, zip(SpectrumY_stack,sigma_stack))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [recalibrate_func(Spec_sigma) for Spec_sigma in zip(SpectrumY_stack,sigma_stack)]
+
+    wavl_slns = np.array([r[0] for r in results])
+    fitted_drifts = np.array([r[1] for r in results])
+    if cov :
+        return wavl_slns, fitted_drifts, np.array([r[2] for r in results])
+    else:
+        return wavl_slns, fitted_drifts
+
 def calculate_pixshift_with_phase_cross_correlation(shifted_spec,reference_spec,upsample_factor=10):
-    """ Returns the pixel shift between `shifted_spec` and `reference_spec` at the resolution of 1/upsample_factor """
-    shift = registration.phase_cross_correlation(reference_spec,shifted_spec,upsample_factor=upsample_factor)[0]
-    if isinstance(shift,np.ndarray): # Support for latest skimage version
-        return shift[0]
+    """ Returns the pixel shift between `shifted_spec` and `reference_spec` at the resolution of 1/upsample_factor 
+    `shifted_spec` can also be a 2D array (Nspectra, Npixels) to return the pixel shifts of all the spectra together """
+    return phase_cross_correlation_1d(reference_spec,shifted_spec,upsample_factor=upsample_factor)
+
+def crosscorrelation_initial_guess(SpectrumY,RefSpectrum,method,scalepixel=True):
+    """ Returns the initial guess of the parameters of `method` for ReCalibrateDispersionSolution.
+    The shift parameter of the method is seeded from the pixel shift between SpectrumY and RefSpectrum found by 
+    cross correlation, and the flux scaling from a linear least squares fit of the shifted reference flux. 
+    For methods with more than one shift parameter, the pixel shift is assigned to only one of them. """
+    RefFlux = RefSpectrum[:,1]
+    RefWavl = RefSpectrum[:,0]
+    # Plain cross correlation (not phase normalised) is less sensitive to the noise in SpectrumY
+    pixshift = -phase_cross_correlation_1d(RefFlux-np.mean(RefFlux),SpectrumY-np.mean(SpectrumY),
+                                           normalization=None)  # SpectrumY(x) ~ RefFlux(x - pixshift)
+    X = np.arange(len(RefFlux))
+    ShiftedRef = np.interp(X-pixshift,X,RefFlux)
+    scale = np.dot(SpectrumY,ShiftedRef)/np.dot(ShiftedRef,ShiftedRef)
+    dWavl = np.gradient(RefWavl)  # Wavelength per pixel
+    logger.debug('Cross correlation pixel shift: %s, flux scale: %s', pixshift, scale)
+
+    if method[0] in ['p','c']:
+        deg = int(method[1:])
+        if scalepixel:
+            dWavl = np.gradient(scale_interval_m1top1(RefWavl,a=min(RefWavl),b=max(RefWavl)))
+        offset = -pixshift*np.mean(dWavl)
+        return [scale,offset,1]+[0]*(deg-1) if deg > 0 else [scale,offset]
+    elif method[0] == 'v':
+        return [scale,-pixshift*speed_of_light*np.median(dWavl/RefWavl)]
+    elif method[0] == 'x':
+        return [scale,100,-pixshift]
+    elif method[0] == 'l':
+        paramstring = [s for s in method[1:] if not s.isdigit()]
+        shifts = {'p':-pixshift*2./(len(RefWavl)-1), 'v':-pixshift*np.median(dWavl/RefWavl), 'w':-pixshift*np.mean(dWavl)}
+        p0 = [scale]+[LEGENDRE_INITIAL_PARAMS[s] for s in paramstring]
+        # Assign the shift to the first available parameter. Pixel shift is normalised when fitted along with 
+        # velocity shift (see TransformLegendreCoeffs), so it is not a good proxy of the pixel shift then.
+        order = 'wvp' if (('p' in paramstring) and ('v' in paramstring)) else 'pvw'
+        for s in order:
+            if s in paramstring:
+                if shifts[s] != 0:
+                    p0[paramstring.index(s)+1] = shifts[s]
+                break
+        return p0
+    else:
+        raise NotImplementedError('Unknown fitting method {0}'.format(method))
+
+def load_reference_spectrum(RefSpectrumFile,RefWavlFile=None,fits_ext=0):
+    """ Loads the reference spectrum as an array of (Wavelength, Flux) pairs.
+    If RefWavlFile is provided, RefSpectrumFile contains only the flux and RefWavlFile the wavelengths.
+    Returns : array of shape (N,2) for a single reference, or (Norders,N,2) for a multi-order reference """
+    if RefWavlFile is None:
+        RefSpectrum = np.asarray(load_fluxdata(RefSpectrumFile,fits_ext=fits_ext))
     else:
-        return shift
+        RefFlux = np.asarray(load_fluxdata(RefSpectrumFile,fits_ext=fits_ext))
+        RefWavl = np.asarray(load_fluxdata(RefWavlFile))
+        if RefFlux.shape != RefWavl.shape:
+            raise ValueError('Shape of reference flux {0} and wavelength {1} arrays do not match'.format(RefFlux.shape,RefWavl.shape))
+        RefSpectrum = np.stack([RefWavl,RefFlux],axis=-1)
+    if (RefSpectrum.ndim not in [2,3]) or (RefSpectrum.shape[-1] != 2):
+        raise ValueError('Reference spectrum should be of shape (N,2) or (Norders,N,2), not {0}'.format(RefSpectrum.shape))
+    return RefSpectrum
+
+def drift_table(orders,fitted_drifts,pcovs):
+    """ Returns the numpy structured array of the fitted drift parameters (PARAMS) and their covariance matrix (COV)
+    of each order (ORDER), to be written as a fits binary table. Covariances of unconstrained parameters are inf/nan """
+    nparams = len(fitted_drifts[0])
+    table = np.zeros(len(orders),dtype=[('ORDER',np.int32),('PARAMS',np.float64,(nparams,)),
+                                        ('COV',np.float64,(nparams,nparams))])
+    table['ORDER'] = orders
+    table['PARAMS'] = fitted_drifts
+    table['COV'] = np.nan
+    for i,pcov in enumerate(pcovs):
+        if pcov is not None:
+            pcov = np.atleast_2d(pcov)
+            table['COV'][i,:pcov.shape[0],:pcov.shape[1]] = pcov
+    return table
+
+def ReCalibrateOrder(order,SpectrumY,SpectrumY_Var,RefSpectrum,RefCache,args):
+    """ Recalibrates the dispersion solution of a single order against its reference spectrum.
+    This is a module level function so that it can be pickled and run in a process pool.
+    RefCache is the prepare_reference_cache output of RefSpectrum if it is shared by all orders, else None to compute it here.
+    Returns : (wavl, fitted_drift, pcov, timing) where fitted_drift are the fitted drift parameters, pcov their covariance
+              matrix, and timing is the StageTimer record of the order.
+    """
+    timer = StageTimer(order=order)
+    logger.info('Recalibrating Order: %s', order)
+    if RefCache is None:
+        with timer.stage('reference_cache'):
+            RefCache = prepare_reference_cache(RefSpectrum,method=args.method)
+    sigma = np.sqrt(SpectrumY_Var) if SpectrumY_Var is not None else None
+    wavl, fitted_drift, pcov = ReCalibrateDispersionSolution(SpectrumY,RefSpectrum,method=args.method,sigma=sigma,cov=True,
+                                                             RefCache=RefCache,timer=timer,auto_init=not args.NoAutoInit)
+    return wavl, fitted_drift, pcov, timer.as_dict()
+
+def _recalibrate_order_star(order_args):
+    """ Unpacks the argument tuple for ReCalibrateOrder to use with Pool.imap """
+    return ReCalibrateOrder(*order_args)
 
 def parse_args(raw_args=None):
     """ Parses the command line input arguments """
     parser = argparse.ArgumentParser(description="Non-Interactive Wavelength Re-Calibration Tool")
     parser.add_argument('SpectrumFluxFile', type=str,
-                        help="File containing the uncalibrated Spectrum Flux array")
+                        help="File (.npy or .fits) containing the uncalibrated Spectrum Flux array, single order or (Norders,Npixels)")
+    parser.add_argument('--fits_ext', type=int, default=0,
+                        help="Extension to load if the input flux file is fits")
+    parser.add_argument('--fits_ext_var', type=int,
+                        help="Extension of the variance array for the input flux fits file (optional)")
     parser.add_argument('RefSpectrumFile', type=str,
-                        help="Reference Spectrum file which is calibrated, containing Flux vs wavelengths for the same pixels")
+                        help="Reference Spectrum file which is calibrated, containing Flux vs wavelengths for the same pixels. "
+                        "Array of shape (Npixels,2) or (Norders,Npixels,2) of (Wavelength, Flux). A single order reference is used for all orders.")
     parser.add_argument('OutputWavlFile', type=str,
-                        help="Output filename to write calibrated Wavelength array")
+                        help="Output filename to write calibrated Wavelength array of all the orders. "
+                        "If it is .fits, the fitted drift parameters and their covariances of all the orders are written "
+                        "in its DRIFT binary table extension")
+    parser.add_argument('--RefWavlFile', type=str,
+                        help="Wavelength solution file of the reference spectrum (eg: output of reidentify). "
+                        "If provided, RefSpectrumFile should contain only the reference flux array of the same shape")
+    parser.add_argument('--ref_fits_ext', type=int, default=0,
+                        help="Extension to load if the RefSpectrumFile is fits")
+    parser.add_argument('--method', type=str, default='p3',
+                        help="Model of the drift to fit (see ReCalibrateDispersionSolution). Eg: p3, c3, v, x, lp6, lpvw6. Default is p3")
+    parser.add_argument('--NoAutoInit', action='store_true',
+                        help="Do not seed the initial guess of the drift from the cross correlation with the reference")
+    parser.add_argument('--orders', type=int, nargs='+',
+                        help="Recalibrate only these orders (0 indexed) of the input flux file. Default is all orders.")
+    parser.add_argument('--jobs', type=int, default=1,
+                        help="Number of parallel processes to use for fitting the orders. Default is 1.")
+    parser.add_argument('--loglevel', type=str, default='INFO', choices=['DEBUG','INFO','WARNING','ERROR'],
+                        help="Level of the diagnostic messages to show. DEBUG shows the details of every fit. Default is INFO")
+    parser.add_argument('--TimingFile', type=str,
+                        help="Append the wall time of the fit and the number of optimizer evaluations of every order "
+                        "to this file as one JSON object per line")
     args = parser.parse_args(raw_args)
     return args
     
 def main(raw_args=None):
-    """ Standalone Interactive Line Identify Tool """
+    """ Standalone Non-Interactive Wavelength Re-Calibration Tool """
     args = parse_args(raw_args)
-    SpectrumY = np.load(args.SpectrumFluxFile)
-    RefSpectrum = np.load(args.RefSpectrumFile)
-    Output_fname = args.OutputWavlFile
-    wavl_sln, fitted_drift = ReCalibrateDispersionSolution(SpectrumY,RefSpectrum,method='p3')
-    np.save(Output_fname,wavl_sln)
-    print('Wavelength solution saved in {0}'.format(Output_fname))
+    setup_logging(args.loglevel)
+
+    # Flux and variance are memory mapped, only the orders being fitted are read from the disk
+    SpectrumY_all = load_fluxdata(args.SpectrumFluxFile,fits_ext=args.fits_ext,lazy=True)
+    if args.fits_ext_var is not None:
+        SpectrumY_Var_all = load_fluxdata(args.SpectrumFluxFile,fits_ext=args.fits_ext_var,lazy=True)
+    else:
+        SpectrumY_Var_all = [None]*len(SpectrumY_all)
+
+    # Memory mapped input files, to be closed at the end
+    FluxFiles = [SpectrumY_all] + ([SpectrumY_Var_all] if args.fits_ext_var is not None else [])
+    try:
+        SingleOrder = len(SpectrumY_all.shape) < 2
+        if SingleOrder:  # If the spectrum is a 1D single order spectrum
+            SpectrumY_all = [SpectrumY_all[:]]  # Pack it into a single element list
+            SpectrumY_Var_all = [SpectrumY_Var_all[:] if args.fits_ext_var is not None else None]
+
+        RefSpectrum_all = load_reference_spectrum(args.RefSpectrumFile,RefWavlFile=args.RefWavlFile,fits_ext=args.ref_fits_ext)
+        orders_tofit = list(args.orders if args.orders is not None else range(len(SpectrumY_all)))
+        timings = []
+        if RefSpectrum_all.ndim == 2:
+            # Same reference for all orders, so precompute the reference quantities only once
+            timer = StageTimer(order='reference')
+            with timer.stage('reference_cache'):
+                RefCache = prepare_reference_cache(RefSpectrum_all,method=args.method)
+            timings.append(timer.as_dict())
+            RefSpectrum_all = [RefSpectrum_all]*len(SpectrumY_all)
+            RefCache_all = [RefCache]*len(SpectrumY_all)
+        elif len(RefSpectrum_all) != len(SpectrumY_all):
+            raise ValueError('Number of orders in reference spectrum ({0}) and input spectrum ({1}) do not match'.format(len(RefSpectrum_all),
+                                                                                                                      len(SpectrumY_all)))
+        else:
+            RefCache_all = [None]*len(SpectrumY_all)
+
+        # Generator, so that each order is loaded only when it is dispatched for fitting
+        order_args = ((order, SpectrumY_all[order], SpectrumY_Var_all[order], RefSpectrum_all[order], RefCache_all[order], args) 
+                      for order in orders_tofit)
+        if args.jobs > 1:
+            pool = Pool(processes=args.jobs)
+            try:
+                # imap returns the results in the order of the input orders
+                results = list(pool.imap(_recalibrate_order_star, order_args))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [ReCalibrateOrder(*oargs) for oargs in order_args]
+        timings.extend(timing for wavl, fitted_drift, pcov, timing in results)
+
+        CoeffDictionary_All = {}
+        CoeffDictionary_All['DRMETHOD'] = (args.method, 'Drift model fitted by recalibrate')
+        CoeffDictionary_All['DRREF'] = (os.path.basename(args.RefSpectrumFile), 'Reference spectrum of the drift')
+        # Binary table instead of header keywords, which cannot fit the covariances of many orders in 8 characters
+        DriftTable = drift_table(orders_tofit,[fitted_drift for wavl, fitted_drift, pcov, timing in results],
+                                 [pcov for wavl, fitted_drift, pcov, timing in results])
+        WavlSolutionArray_All = np.array([wavl for wavl, fitted_drift, pcov, timing in results])
+        if SingleOrder:
+            WavlSolutionArray_All = WavlSolutionArray_All[0]
+        Output_fname = args.OutputWavlFile
+        _ = write_wavldata(Output_fname,WavlSolutionArray_All,fits_headerDic=CoeffDictionary_All,
+                           fits_tables={'DRIFT':DriftTable})
+        logger.info('Wavelength solution saved in %s', Output_fname)
+        if args.TimingFile:
+            write_timing_records(args.TimingFile,timings)
+    finally:
+        for fluxdata in FluxFiles:
+            fluxdata.close()
 
 if __name__ == "__main__":
     main()
@@ -2,14 +2,28 @@
 """ This is a non-interactive tool to re-identify calibration lamp lines from 
 an already identified dispersion file """
 import os
+import re
+import json
+import hashlib
 import argparse
+import logging
+from multiprocessing import Pool
 import numpy as np
-from .iidentify import TryToFitNewLinesinSpectrum, get_fitted_function, read_dispersion_inputfile, load_fluxdata, write_wavldata
-from scipy.constants import speed_of_light
+from .dispersion import FitNewLinesinSpectrum, get_fitted_function, read_dispersion_inputfile, load_fluxdata, write_wavldata
+from .dispersion import dispersion_inputfile_exists, create_dispersion_inputfile, writeto_dispersion_inputfile
+from .utils import fit_echelle_2d_solution, StageTimer, setup_logging, write_timing_records, speed_of_light
+
+logger = logging.getLogger(__name__)
+
+# Options which change the output of an order, and hence invalidate its record in the manifest
+MANIFEST_OPTIONS = ('PixShiftGuess','ModelForDispersion','Global2DModel','EchelleOrderOffset','EchelleOrderDirection',
+                    'SigmaClipMaxIter','MinPeakSNR','PeakMatchTolerance','OutDispTableFile','OutputWavlFile','SavePlots')
 
 def parse_args(raw_args=None):
     """ Parses the command line input arguments """
-    epilog_str=""" Use {0} in the filename if multiple orders are fitted in a single run. """
+    epilog_str=""" Use {0} in the filename if multiple orders are fitted in a single run. 
+    Dispersion tables can also be binary multi-order .npz tables, by using filename of the form table.npz[{0}].
+    A table.npz.lock file exists next to the table only while an order is being written to it. """
     parser = argparse.ArgumentParser(description="Non-Interactive Wavelength Re-Calibration Tool",
                                      epilog=epilog_str)
     parser.add_argument('SpectrumFluxFile', type=str,
@@ -26,140 +40,432 @@ def parse_args(raw_args=None):
                         help="Initial Guess of pixel shift to match the `RefDispTableFile` reference spectrum to the input `SpectrumFluxFile`. Default is 0.")
     parser.add_argument('--OutputWavlFile', type=str,
                         help="Output filename to write calibrated Wavelength solution array")
+    parser.add_argument('--MinPeakSNR', type=float,
+                        help="Detect the lines in the spectrum with a matched filter, and fit only the wavelengths which have a "
+                        "detected line above this signal to noise ratio near their predicted position. Default is to fit all the wavelengths.")
+    parser.add_argument('--PeakMatchTolerance', type=float, default=3.,
+                        help="Maximum distance in pixels of the detected line from the predicted position of the wavelength. Default is 3.")
     parser.add_argument('--ModelForDispersion', type=str,default='l6',
                         help="Model to fit the individual line positions to obtain the full wavelength array dispersion solution")
+    parser.add_argument('--Global2DModel', type=str,
+                        help="Fit a single global 2D dispersion solution m*wavl = f(pixel,order) to all orders together, "
+                        "instead of fitting each order with ModelForDispersion. Of the form xNmM for Legendre polynomial "
+                        "degree N in pixel and M in order (eg: x6m4). Requires --EchelleOrderOffset")
+    parser.add_argument('--EchelleOrderOffset', type=int,
+                        help="Absolute echelle order number m of the order index 0 in the input flux file")
+    parser.add_argument('--EchelleOrderDirection', type=int, default=1, choices=[1,-1],
+                        help="Change in the absolute echelle order number m per order index. Default is 1")
+    parser.add_argument('--BackupDispTable', action='store_true',
+                        help="Keep a .bak backup of an existing OutDispTableFile before updating it")
     parser.add_argument('--SavePlots', action='store_true', 
                         help="Save plots as well of the fitted dispersion solution in the same filename `OutputWavlFile` with .png extension")
     parser.add_argument('--StackOrders', action='store_true', 
                         help="Save a stacked single wavength solution file for all orders")
+    parser.add_argument('--orders', type=int, nargs='+',
+                        help="Fit only these orders (0 indexed) of the input flux file. Default is all orders.")
+    parser.add_argument('--SigmaClipMaxIter', type=int, default=1,
+                        help="Maximum number of iterations of 3 sigma clipping and refitting of the (per order or global 2D) dispersion solution. "
+                        "Iterations stop earlier when no new outliers are rejected. Default is 1.")
+    parser.add_argument('--loglevel', type=str, default='INFO', choices=['DEBUG','INFO','WARNING','ERROR'],
+                        help="Level of the diagnostic messages to show. DEBUG shows the details of every fit. Default is INFO")
+    parser.add_argument('--TimingFile', type=str,
+                        help="Append the wall time of each stage and the number of lines fitted/rejected of every order "
+                        "to this file as one JSON object per line")
+    parser.add_argument('--jobs', type=int, default=1,
+                        help="Number of parallel processes to use for fitting the orders. Default is 1.")
+    parser.add_argument('--Manifest', type=str,
+                        help="JSON file to record the hashes of the inputs (flux, variance, reference table and options) of each order, "
+                        "and its fitted lines and solution. In a rerun with the same manifest, orders with unchanged inputs and outputs "
+                        "are not fitted again, and the outputs of the changed orders are overwritten.")
     args = parser.parse_args(raw_args)
     if args.SavePlots and (args.OutputWavlFile is None):
         parser.error("--SavePlots requires --OutputWavlFile")
     if args.StackOrders and (args.OutputWavlFile is None):
         parser.error("--StackOrders requires --OutputWavlFile")
+    if (args.Global2DModel is not None) and (args.EchelleOrderOffset is None):
+        parser.error("--Global2DModel requires --EchelleOrderOffset")
+    if (args.Global2DModel is not None) and (args.OutputWavlFile is None):
+        parser.error("--Global2DModel requires --OutputWavlFile")
     return args
     
+def plot_dispersion_fit(Output_plot_fname,order,scaled_pixels_inp,wavelengths_inp,wavl,Mask,velocity_residue,SigmaV,model_label):
+    """ Saves the plot of the dispersion solution fit of the order, and its velocity residue """
+    import matplotlib.pyplot as plt
+    fig = plt.figure(figsize=(16,8))
+    ax1 = plt.subplot(211)
+    ax2 = plt.subplot(212, sharex = ax1)
+    ax1.plot(scaled_pixels_inp,wavelengths_inp,'.',color='k',label='Calibration Lines')
+    ax1.plot(np.linspace(-1,1,len(wavl)),wavl,'-',color='orange',label='Dispersion Solution: {0}'.format(model_label))
+    ax1.plot(scaled_pixels_inp[~Mask],wavelengths_inp[~Mask],'x',color='r',label='Outliers')
+    ax1.legend()
+    ax1.set_ylabel('Wavelength')
+    plt.title('Order {0}'.format(order))
+    plt.setp(ax1.get_xticklabels(), visible=False)
+    ax2.axhline(y=0,color='k',ls='--',alpha=0.7)
+    ax2.plot(scaled_pixels_inp[Mask],velocity_residue[Mask],'.',color='k',label='Residue') 
+    # ax2.plot(scaled_pixels_inp[~Mask],wavl_residue[~Mask],'x',color='r',label='Outliers') 
+    ax2.text(0,0,'Sigma V = {0:.2e} m/s'.format(SigmaV),color='blue')
+    ax2.legend()
+    ax2.set_ylabel('Residue in Velocity (m/s)')
+    ax2.set_xlabel(r'Pixels (scaled to -1 to 1)')
+    plt.minorticks_on()
+    plt.tick_params(pad=4)
+    plt.ticklabel_format(useOffset=False)
+    fig.subplots_adjust(hspace=0)
+    fig.savefig(Output_plot_fname)
+    logger.info('Saved plot to %s', Output_plot_fname)
+    plt.close()
+
+def ReidentifyOrder(order,SpectrumY,SpectrumY_Var,args,fresh=False):
+    """ Re-identifies the lines and fits the dispersion solution of a single order.
+    This is a module level function so that it can be pickled and run in a process pool.
+    The reference and output dispersion tables are read only once, the line positions are kept in memory 
+    between the stages, and the output dispersion table is written only once at the end of the line fitting.
+    fresh : (bool, default False) Re-fit all the wavelengths in the reference table, even if the output dispersion table exists.
+    Returns : (wavl, CoeffDictionary, lines, timing) where (wavl, CoeffDictionary) of the order are (None, None) 
+              if args.OutputWavlFile is not provided, lines is the tuple of (wavelengths, pixels, sigma) arrays 
+              of the calibrated lines in the output dispersion table, and timing is the StageTimer record of the order.
+              In args.Global2DModel mode only the lines are re-identified, and the solution is fitted later 
+              for all orders together by FitGlobalEchelleSolution.
+    """
+    Refdisp_fname = args.RefDispTableFile
+    Outdisp_fname = args.OutDispTableFile
+    wavl, CoeffDictionary = None, None
+    timer = StageTimer(order=order)
+    logger.info('Fitting Order: %s', order)
+    timer.start('read_tables')
+    wavelengths_ref_tofit, reference_lines = read_dispersion_inputfile(Refdisp_fname.format(order))
+    OutputExists = (not fresh) and dispersion_inputfile_exists(Outdisp_fname.format(order))
+    if OutputExists:
+        logger.info('Output dispersion file %s exists.', Outdisp_fname.format(order))
+        logger.info('Only non-calibrated wavelenghts in it will be re-fitted..')
+        wavelengths_tofit, existing_lines = read_dispersion_inputfile(Outdisp_fname.format(order))
+    else:
+        # Re-fit all the wavelengths in Reference file
+        wavelengths_tofit = reference_lines[0] + wavelengths_ref_tofit
+        existing_lines = ([],[],[])
+    timer.stop('read_tables')
+
+    plot_pdf_output = Outdisp_fname.format(order)+'_linefit_plots.pdf' if args.SavePlots else None
+    # Now recalibrate the positions of the line by fitting lines again to new positions
+    pix_fitted, sigma_fitted = FitNewLinesinSpectrum(SpectrumY,wavelengths_tofit,reference_lines,LineSigma=1.5,
+                                                     reference_pixshift=args.PixShiftGuess, SpectrumY_Var=SpectrumY_Var,
+                                                     guess_function=args.ModelForDispersion, plot_pdf_output=plot_pdf_output,
+                                                     timer=timer, min_peak_snr=args.MinPeakSNR, 
+                                                     peak_match_tol=args.PeakMatchTolerance)
+    # Lines not fitted for lack of a detected line have NaN pixels, and are left uncalibrated in the table
+    Fitted = np.isfinite(pix_fitted)
+    fitted_lines = tuple([value for value,fit in zip(column,Fitted) if fit] 
+                         for column in (wavelengths_tofit,pix_fitted,sigma_fitted))
+
+    # Save the fitted line positions only once
+    backupsuffix = '.bak' if args.BackupDispTable else None
+    with timer.stage('write_table'):
+        if not OutputExists:
+            create_dispersion_inputfile(Outdisp_fname.format(order),wavelengths_tofit,comment='Re-Fitted',
+                                        pixels=pix_fitted if pix_fitted else None,sigma=sigma_fitted if pix_fitted else None)
+        elif fitted_lines[0]:
+            writeto_dispersion_inputfile(Outdisp_fname.format(order),*fitted_lines,backupsuffix=backupsuffix)
+    logger.info('Dispersion ASCII input file saved in file://%s', Outdisp_fname.format(order))
+
+    # Calibrated lines of the order, same as reading back the output dispersion file
+    lines = tuple(np.array(list(existing)+list(fitted),dtype=float) for existing,fitted in zip(existing_lines,fitted_lines))
+
+    if args.OutputWavlFile and (args.Global2DModel is None):
+        # Also save the full Wavelength array solution
+        Output_fname = args.OutputWavlFile
+
+        wavelengths_inp, pixels_inp, sigma_inp = lines
+        wavelengths_inp = np.array(wavelengths_inp) 
+        # Scale the pixel to -1 to 1 range for stable polynomial function
+        scaled_pixels_inp = (2.*np.array(pixels_inp)/(len(SpectrumY)-1.)) - 1
+        # Dispertion function
+        timer.start('dispersion_fit')
+        disp_func, coeffs, Mask = get_fitted_function(pixels=scaled_pixels_inp,
+                                                      wavel=wavelengths_inp,
+                                                      sigma=sigma_inp, 
+                                                      method=args.ModelForDispersion,
+                                                      return_coeff=True,
+                                                      sigma_to_clip=3,
+                                                      maxiter=args.SigmaClipMaxIter)
+        timer.stop('dispersion_fit')
+        timer.count('lines_used',np.sum(Mask))
+        timer.count('lines_rejected',np.sum(~Mask))
+        if np.sum(~Mask):
+            logger.info('Rejected following oultliers by %s sigma clipping in the fit\n%s', 3,
+                        '\n'.join(map(str,np.array(wavelengths_inp)[~Mask])))
+
+        # Calculate the wavlength array
+        wavl = disp_func(np.linspace(-1,1,len(SpectrumY)))
+
+        # Calculate the residuals of the fit
+        wavl_residue = wavelengths_inp - disp_func(scaled_pixels_inp)
+        velocity_residue = speed_of_light*wavl_residue/wavelengths_inp
+        CoeffDictionary = {}
+        CoeffDictionary['CTYPE{0}'.format(order+1)] = ('WAVE-PLY' , 'Wavelength axis')
+        CoeffDictionary['PS{0}_0'.format(order+1)] = (args.ModelForDispersion, 'Polynomial of dispersion solution')
+        CoeffDictionary['PS{0}_1'.format(order+1)] = (True, 'Domain scaled from 1 to -1')
+        CoeffDictionary.update({'PV{0}_{1}'.format(order+1,i):(c,'{0}th order Coeff'.format(i)) for i,c in enumerate(coeffs)})
+        CoeffDictionary['SigmaW{0}'.format(order+1)] = (np.std(wavl_residue[Mask]), 'Sigma of Wavelength Residue')
+        CoeffDictionary['SigmaV{0}'.format(order+1)] = (np.std(velocity_residue[Mask]), 'Sigma of Velocity Residue (m/s)')
+
+        with timer.stage('write_solution'):
+            _ = write_wavldata(Output_fname.format(order),wavl,fits_headerDic=CoeffDictionary,
+                               overwrite=args.Manifest is not None)
+        logger.info('Wavelength solution saved in %s', Output_fname.format(order))
+
+        if args.SavePlots:
+            Output_plot_fname = os.path.splitext(Output_fname.format(order))[0]+'.png'
+            with timer.stage('plot'):
+                plot_dispersion_fit(Output_plot_fname,order,scaled_pixels_inp,wavelengths_inp,wavl,Mask,velocity_residue,
+                                    CoeffDictionary['SigmaV{0}'.format(order+1)][0],args.ModelForDispersion)
+
+    timing = timer.as_dict()
+    logger.debug('Timing of order %s: %s', order, timing)
+    return wavl, CoeffDictionary, lines, timing
+
+def parse_global2d_model(model):
+    """ Returns the (pixel degree, order degree) from the 2D model string of the form xNmM """
+    match = re.match(r'^x(\d+)m(\d+)$',model)
+    if match is None:
+        raise ValueError('Unknown 2D model {0}. Should be of the form xNmM, eg: x6m4'.format(model))
+    return int(match.group(1)), int(match.group(2))
+
+def FitGlobalEchelleSolution(orders,npixels,args,timer=None,lines_all=None):
+    """ Fits the global 2D (pixel, order) dispersion solution to the line tables of all the orders together.
+    The echelle order number of index `order` is args.EchelleOrderOffset + args.EchelleOrderDirection*order
+    timer (optional): StageTimer to record the wall time of the stages and the number of lines fitted/rejected.
+    lines_all (optional): list of (wavelengths, pixels, sigma) of the calibrated lines of each order in orders.
+                          If not provided, they are read from the output dispersion tables args.OutDispTableFile
+    Returns : list of (wavl, CoeffDictionary) of each order in orders, with the 2D solution coeffs in the CoeffDictionary
+    """
+    timer = StageTimer() if timer is None else timer
+    xdeg, mdeg = parse_global2d_model(args.Global2DModel)
+    echelle_orders = {order:args.EchelleOrderOffset + args.EchelleOrderDirection*order for order in orders}
+    pixels_all, wavl_all, sigma_all, m_all, order_all = [], [], [], [], []
+    if lines_all is None:
+        lines_all = [read_dispersion_inputfile(args.OutDispTableFile.format(order))[1] for order in orders]
+    for order, (wavelengths_inp,pixels_inp,sigma_inp) in zip(orders,lines_all):
+        # Scale the pixel to -1 to 1 range for stable polynomial function
+        pixels_all.append((2.*np.array(pixels_inp,dtype=float)/(npixels-1.)) - 1)
+        wavl_all.append(np.array(wavelengths_inp,dtype=float))
+        sigma_all.append(np.array(sigma_inp,dtype=float))
+        m_all.append(np.full(len(wavelengths_inp),echelle_orders[order]))
+        order_all.append(np.full(len(wavelengths_inp),order))
+    pixels_all, wavl_all, sigma_all, m_all, order_all = map(np.concatenate,(pixels_all,wavl_all,sigma_all,m_all,order_all))
+    order_range = (min(echelle_orders.values()),max(echelle_orders.values()))
+
+    with timer.stage('dispersion_fit'):
+        disp_func, coeffs, Mask = fit_echelle_2d_solution(pixels_all,m_all,wavl_all,sigma=sigma_all,
+                                                          xdeg=xdeg,mdeg=mdeg,order_range=order_range,sigma_to_clip=3,
+                                                          maxiter=args.SigmaClipMaxIter)
+    timer.count('lines_used',np.sum(Mask))
+    timer.count('lines_rejected',np.sum(~Mask))
+    logger.info('Fitted global 2D dispersion solution %s to %d lines from %d orders', args.Global2DModel, len(wavl_all), len(orders))
+    if np.sum(~Mask):
+        logger.info('Rejected %d outliers by %s sigma clipping in the 2D fit', np.sum(~Mask), 3)
+
+    wavl_residue = wavl_all - disp_func(pixels_all,m_all)
+    velocity_residue = speed_of_light*wavl_residue/wavl_all
+    GlobalDictionary = {}
+    GlobalDictionary['D2MODEL'] = (args.Global2DModel, '2D Legendre model of m*wavl(pixel,order)')
+    GlobalDictionary['D2MOFF'] = (args.EchelleOrderOffset, 'Echelle order number of index 0')
+    GlobalDictionary['D2MDIR'] = (args.EchelleOrderDirection, 'Echelle order number increment per index')
+    GlobalDictionary['D2MMIN'] = (order_range[0], 'Echelle order scaled to -1')
+    GlobalDictionary['D2MMAX'] = (order_range[1], 'Echelle order scaled to 1')
+    GlobalDictionary.update({'D2C{0}_{1}'.format(i,j):(coeffs[i,j],'Pixel deg {0}, Order deg {1} Coeff'.format(i,j)) 
+                             for i in range(xdeg+1) for j in range(mdeg+1)})
+    GlobalDictionary['SigmaW2D'] = (np.std(wavl_residue[Mask]), 'Sigma of Wavelength Residue of 2D fit')
+    GlobalDictionary['SigmaV2D'] = (np.std(velocity_residue[Mask]), 'Sigma of Velocity Residue (m/s) of 2D fit')
+
+    results = []
+    for order in orders:
+        InOrder = order_all == order
+        wavl = disp_func(np.linspace(-1,1,npixels),echelle_orders[order])
+        CoeffDictionary = dict(GlobalDictionary)
+        CoeffDictionary['CTYPE{0}'.format(order+1)] = ('WAVE-PLY' , 'Wavelength axis')
+        CoeffDictionary['PS{0}_0'.format(order+1)] = (args.Global2DModel, '2D Polynomial of dispersion solution')
+        CoeffDictionary['PS{0}_1'.format(order+1)] = (True, 'Domain scaled from 1 to -1')
+        CoeffDictionary['ECHORD{0}'.format(order+1)] = (echelle_orders[order], 'Echelle order number')
+        if np.any(InOrder & Mask):
+            CoeffDictionary['SigmaW{0}'.format(order+1)] = (np.std(wavl_residue[InOrder & Mask]), 'Sigma of Wavelength Residue')
+            CoeffDictionary['SigmaV{0}'.format(order+1)] = (np.std(velocity_residue[InOrder & Mask]), 'Sigma of Velocity Residue (m/s)')
+
+        Output_fname = args.OutputWavlFile
+        with timer.stage('write_solution'):
+            _ = write_wavldata(Output_fname.format(order),wavl,fits_headerDic=CoeffDictionary,
+                               overwrite=args.Manifest is not None)
+        logger.info('Wavelength solution saved in %s', Output_fname.format(order))
+        if args.SavePlots:
+            Output_plot_fname = os.path.splitext(Output_fname.format(order))[0]+'.png'
+            with timer.stage('plot'):
+                plot_dispersion_fit(Output_plot_fname,order,pixels_all[InOrder],wavl_all[InOrder],wavl,Mask[InOrder],
+                                    velocity_residue[InOrder],np.std(velocity_residue[InOrder & Mask]),args.Global2DModel)
+        results.append((wavl,CoeffDictionary))
+    return results
+
+def hash_array(data):
+    """ Returns the sha256 hex digest of the array data, including its dtype and shape. None if data is None """
+    if data is None:
+        return None
+    data = np.ascontiguousarray(data)
+    digest = hashlib.sha256(str((data.dtype.str,data.shape)).encode())
+    digest.update(data.tobytes())
+    return digest.hexdigest()
+
+def hash_file(filename):
+    """ Returns the sha256 hex digest of the file contents. None if the file does not exist """
+    if not os.path.isfile(filename):
+        return None
+    with open(filename,'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def hash_dispersion_table(filename):
+    """ Returns the sha256 hex digest of the contents of the Dispersion Input file (or the order in table.npz[order]).
+    None if it does not exist """
+    if not dispersion_inputfile_exists(filename):
+        return None
+    return hashlib.sha256(repr(read_dispersion_inputfile(filename)).encode()).hexdigest()
+
+def order_input_hashes(order,SpectrumY,SpectrumY_Var,args):
+    """ Returns the dictionary of the hashes of all the inputs which determine the ReidentifyOrder output of the order """
+    options = {option:getattr(args,option) for option in MANIFEST_OPTIONS}
+    return {'flux':hash_array(SpectrumY), 'variance':hash_array(SpectrumY_Var),
+            'reference':hash_dispersion_table(args.RefDispTableFile.format(order)),
+            'options':hashlib.sha256(json.dumps(options,sort_keys=True).encode()).hexdigest()}
+
+def order_output_hashes(order,args):
+    """ Returns the dictionary of the hashes of the output files of the order, to detect their modification or removal """
+    wavl_fname = None
+    if args.OutputWavlFile and (args.Global2DModel is None):
+        wavl_fname = args.OutputWavlFile.format(order)
+    return {'table':hash_dispersion_table(args.OutDispTableFile.format(order)),
+            'wavl':hash_file(wavl_fname) if wavl_fname else None}
+
+def read_manifest(filename):
+    """ Returns the dictionary of the order records in the manifest file. Empty if the file does not exist """
+    if not os.path.isfile(filename):
+        return {}
+    with open(filename) as f:
+        return json.load(f)['orders']
+
+def write_manifest(filename,records):
+    """ Writes the dictionary of the order records to the manifest file.
+    The file is first written to a temporary file and then moved, so that it is never left half written. """
+    tmpfilename = filename+'.tmp'
+    with open(tmpfilename,'w') as f:
+        json.dump({'orders':records},f,default=lambda obj: obj.tolist())  # numpy scalars and arrays
+    os.rename(tmpfilename,filename)
+
+def manifest_record(inputs,result,args,order):
+    """ Returns the manifest record of the order from its input hashes and the ReidentifyOrder result """
+    wavl, CoeffDictionary, lines, timing = result
+    return {'inputs':inputs, 'outputs':order_output_hashes(order,args),
+            'lines':[np.asarray(column).tolist() for column in lines], 'CoeffDictionary':CoeffDictionary}
+
+def reuse_manifest_record(record,order,args):
+    """ Returns the ReidentifyOrder result of the order from its manifest record """
+    timer = StageTimer(order=order)
+    timer.count('reused')
+    wavl, CoeffDictionary = None, None
+    if args.OutputWavlFile and (args.Global2DModel is None):
+        wavl = load_fluxdata(args.OutputWavlFile.format(order))
+        CoeffDictionary = {key:tuple(value) for key,value in record['CoeffDictionary'].items()}
+    lines = tuple(np.array(column,dtype=float) for column in record['lines'])
+    return wavl, CoeffDictionary, lines, timer.as_dict()
+
+def _reidentify_order_star(order_args):
+    """ Unpacks the argument tuple for ReidentifyOrder to use with Pool.imap """
+    return ReidentifyOrder(*order_args)
+
 def main(raw_args=None):
     """ Standalone Non-Interactive Line Re-Identify Tool """
     args = parse_args(raw_args)    
+    setup_logging(args.loglevel)
 
-    if args.SavePlots:
-        import matplotlib.pyplot as plt
-
-    SpectrumY_all = load_fluxdata(args.SpectrumFluxFile,fits_ext=args.fits_ext)
+    # Flux and variance are memory mapped, only the orders being fitted are read from the disk
+    SpectrumY_all = load_fluxdata(args.SpectrumFluxFile,fits_ext=args.fits_ext,lazy=True)
     if args.fits_ext_var is not None:
-        SpectrumY_Var_all = load_fluxdata(args.SpectrumFluxFile,fits_ext=args.fits_ext_var)
+        SpectrumY_Var_all = load_fluxdata(args.SpectrumFluxFile,fits_ext=args.fits_ext_var,lazy=True)
     else:
         SpectrumY_Var_all = [None]*len(SpectrumY_all)
 
-    Refdisp_fname = args.RefDispTableFile
-    Outdisp_fname = args.OutDispTableFile
-    if len(SpectrumY_all.shape) < 2:  # If the spectrum is a 1D single order spectrum
-        SpectrumY_all = [SpectrumY]  # Pack it into a single element list
-        SpectrumY_Var_all = [SpectrumY_Var_all]
-
-    if args.StackOrders:
-        CoeffDictionary_All = {}
-        WavlSolutionArray_All = []
-
-    for order, (SpectrumY, SpectrumY_Var) in enumerate(zip(SpectrumY_all,SpectrumY_Var_all)):
-        print('Fitting Order: {0}'.format(order))
-        if os.path.isfile(Outdisp_fname.format(order)):
-            print('Output dispersion file {0} exists.'.format(Outdisp_fname.format(order)))
-            print('Only non-calibrated wavelenghts in it will be re-fitted..')
+    # Memory mapped input files, to be closed at the end
+    FluxFiles = [SpectrumY_all] + ([SpectrumY_Var_all] if args.fits_ext_var is not None else [])
+    try:
+        if len(SpectrumY_all.shape) < 2:  # If the spectrum is a 1D single order spectrum
+            SpectrumY_all = [SpectrumY_all[:]]  # Pack it into a single element list
+            SpectrumY_Var_all = [SpectrumY_Var_all[:] if args.fits_ext_var is not None else None]
+
+        orders_tofit = list(args.orders if args.orders is not None else range(len(SpectrumY_all)))
+        results = {}
+        inputs = {}
+        fresh = {order:False for order in orders_tofit}
+        records = read_manifest(args.Manifest) if args.Manifest else {}
+        if args.Manifest:
+            for order in orders_tofit:
+                inputs[order] = order_input_hashes(order,SpectrumY_all[order],SpectrumY_Var_all[order],args)
+                record = records.get(str(order))
+                if record is None:
+                    continue
+                outputs_unchanged = record['outputs'] == order_output_hashes(order,args)
+                if outputs_unchanged and (record['inputs'] == inputs[order]):
+                    logger.info('Inputs of order %s are unchanged, reusing its results from %s', order, args.Manifest)
+                    results[order] = reuse_manifest_record(record,order,args)
+                elif record['outputs']['table'] == hash_dispersion_table(args.OutDispTableFile.format(order)):
+                    # Output table is from the previous run with different inputs, so re-fit all the lines
+                    fresh[order] = True
+        orders_torun = [order for order in orders_tofit if order not in results]
+
+        def save_result(order,result):
+            """ Stores the result of the order, and updates the manifest so that a crashed run can be resumed """
+            results[order] = result
+            if args.Manifest:
+                records[str(order)] = manifest_record(inputs[order],result,args,order)
+                write_manifest(args.Manifest,records)
+
+        # Generator, so that each order is loaded only when it is dispatched for fitting
+        order_args = ((order, SpectrumY_all[order], SpectrumY_Var_all[order], args, fresh[order]) for order in orders_torun)
+        if args.jobs > 1:
+            pool = Pool(processes=args.jobs)
+            try:
+                # imap returns the results in the order of the input orders
+                for order, result in zip(orders_torun,pool.imap(_reidentify_order_star, order_args)):
+                    save_result(order,result)
+            finally:
+                pool.close()
+                pool.join()
         else:
-            # Create the dispersion file with all the wavelengths in Reference file
-            wavelengths_tofit, (wavelengths_inp,pixels_inp,sigma_inp) = read_dispersion_inputfile(Refdisp_fname.format(order))
-            with open(Outdisp_fname.format(order),'w') as outdispfile:
-                outdispfile.write('# Wavelengths Pixel Sigma # comments\n')
-                for wavel in wavelengths_inp + wavelengths_tofit :
-                    outdispfile.write('{0} # Re-Fitted\n'.format(wavel))
-
-        plot_pdf_output = Outdisp_fname.format(order)+'_linefit_plots.pdf' if args.SavePlots else None
-        # Now recalibrate the positions of the line by fitting lines again to new positions
-        TryToFitNewLinesinSpectrum(SpectrumY,Outdisp_fname.format(order),LineSigma=1.5,
-                                   reference_dispfile=Refdisp_fname.format(order),
-                                   reference_pixshift=args.PixShiftGuess, SpectrumY_Var=SpectrumY_Var,
-                                   guess_function=args.ModelForDispersion, plot_pdf_output=plot_pdf_output)
-
-        print('Dispersion ASCII input file saved in file://{0}'.format(Outdisp_fname.format(order)))
-
-        if args.OutputWavlFile:
-            # Also save the full Wavelength array solution
-            Output_fname = args.OutputWavlFile
+            for oargs in order_args:
+                save_result(oargs[0],ReidentifyOrder(*oargs))
+        results = [results[order] for order in orders_tofit]
+        timings = [timing for wavl, CoeffDictionary, lines, timing in results]
+        lines_all = [lines for wavl, CoeffDictionary, lines, timing in results]
+        results = [(wavl, CoeffDictionary) for wavl, CoeffDictionary, lines, timing in results]
+
+        if args.OutputWavlFile and (args.Global2DModel is not None):
+            # Fit all the orders together
+            timer = StageTimer(order='all')
+            results = FitGlobalEchelleSolution(orders_tofit,SpectrumY_all.shape[-1] if hasattr(SpectrumY_all,'shape') else len(SpectrumY_all[0]),
+                                               args,timer=timer,lines_all=lines_all)
+            timings.append(timer.as_dict())
 
-            # Read back the calibration
-            _ , (wavelengths_inp,pixels_inp,sigma_inp) = read_dispersion_inputfile(Outdisp_fname.format(order))
-
-            wavelengths_inp = np.array(wavelengths_inp) 
-            # Scale the pixel to -1 to 1 range for stable polynomial function
-            scaled_pixels_inp = (2.*np.array(pixels_inp)/(len(SpectrumY)-1.)) - 1
-            # Dispertion function
-            
-            disp_func, coeffs, Mask = get_fitted_function(pixels=scaled_pixels_inp,
-                                                          wavel=wavelengths_inp,
-                                                          sigma=sigma_inp, 
-                                                          method=args.ModelForDispersion,
-                                                          return_coeff=True,
-                                                          sigma_to_clip=3)
-            if np.sum(~Mask):
-                print('Rejected following oultliers by {0} sigma clipping in the fit'.format(3))
-                print('\n'.join(map(str,np.array(wavelengths_inp)[~Mask])))
-                print('*'*5)
-
-            # Calculate the wavlength array
-            wavl = disp_func(np.linspace(-1,1,len(SpectrumY)))
-
-            # Calculate the residuals of the fit
-            wavl_residue = wavelengths_inp - disp_func(scaled_pixels_inp)
-            velocity_residue = speed_of_light*wavl_residue/wavelengths_inp
-            CoeffDictionary = {}
-            CoeffDictionary['CTYPE{0}'.format(order+1)] = ('WAVE-PLY' , 'Wavelength axis')
-            CoeffDictionary['PS{0}_0'.format(order+1)] = (args.ModelForDispersion, 'Polynomial of dispersion solution')
-            CoeffDictionary['PS{0}_1'.format(order+1)] = (True, 'Domain scaled from 1 to -1')
-            CoeffDictionary.update({'PV{0}_{1}'.format(order+1,i):(c,'{0}th order Coeff'.format(i)) for i,c in enumerate(coeffs)})
-            CoeffDictionary['SigmaW{0}'.format(order+1)] = (np.std(wavl_residue[Mask]), 'Sigma of Wavelength Residue')
-            CoeffDictionary['SigmaV{0}'.format(order+1)] = (np.std(velocity_residue[Mask]), 'Sigma of Velocity Residue (m/s)')
-
-            _ = write_wavldata(Output_fname.format(order),wavl,fits_headerDic=CoeffDictionary)
-            print('Wavelength solution saved in {0}'.format(Output_fname.format(order)))
-
-            if args.StackOrders:
+        if args.TimingFile:
+            write_timing_records(args.TimingFile,timings)
+
+        if args.StackOrders:
+            CoeffDictionary_All = {}
+            WavlSolutionArray_All = []
+            for wavl, CoeffDictionary in results:
                 CoeffDictionary_All.update(CoeffDictionary)
                 WavlSolutionArray_All.append(wavl)
-            
-            if args.SavePlots:
-                Output_plot_fname = os.path.splitext(Output_fname.format(order))[0]+'.png'
-                fig = plt.figure(figsize=(16,8))
-                ax1 = plt.subplot(211)
-                ax2 = plt.subplot(212, sharex = ax1)
-                ax1.plot(scaled_pixels_inp,wavelengths_inp,'.',color='k',label='Calibration Lines')
-                ax1.plot(np.linspace(-1,1,len(SpectrumY)),wavl,'-',color='orange',label='Dispersion Solution: {0}'.format(args.ModelForDispersion))
-                ax1.plot(scaled_pixels_inp[~Mask],wavelengths_inp[~Mask],'x',color='r',label='Outliers')
-                ax1.legend()
-                ax1.set_ylabel('Wavelength')
-                plt.title('Order {0}'.format(order))
-                plt.setp(ax1.get_xticklabels(), visible=False)
-                ax2.axhline(y=0,color='k',ls='--',alpha=0.7)
-                ax2.plot(scaled_pixels_inp[Mask],velocity_residue[Mask],'.',color='k',label='Residue') 
-                # ax2.plot(scaled_pixels_inp[~Mask],wavl_residue[~Mask],'x',color='r',label='Outliers') 
-                ax2.text(0,0,'Sigma V = {0:.2e} m/s'.format(CoeffDictionary['SigmaV{0}'.format(order+1)][0]),color='blue')
-                ax2.legend()
-                ax2.set_ylabel('Residue in Velocity (m/s)')
-                ax2.set_xlabel(r'Pixels (scaled to -1 to 1)')
-                plt.minorticks_on()
-                plt.tick_params(pad=4)
-                plt.ticklabel_format(useOffset=False)
-                fig.subplots_adjust(hspace=0)
-                print(Output_plot_fname)
-                fig.savefig(Output_plot_fname)
-                print('Saved plot to {0}'.format(Output_plot_fname))
-                plt.close()
-                
-    if args.StackOrders:
-        _ = write_wavldata(Output_fname.format('all'),np.array(WavlSolutionArray_All),fits_headerDic=CoeffDictionary_All)
-        print('Stacked wavelength solution saved in {0}'.format(Output_fname.format('all')))
-        
+            Output_fname = args.OutputWavlFile
+            _ = write_wavldata(Output_fname.format('all'),np.array(WavlSolutionArray_All),fits_headerDic=CoeffDictionary_All,
+                               overwrite=args.Manifest is not None)
+            logger.info('Stacked wavelength solution saved in %s', Output_fname.format('all'))
+    finally:
+        for fluxdata in FluxFiles:
+            fluxdata.close()
 
 if __name__ == "__main__":
     main()
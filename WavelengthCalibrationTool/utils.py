@@ -1,16 +1,305 @@
 """ This module contains utility functions used by other tools """
 
+from collections import namedtuple, Counter
+from contextlib import contextmanager
+from timeit import default_timer
+import logging
 import numpy as np
-from astropy.modeling import models, fitting
-from scipy.optimize import least_squares
-from scipy import linalg 
 
-def NearestIndex(Array,value):
-    """ Returns the index of element in numpy 1d Array nearest to value """
-    #return np.searchsorted(Array,value)  # Works for sorted array only
+# Speed of light in m/s (exact, same as scipy.constants.speed_of_light), to avoid importing scipy just for it
+speed_of_light = 299792458.0
+
+# Results of the batch line fitter. Each field is an array with one entry per line
+LineFitResults = namedtuple('LineFitResults',['amplitude','mean','stddev','slope','intercept',
+                                              'amplitude_err','mean_err','stddev_err',
+                                              'covariance','chisq','converged'])
+
+# Results of the peak detection. Each field is an array with one entry per detected peak, sorted by position
+PeakDetectionResults = namedtuple('PeakDetectionResults',['position','snr'])
+
+def IsMonotonic(Array):
+    """ Returns 1 if numpy 1d Array is strictly increasing, -1 if strictly decreasing, else 0 """
+    dA = np.diff(Array)
+    if len(Array) < 2:
+        return 0
+    elif np.all(dA > 0):
+        return 1
+    elif np.all(dA < 0):
+        return -1
+    else:
+        return 0
+
+def NearestIndices(Array,values,monotonic=None):
+    """ Returns the array of indices of elements in numpy 1d Array nearest to each of the values.
+    monotonic : None (default) : Detect whether Array is strictly monotonic
+                True : Array is known to be strictly increasing or decreasing
+                False : Array is not monotonic
+    For monotonic Array, all values are resolved by a single binary search (np.searchsorted) call.
+    Ties are resolved to the lower index, same as np.argmin.
+    """
+    Array = np.asarray(Array)
+    values = np.asarray(values,dtype=float)
+    if monotonic is None:
+        direction = IsMonotonic(Array)
+    elif monotonic and (len(Array) > 1):
+        direction = 1 if Array[-1] > Array[0] else -1
+    else:
+        direction = 0
+
+    if direction == 0:
+        # Brute force in chunks, to limit the size of the temporary distance array
+        chunk = max(1,int(1e6//max(len(Array),1)))
+        return np.concatenate([np.abs(Array[np.newaxis,:]-values[i:i+chunk,np.newaxis]).argmin(axis=1)
+                               for i in range(0,len(values),chunk)] or [np.array([],dtype=int)])
+
+    # For decreasing Array, search the reversed array
+    SortedArray = Array if direction > 0 else Array[::-1]
+    Right = np.clip(np.searchsorted(SortedArray,values),1,len(SortedArray)-1)
+    Left = Right - 1
+    if direction > 0:
+        return np.where(values-SortedArray[Left] <= SortedArray[Right]-values, Left, Right)
+    else:
+        Nearest = np.where(values-SortedArray[Left] < SortedArray[Right]-values, Left, Right)
+        return len(SortedArray)-1 - Nearest
+
+def NearestIndex(Array,value,monotonic=False):
+    """ Returns the index of element in numpy 1d Array nearest to value 
+    monotonic : (default False) Set True if the Array is known to be strictly increasing or decreasing
+                to do a binary search instead of the full array argmin. 
+                None will detect it, which is worth only for resolving many values (see NearestIndices).
+    """
+    if monotonic is None:
+        return NearestIndices(Array,[value],monotonic=None)[0]
+    elif monotonic and (len(Array) > 1):
+        if Array[-1] > Array[0]:
+            Right = min(max(np.searchsorted(Array,value),1),len(Array)-1)
+            return Right-1 if value-Array[Right-1] <= Array[Right]-value else Right
+        else:  # Decreasing array
+            Right = min(max(len(Array)-np.searchsorted(Array[::-1],value),1),len(Array)-1)
+            return Right-1 if Array[Right-1]-value <= value-Array[Right] else Right
     return np.abs(Array-value).argmin()
 
 
+def DetectPeaks(SpecY,Sigma=1.5,min_snr=5.,SpecY_Var=None,saturation=None):
+    """ Detects the emission lines in the whole SpecY by a matched filter of a gaussian line of width Sigma.
+    Peaks are the local maxima of the filtered spectrum with signal to noise ratio above min_snr.
+    SpecY_Var : (optional) Varience of the `SpecY` to calculate the noise of the filtered spectrum.
+                Else the noise is estimated from the median absolute deviation of the pixel to pixel differences.
+    saturation : (optional) Peaks with a flux at or above this level are discarded
+    Lines truncated by the ends of the spectrum are not detected.
+    Returns : PeakDetectionResults of the sub pixel position and signal to noise ratio of the peaks
+    """
+    SpecY = np.asarray(SpecY,dtype=float)
+    HalfWidth = int(np.ceil(3*Sigma))
+    Offsets = np.arange(-HalfWidth,HalfWidth+1)
+    kernel = np.exp(-0.5*(Offsets/Sigma)**2)
+    kernel -= np.mean(kernel)  # Zero sum kernel does not respond to a constant background
+    Filtered = np.convolve(SpecY,kernel,mode='same')
+    if SpecY_Var is not None:
+        Noise = np.sqrt(np.convolve(np.asarray(SpecY_Var,dtype=float),kernel**2,mode='same'))
+    else:
+        PixelNoise = 1.4826*np.median(np.abs(np.diff(SpecY)))/np.sqrt(2)
+        Noise = np.full(len(SpecY),PixelNoise*np.sqrt(np.sum(kernel**2)))
+    Noise[Noise <= 0] = np.inf
+
+    # Local maxima, away from the ends where the filter is incomplete
+    Index = np.arange(HalfWidth+1,len(SpecY)-HalfWidth-1)
+    IsPeak = (Filtered[Index] > Filtered[Index-1]) & (Filtered[Index] >= Filtered[Index+1])
+    SNR = Filtered[Index]/Noise[Index]
+    IsPeak &= SNR >= min_snr
+    if saturation is not None:
+        IsPeak &= np.max(SpecY[Index[:,np.newaxis]+np.arange(-1,2)[np.newaxis,:]],axis=1) < saturation
+    Index, SNR = Index[IsPeak], SNR[IsPeak]
+
+    # Sub pixel position from the parabola through the peak and its neighbours
+    Left, Center, Right = Filtered[Index-1], Filtered[Index], Filtered[Index+1]
+    Curvature = Left - 2*Center + Right
+    Delta = np.where(Curvature < 0, 0.5*(Left-Right)/np.where(Curvature < 0,Curvature,-1), 0)
+    return PeakDetectionResults(position=Index+Delta, snr=SNR)
+
+def MatchPeaksToPositions(PeakPositions,Positions,tol=3.):
+    """ Returns the array of indices of the peak in sorted PeakPositions matched to each of the Positions.
+    Positions without a peak within tol pixels are -1. Positions which match the same peak as another
+    position are -1 as well, since the peak is a blend of lines or cannot be identified uniquely.
+    """
+    Positions = np.asarray(Positions,dtype=float)
+    Matches = np.full(len(Positions),-1,dtype=int)
+    if (len(PeakPositions) == 0) or (len(Positions) == 0):
+        return Matches
+    PeakPositions = np.asarray(PeakPositions,dtype=float)
+    Nearest = NearestIndices(PeakPositions,Positions,monotonic=len(PeakPositions) > 1)
+    Within = np.abs(PeakPositions[Nearest]-Positions) <= tol
+    Count = np.bincount(Nearest[Within],minlength=len(PeakPositions))
+    Unique = Within & (Count[Nearest] == 1)
+    Matches[Unique] = Nearest[Unique]
+    return Matches
+
+
+def BuildLineModel(amplitude,mean,stddev,slope,intercept):
+    """ Returns the astropy Gaussian1D + Linear1D compound model of a line with the given parameters """
+    from astropy.modeling import models
+    return models.Gaussian1D(amplitude=amplitude, mean=mean, stddev=stddev)+models.Linear1D(slope=slope,intercept=intercept)
+
+
+def _gaussian_line_model_and_jacobian(X,params):
+    """ Returns the Gaussian + linear background model and its analytic Jacobian 
+    for the stacked windows X (Nlines,Npix) and params (Nlines,5) of [amplitude,mean,stddev,slope,intercept] """
+    A, mu, s, m, b = [params[:,i:i+1] for i in range(5)]
+    z = (X-mu)/s
+    g = np.exp(-0.5*z**2)
+    model = A*g + m*X + b
+    jac = np.empty(X.shape+(5,))
+    jac[...,0] = g
+    jac[...,1] = A*g*z/s
+    jac[...,2] = A*g*z**2/s
+    jac[...,3] = X
+    jac[...,4] = 1
+    return model, jac
+
+def FitGaussianLinesBatch(X,Y,p0,weights=None,maxiter=100,tol=1e-10):
+    """ Fits Gaussian + linear background model simultaneously to a stack of line windows
+    using a vectorised Levenberg-Marquardt with analytic Jacobian.
+    Parameters
+    ----------
+    X : 2D numpy array (Nlines,Npix)
+          X coordinates of each line window
+    Y : 2D numpy array (Nlines,Npix)
+          Data values of each line window
+    p0 : 2D numpy array (Nlines,5)
+          Initial guess of [amplitude,mean,stddev,slope,intercept] for each line
+    weights: 2D numpy array (Nlines,Npix) (optional; default: np.ones)
+          Weights to multiply the residuals (for eg: 1/sqrt(Variance)). Zero weight masks the pixel.
+    maxiter: int
+          Maximum number of iterations
+    tol: float
+          Relative change in chi square below which a line's fit is considered converged
+
+    Returns
+    -------
+    fitted_params : 2D numpy array (Nlines,5)
+    covariance : 3D numpy array (Nlines,5,5)
+    chisq : 1D numpy array (Nlines)
+    converged : 1D boolean numpy array (Nlines)
+          False also for the lines whose fitted mean is outside the X range (of non zero weight) of its window
+    """
+    X = np.asarray(X,dtype=float)
+    Y = np.asarray(Y,dtype=float)
+    params = np.array(p0,dtype=float)
+    if weights is None:
+        weights = np.ones_like(Y)
+    weights = np.asarray(weights,dtype=float)
+    Nlines = params.shape[0]
+
+    lam = np.full(Nlines,1e-3)
+    model, jac = _gaussian_line_model_and_jacobian(X,params)
+    chisq = np.sum((weights*(Y-model))**2,axis=1)
+    converged = np.zeros(Nlines,dtype=bool)
+    Identity = np.identity(5)
+    for _ in range(maxiter):
+        active = ~converged
+        if not np.any(active):
+            break
+        wJ = weights[active,:,None]*jac[active]
+        wr = weights[active]*(Y[active]-model[active])
+        JTJ = np.einsum('nki,nkj->nij',wJ,wJ)
+        JTr = np.einsum('nki,nk->ni',wJ,wr)
+        diagJTJ = np.maximum(np.diagonal(JTJ,axis1=1,axis2=2),1e-12)
+        Damped = JTJ + lam[active,None,None]*diagJTJ[:,:,None]*Identity
+        try:
+            delta = np.linalg.solve(Damped,JTr[...,None])[...,0]
+        except np.linalg.LinAlgError:
+            delta = np.einsum('nij,nj->ni',np.linalg.pinv(Damped),JTr)
+
+        trial_params = params[active] + delta
+        trial_model, trial_jac = _gaussian_line_model_and_jacobian(X[active],trial_params)
+        trial_chisq = np.sum((weights[active]*(Y[active]-trial_model))**2,axis=1)
+        improved = np.isfinite(trial_chisq) & (trial_chisq <= chisq[active])
+
+        idx = np.flatnonzero(active)
+        acc = idx[improved]
+        rel_change = np.abs(chisq[acc]-trial_chisq[improved])/np.maximum(chisq[acc],np.finfo(float).tiny)
+        params[acc] = trial_params[improved]
+        model[acc] = trial_model[improved]
+        jac[acc] = trial_jac[improved]
+        chisq[acc] = trial_chisq[improved]
+        lam[acc] /= 10.
+        lam[idx[~improved]] *= 10.
+        converged[acc[rel_change < tol]] = True
+        # Lines where the damping exploded cannot be improved further
+        converged[idx[~improved][lam[idx[~improved]] > 1e10]] = True
+
+    # Covariance matrix from the Jacobian at the solution
+    wJ = weights[:,:,None]*jac
+    JTJ = np.einsum('nki,nkj->nij',wJ,wJ)
+    covariance = np.linalg.pinv(JTJ)
+    params[:,2] = np.abs(params[:,2])
+    # The mean is not constrained, so a line can wander off to a neighbouring line or the background
+    converged &= _mean_inside_window(X,weights,params[:,1])
+    return params, covariance, chisq, converged
+
+def _mean_inside_window(X,weights,mean):
+    """ Returns the boolean array of whether each line's mean is inside the X range of non zero weights of its window """
+    InData = weights != 0
+    Xmin = np.min(np.where(InData,X,np.inf),axis=1)
+    Xmax = np.max(np.where(InData,X,-np.inf),axis=1)
+    return (mean >= Xmin) & (mean <= Xmax)
+
+def _line_fit_results(params,covariance,chisq,converged,dof=None):
+    """ Packs the output of FitGaussianLinesBatch into LineFitResults.
+    If dof is provided, covariance is scaled by the reduced chi square (ie. relative weights) """
+    if dof is not None:
+        covariance = covariance*(chisq/np.maximum(dof,1))[:,None,None]
+    errors = np.sqrt(np.abs(np.diagonal(covariance,axis1=1,axis2=2)))
+    return LineFitResults(amplitude=params[:,0], mean=params[:,1], stddev=params[:,2],
+                          slope=params[:,3], intercept=params[:,4],
+                          amplitude_err=errors[:,0], mean_err=errors[:,1], stddev_err=errors[:,2],
+                          covariance=covariance, chisq=chisq, converged=converged)
+
+def FitLinesToData(SpecY,Pos,Amp,AmpisBkgSubtracted=True,Sigma=1.5,SpecY_Var=None):
+    """ Fits model lines simultaneously at all the pixel positions `Pos` in the SpecY data 
+    Pos : 1D array of initial pixel positions of the lines
+    Amp : 1D array of initial amplitudes of the lines
+    Sigma = 1.5 # Approximate size of the line width sigma in pixels.
+          Half of the window size to use for fitting line in pixels will be FitWindowH = 5*Sigma  
+    SpecY_Var : (optional) if Varience of the `SpecY` is provided weights to line mode fit will be 1/sqrt(SpecY_Var) 
+    Returns : LineFitResults containing arrays of fitted parameters and uncertainties for each line.
+              The parameters of the lines whose fitted mean is outside their fitting window are NaN.
+    """
+    SpecY = np.asarray(SpecY,dtype=float)
+    Pos = np.atleast_1d(np.asarray(Pos,dtype=float))
+    Amp = np.atleast_1d(np.asarray(Amp,dtype=float))
+    FitWindowH = int(np.rint(5*Sigma))  # window to fit the line is 2*5 expected Sigma of line
+    CenterIdx = np.clip(np.rint(Pos).astype(int),0,len(SpecY)-1)
+    Offsets = np.arange(-FitWindowH,FitWindowH+1)
+    WindowIdx = CenterIdx[:,None] + Offsets[None,:]
+    # Pixels outside the spectrum are masked with zero weight
+    Valid = (WindowIdx >= 0) & (WindowIdx < len(SpecY)-1)
+    ClippedIdx = np.clip(WindowIdx,0,len(SpecY)-1)
+
+    SliceToFitY = SpecY[ClippedIdx]
+    if SpecY_Var is not None:
+        weights = np.where(Valid,1./np.sqrt(np.asarray(SpecY_Var,dtype=float)[ClippedIdx]),0)
+    else:
+        weights = Valid.astype(float)
+
+    # For fit stability, create a new X coordinates centered on each line
+    Xoffset = np.sum(WindowIdx*Valid,axis=1)/np.sum(Valid,axis=1)
+    SliceToFitX_off = WindowIdx - Xoffset[:,None]
+
+    MedianBkg = np.nanpercentile(np.where(Valid,SliceToFitY,np.nan),10,axis=1)
+    if not AmpisBkgSubtracted:
+        Amp = Amp - MedianBkg
+
+    p0 = np.column_stack([Amp, Pos-Xoffset, np.full(len(Pos),Sigma), np.zeros(len(Pos)), MedianBkg])
+    params, covariance, chisq, converged = FitGaussianLinesBatch(SliceToFitX_off,SliceToFitY,p0,weights=weights)
+    # Fits which wandered off their window are not of the line, and hence not returned
+    params[~_mean_inside_window(SliceToFitX_off,weights,params[:,1])] = np.nan
+    # Add back the offset in X
+    params[:,1] += Xoffset
+    params[:,4] -= params[:,3]*Xoffset
+    dof = None if SpecY_Var is not None else np.sum(Valid,axis=1) - 5
+    return _line_fit_results(params,covariance,chisq,converged,dof=dof)
+
 def FitLineToData(SpecX,SpecY,Pos,Amp,AmpisBkgSubtracted=True,Sigma = 1.5, WindowStartEnd = None,SpecY_Var=None):
     """ Fits a model line to the SpecX SpecY data 
     Model as well as parameters to fit are defined inside this function
@@ -20,22 +309,24 @@ def FitLineToData(SpecX,SpecY,Pos,Amp,AmpisBkgSubtracted=True,Sigma = 1.5, Windo
     else WindowStartEnd = (StartW,EndW)
          will result in data in the wavelength range StartW to EndW to be used for fitting
     SpecY_Var : (optional) if Varience of the `SpecY` is provided weights to line mode fit will be 1/sqrt(SpecY_Var) 
+    Returns : astropy Gaussian1D + Linear1D compound model fitted using FitGaussianLinesBatch
     """
 
     if WindowStartEnd is None:
         FitWindowH = int(np.rint(5*Sigma))  # window to fit the line is 2*5 expected Sigma of line
-        StartIdx = max(NearestIndex(SpecX,Pos) - FitWindowH, 0)
-        EndIdx = min(NearestIndex(SpecX,Pos) + FitWindowH +1, len(SpecX)-1)
+        PosIdx = NearestIndex(SpecX,Pos)
+        StartIdx = max(PosIdx - FitWindowH, 0)
+        EndIdx = min(PosIdx + FitWindowH +1, len(SpecX)-1)
     else:
-        StartIdx = NearestIndex(SpecX,WindowStartEnd[0])
-        EndIdx = min(NearestIndex(SpecX,WindowStartEnd[1]) +1, len(SpecX)-1)
+        StartIdx, EndIdx = NearestIndices(SpecX,WindowStartEnd)
+        EndIdx = min(EndIdx +1, len(SpecX)-1)
 
-    SliceToFitX = SpecX[StartIdx:EndIdx] 
+    SliceToFitX = np.asarray(SpecX[StartIdx:EndIdx],dtype=float)
     SliceToFitY = SpecY[StartIdx:EndIdx]
     if SpecY_Var is not None:
-        SliceToFitY_Var = SpecY_Var[StartIdx:EndIdx]
-    else:
-        SliceToFitY_Var = None
+        weights = 1./np.sqrt(SpecY_Var[StartIdx:EndIdx])
+    else :
+        weights = None
 
     # For fit stability, create a new X coordinates centered on 0
     Xoffset = np.mean(SliceToFitX)
@@ -50,23 +341,88 @@ def FitLineToData(SpecX,SpecY,Pos,Amp,AmpisBkgSubtracted=True,Sigma = 1.5, Windo
     if not AmpisBkgSubtracted:
         Amp = Amp - MedianBkg
 
-    #Define the line model to fit 
-    LineModel = models.Gaussian1D(amplitude=Amp, mean=Pos-Xoffset, stddev=Sigma*dw)+models.Linear1D(slope=0,intercept=MedianBkg)
-
-    #Define fitting object
-    Fitter = fitting.LevMarLSQFitter()#SLSQPLSQFitter()
-    
-    if SliceToFitY_Var is not None:
-        weights = 1./np.sqrt(SliceToFitY_Var)
-    else :
-        weights = None
-    #Fit the model to data
-    Model_fit = Fitter(LineModel, SliceToFitX_off, SliceToFitY,weights=weights)
+    p0 = [[Amp, Pos-Xoffset, Sigma*dw, 0, MedianBkg]]
+    params, _, _, _ = FitGaussianLinesBatch(SliceToFitX_off[None,:], np.asarray(SliceToFitY)[None,:], p0,
+                                            weights=None if weights is None else weights[None,:])
+    Amp_fit, Mean_fit, Stddev_fit, Slope_fit, Intercept_fit = params[0]
     # Add back the offset in X
-    Model_fit.mean_0.value = Model_fit.mean_0.value + Xoffset
-    Model_fit.intercept_1.value = Model_fit.intercept_1.value - Model_fit.slope_1.value*Xoffset
+    Model_fit = BuildLineModel(amplitude=Amp_fit, mean=Mean_fit+Xoffset, stddev=Stddev_fit,
+                               slope=Slope_fit, intercept=Intercept_fit-Slope_fit*Xoffset)
     return Model_fit
 
+class OrthogonalPolynomialBasis(object):
+    """ Discrete Orthogonal Polynomial Basis of degree `deg`, at locations `x`, weights by given by `weights`,
+    represented by the coefficents of its Three Term Recurrence
+          p_-1(x) = 0,  p_0(x) = 1,  p_j+1(x) = (x - alpha[j]) p_j(x) - beta[j] p_j-1(x)
+    The basis evaluated at `x` is stored as the (N,deg+1) `design_matrix`. 
+    Evaluation at new points are also done directly by the recurrence (and Clenshaw summation), 
+    without creating any polynomial objects.
+
+    Algorithm
+    --------
+    Uses the Three Term Recurrence formula to calculate the orthogonal polynomials. This is more stable than Gram-Schmidt procedure.
+    Reference : A First Course in Numerical Analysis 2nd ed. Ralston, Rabinowitz. Page 256
+    Equations: 6.4-14,15,17,20,21
+    """
+    def __init__(self,deg,x,weights=None):
+        x = np.asarray(x,dtype=float)
+        if weights is None:
+            weights = np.ones(len(x))
+        self.deg = deg
+        self.x = x
+        self.alpha = np.zeros(deg)
+        self.beta = np.zeros(deg)
+        self.design_matrix = np.empty((len(x),deg+1))
+        self.design_matrix[:,0] = 1
+        self.norms = np.empty(deg+1)  # weighted sum of squares of each basis polynomial at x
+        self.norms[0] = np.sum(weights)
+        for j in range(deg):  # Calculate p_j+1
+            p_j = self.design_matrix[:,j]
+            self.alpha[j] = np.dot(weights*x,p_j**2)/self.norms[j]
+            self.design_matrix[:,j+1] = (x-self.alpha[j])*p_j
+            if j > 0:
+                self.beta[j] = self.norms[j]/self.norms[j-1]
+                self.design_matrix[:,j+1] -= self.beta[j]*self.design_matrix[:,j-1]
+            self.norms[j+1] = np.dot(weights,self.design_matrix[:,j+1]**2)
+
+    def __len__(self):
+        return self.deg+1
+
+    def evaluate_basis(self,x):
+        """ Returns the (N,deg+1) design matrix of the basis evaluated at x """
+        x = np.asarray(x,dtype=float)
+        if (x is self.x) or ((x.shape == self.x.shape) and np.array_equal(x,self.x)):
+            return self.design_matrix
+        Basis = np.empty((len(x),self.deg+1))
+        Basis[:,0] = 1
+        for j in range(self.deg):
+            Basis[:,j+1] = (x-self.alpha[j])*Basis[:,j]
+            if j > 0:
+                Basis[:,j+1] -= self.beta[j]*Basis[:,j-1]
+        return Basis
+
+    def evaluate(self,x,coeffs):
+        """ Returns the linear combination of the basis with coefficents `coeffs` at x, by Clenshaw summation """
+        x = np.asarray(x,dtype=float)
+        y_kp1 = np.zeros_like(x)
+        y_kp2 = np.zeros_like(x)
+        for k in range(len(coeffs)-1,-1,-1):
+            y_k = np.full_like(x,coeffs[k])
+            if k < self.deg:
+                y_k += (x-self.alpha[k])*y_kp1
+            if k+1 < self.deg:
+                y_k -= self.beta[k+1]*y_kp2
+            y_kp1, y_kp2 = y_k, y_kp1
+        return y_kp1
+
+    def polynomials(self):
+        """ Returns the basis as a list of np.polynomial.Polynomial objects """
+        p_x = np.polynomial.Polynomial(coef=[0,1.])
+        base_polynomials = [np.polynomial.Polynomial(coef=[0.]),np.polynomial.Polynomial(coef=[1.])]
+        for j in range(self.deg):
+            base_polynomials.append((p_x-self.alpha[j])*base_polynomials[-1] - self.beta[j]*base_polynomials[-2])
+        return base_polynomials[1:] # skip the first p_m1 term
+
 def create_orthogonal_polynomials_ttr(deg,x,weights=None):
     """ Creates Discrete Orthogonal Polynomial Basis function of degree `deg`, at locations `x`, weights by given by `weights` 
     Parameters
@@ -85,49 +441,352 @@ def create_orthogonal_polynomials_ttr(deg,x,weights=None):
 
     Algorithm
     --------
-    Uses the Three Term Recurrence formula to calculate the orthogonal polynomials. This is more stable than Gram-Schmidt procedure.
-    Reference : A First Course in Numerical Analysis 2nd ed. Ralston, Rabinowitz. Page 256
-    Equations: 6.4-14,15,17,20,21
+    See OrthogonalPolynomialBasis, which should be used directly to avoid the polynomial objects.
     """
-    if weights is None:
-        weights = np.ones(len(x))
-    p_m1 = np.polynomial.Polynomial(coef=[0.])
-    p_0 = np.polynomial.Polynomial(coef=[1.])
-    base_polynomials = [p_m1,p_0]
-    p_x = np.polynomial.Polynomial(coef=[0,1.])
-
-    for jp1 in range(1,deg+1):  # loop through j+1 start with j+1=1
-        p_j = base_polynomials[jp1-1 +1]  # +1 since the first element is p_m1
-        p_jm1 = base_polynomials[jp1-2 +1]
-        if jp1 == 1 :
-            alpha_jp1 = np.sum(weights*x)/np.sum(weights)
-            beta_j = 0  # setting it to zero to avoid divide by zero
-        else:
-            alpha_jp1 = np.sum(weights*x*p_j(x)**2)/np.sum(weights*p_j(x)**2)
-            beta_j = np.sum(weights*p_j(x)**2)/np.sum(weights*p_jm1(x)**2)
-        p_jp1 = (p_x-alpha_jp1)*p_j - beta_j*p_jm1
-        base_polynomials.append(p_jp1)
-
-    return base_polynomials[1:] # skip the first p_m1 term
+    return OrthogonalPolynomialBasis(deg,x,weights=weights).polynomials()
 
 
 def eval_polynomial_basis(x,coeffs,p_list):
-    """ Returns the evaluvated values at `x` using the lineary combination of `p_list` with linear combination coefficent `coeffs` """
+    """ Returns the evaluvated values at `x` using the lineary combination of `p_list` with linear combination coefficent `coeffs` 
+    p_list can be a list of polynomials or an OrthogonalPolynomialBasis """
+    if isinstance(p_list,OrthogonalPolynomialBasis):
+        return p_list.evaluate(x,coeffs)
     x = np.array(x)
-    return np.sum([c*p(x) for c,p in zip(coeffs,p_list)],axis=0)
-    
-def fit_polynomial_basis(X,Y,p_list,full_output=False):
-    """ Fits `X` versus `Y` using a linear combination of the polynomial list `p_list` """
-    def error_func(c_values):
-        return eval_polynomial_basis(X,c_values,p_list) - np.array(Y)
+    result = np.zeros(x.shape)
+    for c,p in zip(coeffs,p_list):
+        result += c*p(x)
+    return result
     
-    c0 = np.ones(len(p_list))
-    res = least_squares(error_func, c0)
-    # print(res.message,res.status,res.success)
-    if full_output:
-        return res.x, res
+def fit_polynomial_basis(X,Y,p_list,full_output=False,weights=None,orthogonal=False,absolute_sigma=True,return_cov=False):
+    """ Fits `X` versus `Y` using a linear combination of the polynomial list `p_list` 
+    The model is linear in the coefficents, so this is solved directly by weighted linear least squares.
+    Parameters
+    ----------
+    X, Y : 1D numpy arrays
+          Data points to fit
+    p_list : list of polynomials or OrthogonalPolynomialBasis
+          Basis polynomials
+    full_output: bool (default: False)
+          If True, also returns the fit result in the form of the scipy.optimize.least_squares output 
+          (with x, fun, jac and cost of the weighted residuals), which can be passed to calculate_cov_matrix_fromscipylsq
+    weights: 1D numpy array (optional; default: np.ones(len(X)))
+          Weights of the squared residuals (for eg: 1/sigma**2)
+    orthogonal: bool (default: False)
+          Set True if `p_list` is orthogonal under `weights` at `X` (for eg: created by create_orthogonal_polynomials_ttr
+          with the same `X` and `weights`). Then the coefficents are just the weighted projections of `Y` on the basis.
+          Otherwise the least squares problem is solved by QR decomposition. 
+    absolute_sigma: bool (default: True)
+          If False, covariance matrix is scaled by the reduced chi square of the fit.
+    return_cov: bool (default: False)
+          If True, also returns the covariance matrix of the coefficents
+
+    Returns
+    -------
+    coeffs : 1D numpy array
+    res : scipy.optimize.OptimizeResult (only if full_output=True)
+    pcov : 2D numpy array (only if return_cov=True)
+    """
+    X = np.asarray(X,dtype=float)
+    Y = np.asarray(Y,dtype=float)
+    if weights is None:
+        weights = np.ones(len(X))
+    weights = np.asarray(weights,dtype=float)
+    if isinstance(p_list,OrthogonalPolynomialBasis):
+        DesignMatrix = p_list.evaluate_basis(X)
+    else:
+        DesignMatrix = np.column_stack([p(X) for p in p_list])
+    sqrtw = np.sqrt(weights)
+
+    if orthogonal:
+        norms = np.dot(weights,DesignMatrix**2)
+        coeffs = np.dot(weights*Y,DesignMatrix)/norms
+        pcov = np.diag(1./norms)
     else:
-        return res.x
+        from scipy import linalg
+        Q, R = linalg.qr(sqrtw[:,np.newaxis]*DesignMatrix, mode='economic')
+        coeffs = linalg.solve_triangular(R, np.dot(Q.T,sqrtw*Y))
+        Rinv = linalg.solve_triangular(R, np.identity(R.shape[0]))
+        pcov = np.dot(Rinv,Rinv.T)
+
+    residuals = sqrtw*(np.dot(DesignMatrix,coeffs) - Y)
+    if not absolute_sigma:
+        dof = len(X) - len(coeffs)
+        if dof > 0:
+            pcov = pcov * np.sum(residuals**2)/dof
+
+    output = [coeffs]
+    if full_output:
+        from scipy.optimize import OptimizeResult
+        output.append(OptimizeResult(x=coeffs, fun=residuals, jac=sqrtw[:,np.newaxis]*DesignMatrix,
+                                     cost=0.5*np.sum(residuals**2), status=1, success=True,
+                                     message='Solved by linear least squares'))
+    if return_cov:
+        output.append(pcov)
+    return output[0] if len(output) == 1 else tuple(output)
+
+def fit_echelle_2d_solution(pixels,orders,wavel,sigma=None,xdeg=6,mdeg=4,order_range=None,sigma_to_clip=3,maxiter=10):
+    """ Fits a global 2D dispersion solution of all echelle orders together, using the grating equation form
+          wavel(x,m) = 1/m * Sum_ij c_ij L_i(x) L_j(m') 
+    where L are Legendre polynomials, x is the pixel coordinate scaled to -1 to 1, m is the absolute echelle order number,
+    and m' is m scaled to -1 to 1 over order_range.
+    Parameters
+    ----------
+    pixels : 1D numpy array
+          Pixel positions of all the lines of all orders, scaled to -1 to 1
+    orders : 1D numpy array
+          Absolute echelle order number of each line
+    wavel : 1D numpy array
+          Wavelength of each line
+    sigma : 1D numpy array (optional)
+          Error of each wavelength, to weight the fit
+    xdeg, mdeg : int
+          Degree of the Legendre polynomials in pixel and order
+    order_range : (mmin,mmax) (optional; default: (min(orders),max(orders)))
+          Range of the orders to scale to -1 to 1
+    sigma_to_clip : float or False
+          Iteratively reject outliers beyond this sigma, until no new outliers or maxiter iterations.
+    Returns
+    -------
+    disp_func : function disp_func(x,m) which returns the wavelength at scaled pixel x in absolute order m
+    coeffs : 2D numpy array (xdeg+1,mdeg+1) of c_ij
+    Mask : 1D boolean array, False for the rejected outliers
+    """
+    from astropy.stats import sigma_clip
+    pixels = np.asarray(pixels,dtype=float)
+    orders = np.asarray(orders,dtype=float)
+    wavel = np.asarray(wavel,dtype=float)
+    if sigma is None:
+        sigma = np.ones(len(wavel))
+    sigma = np.asarray(sigma,dtype=float)
+    if order_range is None:
+        order_range = (np.min(orders),np.max(orders))
+    mmin, mmax = order_range
+
+    def scale_orders(m):
+        if mmax == mmin:
+            return np.zeros_like(np.asarray(m,dtype=float))
+        return (2.0*np.asarray(m,dtype=float) - (mmax+mmin))/(mmax-mmin)
+
+    # Fit m*wavel, which is linear in the coefficents. Each row is weighted by the error of m*wavel
+    DesignMatrix = np.polynomial.legendre.legvander2d(pixels,scale_orders(orders),[xdeg,mdeg])
+    WeightedDesign = DesignMatrix/(orders*sigma)[:,np.newaxis]
+    WeightedY = wavel/sigma
+
+    # The Legendre design matrix is dense (every line depends on all the (xdeg+1)*(mdeg+1) coefficients),
+    # so a dense solve of this small number of columns is the fastest; a sparse solver has nothing to exploit.
+    def fit(Mask):
+        c, _, rank, _ = np.linalg.lstsq(WeightedDesign[Mask],WeightedY[Mask],rcond=None)
+        return c
+
+    Mask = np.ones(len(wavel),dtype=bool)
+    c = fit(Mask)
+    if sigma_to_clip:
+        for iteration in range(maxiter):
+            residue = WeightedY - np.dot(WeightedDesign,c)
+            # Rejected points are not added back
+            NewMask = ~sigma_clip(np.ma.masked_array(residue,mask=~Mask), sigma=sigma_to_clip, maxiters=1).mask
+            if np.array_equal(NewMask,Mask):
+                break
+            Mask = NewMask
+            # Refit, so that the returned coefficents are always of the returned Mask
+            c = fit(Mask)
+
+    coeffs = c.reshape(xdeg+1,mdeg+1)
+    def disp_func(x,m):
+        return np.polynomial.legendre.legval2d(x,scale_orders(m)*np.ones_like(x),coeffs)/m
+    return disp_func, coeffs, Mask
+
+class IncrementalPolynomialFit(object):
+    """ Weighted least squares polynomial fit of degree `deg` wavel = f(pixel), which can be updated 
+    by adding or removing individual lines in O(deg^2) time each, without refitting all the lines.
+    The normal equations (A^T W A) c = A^T W y are accumulated in a Legendre basis of the pixels scaled 
+    from `domain` to -1 to 1, which keeps them well conditioned. The fitted polynomial is the same as 
+    that from a full refit of any other polynomial basis (eg: Chebyshev fit of get_fitted_function).
+    To limit accumulation of round off errors by removals, the normal equations are rebuilt 
+    from the remaining lines once the number of removals exceed the number of lines.
+    """
+    def __init__(self,deg,domain=(-1,1)):
+        self.deg = deg
+        self.domain = domain
+        self.lines = Counter()  # Multiset of (pixel, wavel, sigma) in the fit
+        self._nlines = 0
+        self._reset()
+
+    def _reset(self):
+        self.AtA = np.zeros((self.deg+1,self.deg+1))
+        self.Atb = np.zeros(self.deg+1)
+        self._removals = 0
+        self._coeffs = None
+
+    def _scale(self,x):
+        return (2.*np.asarray(x,dtype=float) - (self.domain[0]+self.domain[1]))/(self.domain[1]-self.domain[0])
+
+    def _accumulate(self,pixels,wavel,sigma,sign):
+        rows = np.polynomial.legendre.legvander(self._scale(pixels),self.deg)/sigma[:,np.newaxis]
+        self.AtA += sign*np.dot(rows.T,rows)
+        self.Atb += sign*np.dot(rows.T,wavel/sigma)
+        self._coeffs = None
+
+    def _as_arrays(self,pixels,wavel,sigma):
+        pixels = np.atleast_1d(np.asarray(pixels,dtype=float))
+        wavel = np.atleast_1d(np.asarray(wavel,dtype=float))
+        sigma = np.ones(len(pixels)) if sigma is None else np.atleast_1d(np.asarray(sigma,dtype=float))
+        return pixels, wavel, sigma
+
+    def add(self,pixels,wavel,sigma=None):
+        """ Adds lines at `pixels` with wavelengths `wavel` and error `sigma` to the fit """
+        pixels, wavel, sigma = self._as_arrays(pixels,wavel,sigma)
+        self._accumulate(pixels,wavel,sigma,1)
+        self.lines.update(zip(pixels,wavel,sigma))
+        self._nlines += len(pixels)
+
+    def remove(self,pixels,wavel,sigma=None):
+        """ Removes lines which were previously added to the fit """
+        pixels, wavel, sigma = self._as_arrays(pixels,wavel,sigma)
+        ToRemove = Counter(zip(pixels,wavel,sigma))
+        Missing = [line for line,count in ToRemove.items() if self.lines[line] < count]
+        if Missing:
+            raise KeyError('Lines not in the fit: {0}'.format(Missing))
+        for line,count in ToRemove.items():
+            self.lines[line] -= count
+            if self.lines[line] == 0:
+                del self.lines[line]
+        self._nlines -= len(pixels)
+        self._removals += len(pixels)
+        if self._removals > self._nlines:
+            self.rebuild()
+        else:
+            self._accumulate(pixels,wavel,sigma,-1)
+
+    def update(self,pixels,wavel,sigma=None):
+        """ Updates the fit to contain exactly the input lines, by adding and removing only the changed lines.
+        Returns : (number of lines added, number of lines removed) """
+        pixels, wavel, sigma = self._as_arrays(pixels,wavel,sigma)
+        NewLines = Counter(zip(pixels,wavel,sigma))
+        ToAdd = list((NewLines - self.lines).elements())
+        ToRemove = list((self.lines - NewLines).elements())
+        if ToRemove:
+            self.remove(*zip(*ToRemove))
+        if ToAdd:
+            self.add(*zip(*ToAdd))
+        return len(ToAdd), len(ToRemove)
+
+    def rebuild(self):
+        """ Rebuilds the normal equations from scratch from the current lines """
+        self._reset()
+        if self.lines:
+            pixels, wavel, sigma = map(np.array,zip(*self.lines.elements()))
+            self._accumulate(pixels,wavel,sigma,1)
+
+    def __len__(self):
+        return self._nlines
+
+    @property
+    def coeffs(self):
+        """ Legendre coefficients of the fit in the scaled domain """
+        if self._coeffs is None:
+            from scipy import linalg
+            try:
+                self._coeffs = linalg.cho_solve(linalg.cho_factor(self.AtA),self.Atb)
+            except linalg.LinAlgError:
+                # Under determined with too few lines; return the minimum norm solution
+                self._coeffs = linalg.lstsq(self.AtA,self.Atb)[0]
+        return self._coeffs
+
+    def __call__(self,x):
+        return np.polynomial.legendre.legval(self._scale(x),self.coeffs)
+
+def phase_cross_correlation_1d(reference_spec,shifted_spec,upsample_factor=10,normalization='phase'):
+    """ Returns the pixel shift required to register `shifted_spec` with `reference_spec` 
+    (same convention as skimage.registration.phase_cross_correlation), at the resolution of 1/upsample_factor.
+    Either of the inputs can be a 2D array (Nspectra, Npixels) to find the shifts of a batch of spectra together,
+    in which case an array of Nspectra shifts is returned.
+
+    Algorithm
+    --------
+    The cross power spectrum of the real spectra is calculated by rFFT (normalised to unit amplitude if 
+    normalization='phase', else plain cross correlation) and its inverse gives the integer pixel peak.
+    The peak is then refined by evaluating the cross correlation on a 1/upsample_factor grid of 1.5 pixels 
+    around it by a matrix multiply DFT, as in Guizar-Sicairos et al. 2008, Optics Letters 33, 156. 
+    """
+    reference_spec = np.asarray(reference_spec,dtype=float)
+    shifted_spec = np.asarray(shifted_spec,dtype=float)
+    single = (reference_spec.ndim == 1) and (shifted_spec.ndim == 1)
+    N = reference_spec.shape[-1]
+    product = np.fft.rfft(np.atleast_2d(reference_spec),axis=-1) * np.conj(np.fft.rfft(np.atleast_2d(shifted_spec),axis=-1))
+    if normalization == 'phase':
+        product /= np.maximum(np.abs(product),100*np.finfo(float).eps)
+    xcorr = np.fft.irfft(product,N,axis=-1)
+    shifts = np.argmax(xcorr,axis=-1).astype(float)
+    shifts[shifts > N//2] -= N  # Negative shifts are at the end
+
+    if upsample_factor > 1:
+        shifts = np.round(shifts*upsample_factor)/upsample_factor
+        region_size = int(np.ceil(upsample_factor*1.5))
+        dftshift = region_size//2
+        k = np.arange(product.shape[-1])
+        # Each rFFT frequency other than 0 and Nyquist stands for a conjugate pair in the full spectrum
+        weights = np.where((k == 0) | (2*k == N),1.,2.)
+        # Cross correlation at shifts + (j-dftshift)/upsample_factor = exp(2 pi i shifts k/N) product  x  exp(2 pi i (j-dftshift) k/(N upsample_factor))
+        kernel = np.exp(2j*np.pi*np.outer(k,np.arange(region_size)-dftshift)/(N*upsample_factor))
+        upsampled = np.dot(product*weights*np.exp(2j*np.pi*np.outer(shifts,k)/N),kernel).real
+        shifts += (np.argmax(upsampled,axis=-1)-dftshift)/float(upsample_factor)
+
+    return shifts[0] if single else shifts
+
+def setup_logging(loglevel='INFO'):
+    """ Configures the logging of the diagnostics of all the tools to stderr at the loglevel """
+    logging.basicConfig(level=getattr(logging,loglevel.upper()),format='%(message)s')
+
+class StageTimer(object):
+    """ Records the wall time of named stages and counters (eg: number of lines fitted or optimizer evaluations) 
+    of a single task like fitting one order, for monitoring batch runs.
+    Example:
+        timer = StageTimer(order=3)
+        with timer.stage('linefit'):
+            ...
+        timer.count('lines_fitted',120)
+        json.dumps(timer.as_dict())
+    """
+    def __init__(self,**labels):
+        self.labels = labels
+        self.stages = {}
+        self.counters = {}
+        self._started = {}
+        self._created = default_timer()
+
+    def start(self,name):
+        self._started[name] = default_timer()
+
+    def stop(self,name):
+        """ Adds the time since start(name) to the stage name. Repeated stages are summed """
+        self.stages[name] = self.stages.get(name,0.) + default_timer() - self._started.pop(name)
+
+    @contextmanager
+    def stage(self,name):
+        self.start(name)
+        try:
+            yield self
+        finally:
+            self.stop(name)
+
+    def count(self,name,n=1):
+        self.counters[name] = self.counters.get(name,0) + int(n)
+
+    def as_dict(self):
+        """ Returns the JSON serialisable dictionary of labels, stage times (s), counters and total wall time (s) """
+        record = dict(self.labels)
+        record['stages'] = dict(self.stages)
+        record['counters'] = dict(self.counters)
+        record['wall_time'] = default_timer() - self._created
+        return record
+
+def write_timing_records(filename,records):
+    """ Appends the timing records (dictionaries from StageTimer.as_dict) to filename, one JSON object per line """
+    import json
+    with open(filename,'a') as f:
+        for record in records:
+            f.write(json.dumps(record)+'\n')
 
 def calculate_cov_matrix_fromscipylsq(scipylsq_res,absolute_sigma=True):
     """ Returns the covariance matrix of the scipy.least_squares fit output.
@@ -140,6 +799,7 @@ def calculate_cov_matrix_fromscipylsq(scipylsq_res,absolute_sigma=True):
     """
     # Code below is from https://github.com/scipy/scipy/blob/v1.5.3/scipy/optimize/minpack.py#L532-L834
     # Do Moore-Penrose inverse discarding zero singular values.
+    from scipy import linalg
     _, s, VT = linalg.svd(scipylsq_res.jac, full_matrices=False)
     threshold = np.finfo(float).eps * max(scipylsq_res.jac.shape) * s[0]
     s = s[s > threshold]
@@ -0,0 +1 @@
+""" Benchmarks of the hot paths of WavelengthCalibrationTool on synthetic arc lamp spectra """
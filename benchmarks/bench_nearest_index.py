@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+""" Benchmark of utils.NearestIndex and utils.NearestIndices against the brute force argmin search """
+import timeit
+import numpy as np
+from WavelengthCalibrationTool.utils import NearestIndex, NearestIndices
+
+def brute_force_nearest(Array,values):
+    """ The original per value np.abs(Array-value).argmin() search """
+    return np.array([np.abs(Array-value).argmin() for value in values])
+
+def main(npixels_list=(4096,8192),nqueries=1500,repeat=5):
+    """ Prints the timings of the nearest index search on monotonic wavelength arrays of npixels """
+    rng = np.random.default_rng(0)
+    for npixels in npixels_list:
+        WavlArray = 5000 + np.cumsum(rng.uniform(0.04,0.06,npixels))
+        queries = rng.uniform(WavlArray[0],WavlArray[-1],nqueries)
+        assert np.array_equal(brute_force_nearest(WavlArray,queries),NearestIndices(WavlArray,queries))
+        timings = {'brute force argmin loop':lambda: brute_force_nearest(WavlArray,queries),
+                   'NearestIndex loop':lambda: [NearestIndex(WavlArray,q) for q in queries],
+                   'NearestIndex loop (monotonic=True)':lambda: [NearestIndex(WavlArray,q,monotonic=True) for q in queries],
+                   'NearestIndices':lambda: NearestIndices(WavlArray,queries),
+                   'NearestIndices (monotonic=True)':lambda: NearestIndices(WavlArray,queries,monotonic=True)}
+        reference = None
+        print('Npixels = {0}, Nqueries = {1}'.format(npixels,nqueries))
+        for name,func in timings.items():
+            t = min(timeit.repeat(func,number=1,repeat=repeat))
+            if reference is None:
+                reference = t
+            print('  {0:40s}: {1:10.3e} s  (speedup x{2:.1f})'.format(name,t,reference/t))
+
+if __name__ == "__main__":
+    main()
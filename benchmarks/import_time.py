@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+""" Measures the import time of the module of each console script in a fresh interpreter, and checks it against
+the budget. Also checks that the non-interactive tools do not import the GUI or other heavy modules.
+Usage:
+    python -m benchmarks.import_time [--repeat N]
+Exits with error if any budget is exceeded.
+"""
+import sys
+import json
+import argparse
+import subprocess
+
+# Import time budget (s) of the module of each console script, and the modules it should not import
+IMPORT_BUDGETS = {'WavelengthCalibrationTool.iidentify':(1.0, ['skimage']),
+                  'WavelengthCalibrationTool.reidentify':(0.3, ['matplotlib','termios','readline','skimage',
+                                                                 'astropy.modeling','scipy.interpolate','scipy.optimize']),
+                  'WavelengthCalibrationTool.autoidentify':(0.3, ['matplotlib','termios','readline','skimage',
+                                                                   'astropy.modeling','scipy.optimize']),
+                  'WavelengthCalibrationTool.recalibrate':(0.3, ['matplotlib','termios','readline','skimage',
+                                                                  'astropy.modeling'])}
+
+MEASURE_SCRIPT = """
+import sys, json, time
+t = time.perf_counter()
+import {module}
+t = time.perf_counter() - t
+print(json.dumps({{'time':t, 'modules':[m for m in {forbidden!r} if m in sys.modules]}}))
+"""
+
+def measure_import(module,forbidden,repeat=5):
+    """ Returns the minimum import time (s) of module over repeat fresh interpreters,
+    and the list of forbidden modules which got imported """
+    times = []
+    for i in range(repeat):
+        output = subprocess.check_output([sys.executable,'-c',MEASURE_SCRIPT.format(module=module,forbidden=forbidden)])
+        result = json.loads(output.decode().strip().split('\n')[-1])
+        times.append(result['time'])
+    return min(times), result['modules']
+
+def parse_args(raw_args=None):
+    """ Parses the command line input arguments """
+    parser = argparse.ArgumentParser(description="Import time budget check of the console scripts")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="Number of fresh interpreters to measure each import (minimum is reported)")
+    return parser.parse_args(raw_args)
+
+def main(raw_args=None):
+    args = parse_args(raw_args)
+    failed = False
+    print('{0:40s} {1:>10s} {2:>10s}  {3}'.format('Module','Time (s)','Budget (s)','Heavy modules imported'))
+    for module, (budget, forbidden) in sorted(IMPORT_BUDGETS.items()):
+        import_time, imported = measure_import(module,forbidden,repeat=args.repeat)
+        status = ''
+        if (import_time > budget) or imported:
+            failed = True
+            status = 'FAIL'
+        print('{0:40s} {1:10.3f} {2:10.3f}  {3} {4}'.format(module,import_time,budget,','.join(imported) or '-',status))
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
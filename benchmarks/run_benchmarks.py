@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+""" Runs the benchmarks of the line fitting, dispersion fitting and recalibration hot paths.
+Usage: 
+    python -m benchmarks.run_benchmarks [--quick] [--only NAME ...] [--save results.json] [--compare baseline.json]
+"""
+import os
+import io
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import timeit
+import tracemalloc
+import warnings
+import contextlib
+import numpy as np
+from WavelengthCalibrationTool.utils import FitLineToData, FitLinesToData, NearestIndices, IncrementalPolynomialFit, StageTimer
+from WavelengthCalibrationTool.utils import phase_cross_correlation_1d, DetectPeaks, MatchPeaksToPositions
+from WavelengthCalibrationTool.iidentify import get_fitted_function, TryToFitNewLinesinSpectrum
+from WavelengthCalibrationTool.recalibrate import ReCalibrateDispersionSolution
+from WavelengthCalibrationTool import reidentify, recalibrate
+from WavelengthCalibrationTool.autoidentify import SpacingRatioIndex, vote_line_identifications
+from .synthetic import make_arc_spectrum, make_reference_spectrum, write_reidentify_inputs, dispersion_polynomial, make_echelle_frame
+
+# Problem sizes of the benchmarks
+CONFIGS = {'quick':{'npixels':2048, 'nlines':100, 'norders':2, 'snr':100., 'drift':0.5, 'repeat':2},
+           'default':{'npixels':4096, 'nlines':500, 'norders':8, 'snr':100., 'drift':0.5, 'repeat':3}}
+
+BENCHMARKS = {}
+
+def benchmark(unit):
+    """ Decorator to register a benchmark. The decorated function takes the config and a temporary directory,
+    and returns (function to time, number of `unit` items processed in each call) """
+    def register(setup_func):
+        BENCHMARKS[setup_func.__name__.replace('bench_','')] = (setup_func,unit)
+        return setup_func
+    return register
+
+@benchmark('lines/s')
+def bench_fitlinetodata_loop(config,tmpdir):
+    flux, variance, pixels, amps = make_arc_spectrum(npixels=config['npixels'],nlines=config['nlines'],
+                                                     snr=config['snr'],drift=config['drift'])
+    X = np.arange(len(flux))
+    def run():
+        return [FitLineToData(X,flux,np.rint(p),a,SpecY_Var=variance) for p,a in zip(pixels,amps)]
+    return run, len(pixels)
+
+@benchmark('lines/s')
+def bench_fitlinestodata_batch(config,tmpdir):
+    flux, variance, pixels, amps = make_arc_spectrum(npixels=config['npixels'],nlines=config['nlines'],
+                                                     snr=config['snr'],drift=config['drift'])
+    def run():
+        return FitLinesToData(flux,np.rint(pixels),amps,SpecY_Var=variance)
+    return run, len(pixels)
+
+@benchmark('fits/s')
+def bench_get_fitted_function(config,tmpdir):
+    rng = np.random.default_rng(0)
+    pixels = np.sort(rng.uniform(0,config['npixels'],config['nlines']))
+    wavl = np.polyval(dispersion_polynomial(0,config['npixels']),pixels) + rng.normal(0,1e-3,len(pixels))
+    scaled_pixels = 2.*pixels/(config['npixels']-1.) - 1
+    def run():
+        return get_fitted_function(scaled_pixels,wavl,sigma=np.ones(len(wavl)),method='l6',
+                                   return_coeff=True,sigma_to_clip=3)
+    return run, 1
+
+@benchmark('lines/s')
+def bench_trytofitnewlinesinspectrum(config,tmpdir):
+    flux_filename, ref_template = write_reidentify_inputs(tmpdir,norders=1,npixels=config['npixels'],
+                                                          nlines=config['nlines'],snr=config['snr'],
+                                                          drift=config['drift'])
+    from astropy.io import fits
+    flux = fits.getdata(flux_filename,ext=0)[0]
+    variance = fits.getdata(flux_filename,ext=1)[0]
+    wavelengths = np.loadtxt(ref_template.format(0),usecols=0)
+    out_disp = os.path.join(tmpdir,'out_disp.txt')
+    def run():
+        with open(out_disp,'w') as f:
+            f.write(''.join('{0}\n'.format(w) for w in wavelengths))
+        TryToFitNewLinesinSpectrum(flux,out_disp,reference_dispfile=ref_template.format(0),
+                                   SpectrumY_Var=variance,guess_function='l6')
+    return run, len(wavelengths)
+
+def _recalibrate_benchmark(config,method):
+    """ Returns the recalibration benchmark of the method """
+    ref = make_reference_spectrum(npixels=config['npixels'],nlines=config['nlines'],snr=config['snr'])
+    flux, _, _, _ = make_arc_spectrum(npixels=config['npixels'],nlines=config['nlines'],
+                                      snr=config['snr'],drift=config['drift'])
+    _check_analytic_jacobian(flux,ref,method)
+    def run():
+        return ReCalibrateDispersionSolution(flux,ref,method=method)
+    return run, 1
+
+def _check_analytic_jacobian(flux,ref,method,nsigma=0.1):
+    """ Raises an error if the recalibration with the analytic Jacobian takes more function evaluations than with 
+    finite differences, or converges to parameters more than nsigma standard errors away from it """
+    results = {}
+    for analytic_jac in [True,False]:
+        timer = StageTimer()
+        _, popt, pcov = ReCalibrateDispersionSolution(flux,ref,method=method,cov=True,analytic_jac=analytic_jac,timer=timer)
+        results[analytic_jac] = (popt,np.sqrt(np.diag(pcov)),timer.as_dict()['counters']['nfev'])
+    (popt_jac,_,nfev_jac), (popt_fd,perr_fd,nfev_fd) = results[True], results[False]
+    if (nfev_jac > nfev_fd) or np.any(np.abs(popt_jac-popt_fd) > nsigma*perr_fd):
+        raise RuntimeError('Analytic Jacobian fit of {0} took {1} evaluations to {2}, finite differences took {3} '
+                           'evaluations to {4}'.format(method,nfev_jac,popt_jac,nfev_fd,popt_fd))
+
+@benchmark('spectra/s')
+def bench_recalibrate_p3(config,tmpdir):
+    return _recalibrate_benchmark(config,'p3')
+
+@benchmark('spectra/s')
+def bench_recalibrate_lpw6(config,tmpdir):
+    return _recalibrate_benchmark(config,'lpw6')
+
+@benchmark('spectra/s')
+def bench_recalibrate_lpvw6(config,tmpdir):
+    return _recalibrate_benchmark(config,'lpvw6')
+
+def _recalibrate_main_benchmark(config,tmpdir,method):
+    """ Returns the benchmark of the recalibrate tool fitting the drift of all orders with the method.
+    The DRIFT table of the fits output is checked to have the parameters and covariances of every order """
+    flux_filename, _ = write_reidentify_inputs(tmpdir,norders=config['norders'],npixels=config['npixels'],
+                                               nlines=config['nlines'],snr=config['snr'],drift=config['drift'])
+    # Noiseless undrifted frame with its dispersion solutions is the calibrated reference
+    _, ref_flux, _, _ = make_echelle_frame(norders=config['norders'],npixels=config['npixels'],
+                                           nlines=config['nlines'],snr=config['snr'],drift=0)
+    ref_wavl = [np.polyval(dispersion_polynomial(order,config['npixels']),np.arange(config['npixels']))
+                for order in range(config['norders'])]
+    ref_filename = os.path.join(tmpdir,'ref_spectrum.npy')
+    np.save(ref_filename,np.stack([ref_wavl,ref_flux],axis=-1))
+    output = os.path.join(tmpdir,'recalibrated_wavl.fits')
+    raw_args = [flux_filename,'--fits_ext_var','1',ref_filename,output,'--method',method,'--loglevel','WARNING']
+    def run():
+        if os.path.exists(output):
+            os.remove(output)
+        recalibrate.main(raw_args)
+    run()
+    _check_drift_table(output,config['norders'])
+    return run, config['norders']
+
+def _check_drift_table(filename,norders):
+    """ Raises an error if the DRIFT table of the recalibrate output does not have the fit of every order """
+    from astropy.io import fits
+    table = fits.getdata(filename,'DRIFT')
+    nparams = table['PARAMS'].shape[1]
+    if (len(table) != norders) or (table['COV'].shape != (norders,nparams,nparams)):
+        raise RuntimeError('DRIFT table has PARAMS {0} and COV {1} for {2} orders'.format(table['PARAMS'].shape,
+                                                                                          table['COV'].shape,norders))
+    if not np.all(np.isfinite(table['PARAMS'])):
+        raise RuntimeError('DRIFT table has non finite fitted parameters')
+
+@benchmark('orders/s')
+def bench_recalibrate_main_p3(config,tmpdir):
+    return _recalibrate_main_benchmark(config,tmpdir,'p3')
+
+@benchmark('orders/s')
+def bench_recalibrate_main_p0(config,tmpdir):
+    return _recalibrate_main_benchmark(config,tmpdir,'p0')
+
+@benchmark('orders/s')
+def bench_recalibrate_main_c0(config,tmpdir):
+    return _recalibrate_main_benchmark(config,tmpdir,'c0')
+
+@benchmark('orders/s')
+def bench_reidentify_main(config,tmpdir):
+    flux_filename, ref_template = write_reidentify_inputs(tmpdir,norders=config['norders'],npixels=config['npixels'],
+                                                          nlines=config['nlines'],snr=config['snr'],
+                                                          drift=config['drift'])
+    outdir = os.path.join(tmpdir,'reidentify_output')
+    def run():
+        # Existing output tables would be reused by reidentify, so start from a clean directory each time
+        if os.path.isdir(outdir):
+            shutil.rmtree(outdir)
+        os.makedirs(outdir)
+        reidentify.main([flux_filename,'--fits_ext_var','1',ref_template,
+                         os.path.join(outdir,'disp_{0}.txt'),
+                         '--OutputWavlFile',os.path.join(outdir,'wavl_{0}.fits'),
+                         '--ModelForDispersion','l6','--StackOrders','--loglevel','WARNING'])
+    return run, config['norders']
+
+@benchmark('queries/s')
+def bench_nearestindices(config,tmpdir):
+    rng = np.random.default_rng(0)
+    WavlArray = np.polyval(dispersion_polynomial(0,config['npixels']),np.arange(config['npixels']))
+    queries = rng.uniform(WavlArray[0],WavlArray[-1],config['nlines'])
+    def run():
+        return NearestIndices(WavlArray,queries)
+    return run, len(queries)
+
+@benchmark('lines/s')
+def bench_detect_and_match_peaks(config,tmpdir):
+    flux, variance, pixels, amps = make_arc_spectrum(npixels=config['npixels'],nlines=config['nlines'],
+                                                     snr=config['snr'],drift=config['drift'])
+    def run():
+        Peaks = DetectPeaks(flux,min_snr=5.,SpecY_Var=variance)
+        return MatchPeaksToPositions(Peaks.position,pixels,tol=3.)
+    return run, len(pixels)
+
+@benchmark('orders/s')
+def bench_autoidentify_pattern_match(config,tmpdir):
+    flux, variance, line_pixels, line_wavls = make_echelle_frame(norders=2,npixels=config['npixels'],nlines=config['nlines'],
+                                                                 snr=config['snr'])
+    # Atlas of the lines of both the orders, with a tenth of the lines missing and as many spurious lines added
+    rng = np.random.default_rng(0)
+    atlas = np.concatenate(line_wavls)
+    atlas = np.sort(np.concatenate([atlas[rng.random(len(atlas)) > 0.1],
+                                    rng.uniform(np.min(atlas),np.max(atlas),len(atlas)//10)]))
+    AtlasIndex = SpacingRatioIndex(atlas,neighbours=12)
+    Peaks = DetectPeaks(flux[0],min_snr=10.,SpecY_Var=variance[0])
+    def run():
+        return vote_line_identifications(Peaks.position,AtlasIndex,config['npixels'])
+    return run, 1
+
+@benchmark('updates/s')
+def bench_incremental_refit(config,tmpdir):
+    rng = np.random.default_rng(0)
+    pixels = np.sort(rng.uniform(0,config['npixels'],config['nlines']))
+    wavl = np.polyval(dispersion_polynomial(0,config['npixels']),pixels) + rng.normal(0,1e-3,len(pixels))
+    sigma = np.ones(len(wavl))
+    IncFit = IncrementalPolynomialFit(6,domain=(0,config['npixels']-1))
+    IncFit.add(pixels,wavl,sigma)
+    X = np.arange(config['npixels'])
+    def run():
+        # Interactive edit of a single line: remove it, add it back, and redraw the solution
+        for i in range(10):
+            IncFit.remove(pixels[i],wavl[i],sigma[i])
+            IncFit.add(pixels[i],wavl[i],sigma[i])
+            IncFit(X)
+    return run, 20
+
+def _drifted_spectra_stack(config):
+    """ Returns the noiseless reference spectrum, a stack of norders noisy spectra of the same lines drifted 
+    by -5 to 5 pixels, and the drifts. The reference is noiseless, since the noise of the same seed is the same 
+    in all the spectra, and would bias the cross correlation towards zero shift """
+    drifts = np.linspace(-5,5,config['norders'])
+    _, reference, _, _ = make_arc_spectrum(npixels=config['npixels'],nlines=config['nlines'],snr=config['snr'])
+    stack = np.array([make_arc_spectrum(npixels=config['npixels'],nlines=config['nlines'],snr=config['snr'],drift=drift)[0]
+                      for drift in drifts])
+    return reference, stack, drifts
+
+def _check_shifts(shifts,drifts,upsample_factor):
+    """ Raises RuntimeError if the shifts to register the drifted spectra are not -drifts within 1/upsample_factor pixels,
+    so that the benchmark does not time a wrong result """
+    error = np.max(np.abs(np.ravel(shifts)+drifts))
+    if error > 1./upsample_factor:
+        raise RuntimeError('Phase cross correlation shifts {0} differ from {1} by {2}'.format(np.ravel(shifts),-drifts,error))
+
+@benchmark('spectra/s')
+def bench_phase_cross_correlation_batch(config,tmpdir):
+    reference, stack, drifts = _drifted_spectra_stack(config)
+    def run():
+        return phase_cross_correlation_1d(reference,stack,upsample_factor=10)
+    _check_shifts(run(),drifts,10)
+    return run, len(stack)
+
+try:
+    from skimage import registration
+except ImportError:
+    pass  # Nothing to compare against
+else:
+    @benchmark('spectra/s')
+    def bench_phase_cross_correlation_skimage(config,tmpdir):
+        reference, stack, drifts = _drifted_spectra_stack(config)
+        def run():
+            return [registration.phase_cross_correlation(reference,spec,upsample_factor=10)[0] for spec in stack]
+        _check_shifts(run(),drifts,10)
+        return run, len(stack)
+
+def run_benchmark(name,config):
+    """ Runs the benchmark `name` and returns the dictionary of results """
+    setup_func, unit = BENCHMARKS[name]
+    tmpdir = tempfile.mkdtemp(prefix='wct_bench_')
+    try:
+        func, nitems = setup_func(config,tmpdir)
+        # The tools print diagnostics, which are not part of what we want to time
+        with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            tracemalloc.start()
+            func()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            times = timeit.repeat(func,number=1,repeat=config['repeat'])
+    finally:
+        shutil.rmtree(tmpdir)
+    best = min(times)
+    return {'time_s':best, 'throughput':nitems/best, 'unit':unit, 'peak_memory_MB':peak/1024.**2}
+
+def compare_with_baseline(results,baseline,tolerance=0.2):
+    """ Prints the comparison of results with the baseline. Returns the list of regressed benchmarks """
+    regressions = []
+    print('{0:30s} {1:>12s} {2:>12s} {3:>8s}'.format('Benchmark','Baseline (s)','Current (s)','Ratio'))
+    for name,res in results['benchmarks'].items():
+        if name not in baseline['benchmarks']:
+            print('{0:30s} {1:>12s} {2:12.4e}'.format(name,'-',res['time_s']))
+            continue
+        base_time = baseline['benchmarks'][name]['time_s']
+        ratio = res['time_s']/base_time
+        flag = ''
+        if ratio > 1+tolerance:
+            flag = 'SLOWER'
+            regressions.append(name)
+        elif ratio < 1/(1+tolerance):
+            flag = 'faster'
+        print('{0:30s} {1:12.4e} {2:12.4e} {3:8.2f} {4}'.format(name,base_time,res['time_s'],ratio,flag))
+    return regressions
+
+def parse_args(raw_args=None):
+    """ Parses the command line input arguments """
+    parser = argparse.ArgumentParser(description="Benchmarks of the WavelengthCalibrationTool hot paths")
+    parser.add_argument('--quick', action='store_true',
+                        help="Run with small problem sizes")
+    parser.add_argument('--only', type=str, nargs='+', choices=sorted(BENCHMARKS),
+                        help="Run only these benchmarks")
+    parser.add_argument('--npixels', type=int, help="Override number of pixels per order")
+    parser.add_argument('--nlines', type=int, help="Override number of lines per order")
+    parser.add_argument('--norders', type=int, help="Override number of orders")
+    parser.add_argument('--snr', type=float, help="Override SNR of the median line")
+    parser.add_argument('--drift', type=float, help="Override pixel drift of the spectrum from reference")
+    parser.add_argument('--save', type=str,
+                        help="Save the results to this json file")
+    parser.add_argument('--compare', type=str,
+                        help="Baseline json file (from --save) to compare the results with")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="Fractional slow down to flag as regression in comparison. Default is 0.2")
+    return parser.parse_args(raw_args)
+
+def main(raw_args=None):
+    """ Runs the benchmarks """
+    args = parse_args(raw_args)
+    config = dict(CONFIGS['quick' if args.quick else 'default'])
+    for key in ['npixels','nlines','norders','snr','drift']:
+        if getattr(args,key) is not None:
+            config[key] = getattr(args,key)
+
+    results = {'config':config, 'benchmarks':{}}
+    print('{0:30s} {1:>12s} {2:>22s} {3:>12s}'.format('Benchmark','Time (s)','Throughput','Peak Mem (MB)'))
+    for name in (args.only or sorted(BENCHMARKS)):
+        res = run_benchmark(name,config)
+        results['benchmarks'][name] = res
+        print('{0:30s} {1:12.4e} {2:12.1f} {3:>9s} {4:12.1f}'.format(name,res['time_s'],res['throughput'],
+                                                                     res['unit'],res['peak_memory_MB']))
+    if args.save:
+        with open(args.save,'w') as f:
+            json.dump(results,f,indent=2)
+        print('Saved results to {0}'.format(args.save))
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('config') != config:
+            print('WARNING: Baseline was run with a different config {0}'.format(baseline.get('config')))
+        regressions = compare_with_baseline(results,baseline,tolerance=args.tolerance)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+""" Generators of synthetic arc lamp spectra and dispersion tables for the benchmarks """
+import os
+import numpy as np
+from astropy.io import fits
+
+def dispersion_polynomial(order,npixels):
+    """ Returns the coefficents (highest power first) of a smooth synthetic dispersion solution of the order """
+    central_wavl = 5000. + 100.*order
+    dispersion = 0.05
+    return np.array([2e-7*dispersion*4096/npixels, dispersion, central_wavl-dispersion*npixels/2.])
+
+def make_arc_spectrum(npixels=4096,nlines=200,snr=100.,drift=0.,line_sigma=1.5,background=50.,seed=0):
+    """ Returns a synthetic arc lamp spectrum of a single order.
+    npixels : Number of pixels
+    nlines : Number of lamp lines (positioned randomly, with at least 4*line_sigma separation when possible)
+    snr : Peak signal to noise ratio of the median line
+    drift : Pixel shift of the lines in the spectrum with respect to the returned reference `line_pixels`
+    Returns : flux, model, line_pixels, line_amplitudes
+              where model is the noiseless spectrum, which is also the Poisson variance of the flux
+    """
+    rng = np.random.default_rng(seed)
+    margin = 10*line_sigma
+    line_pixels = np.sort(rng.uniform(margin,npixels-margin,nlines))
+    line_amplitudes = rng.lognormal(mean=0,sigma=0.7,size=nlines)
+    # Scale the amplitudes so that the median line has the requested peak SNR (Poisson noise)
+    median_amp = snr**2
+    line_amplitudes *= median_amp/np.median(line_amplitudes)
+
+    X = np.arange(npixels)
+    model = np.full(npixels,background,dtype=float)
+    half_window = int(np.ceil(6*line_sigma))
+    for pix,amp in zip(line_pixels+drift,line_amplitudes):
+        start, end = max(int(pix)-half_window,0), min(int(pix)+half_window+1,npixels)
+        model[start:end] += amp*np.exp(-0.5*((X[start:end]-pix)/line_sigma)**2)
+    flux = model + rng.normal(0,np.sqrt(model))
+    return flux, model, line_pixels, line_amplitudes
+
+def make_echelle_frame(norders=10,npixels=4096,nlines=200,snr=100.,drift=0.,line_sigma=1.5,seed=0):
+    """ Returns a synthetic multi-order arc frame.
+    Returns : flux (norders,npixels), variance (norders,npixels) (ie. the noiseless model of make_arc_spectrum), 
+              list of line pixel positions and list of line wavelengths of each order """
+    flux, variance, line_pixels, line_wavls = [], [], [], []
+    for order in range(norders):
+        f, v, pix, _ = make_arc_spectrum(npixels=npixels,nlines=nlines,snr=snr,drift=drift,
+                                         line_sigma=line_sigma,seed=seed+order)
+        flux.append(f)
+        variance.append(v)
+        line_pixels.append(pix)
+        line_wavls.append(np.polyval(dispersion_polynomial(order,npixels),pix))
+    return np.array(flux), np.array(variance), line_pixels, line_wavls
+
+def make_reference_spectrum(npixels=4096,nlines=200,snr=100.,line_sigma=1.5,seed=0):
+    """ Returns a calibrated reference spectrum (npixels,2) array of [wavelength, flux] for recalibrate """
+    flux, _, _, _ = make_arc_spectrum(npixels=npixels,nlines=nlines,snr=snr,line_sigma=line_sigma,seed=seed)
+    wavl = np.polyval(dispersion_polynomial(0,npixels),np.arange(npixels))
+    return np.column_stack([wavl,flux])
+
+def write_reidentify_inputs(outdir,norders=10,npixels=4096,nlines=200,snr=100.,drift=0.5,seed=0):
+    """ Writes a synthetic multi-order flux fits file (with variance in extension 1) and 
+    reference dispersion ASCII tables of each order into outdir.
+    Returns : (flux fits filename, reference dispersion table filename template with {0} for order) """
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    flux, variance, line_pixels, line_wavls = make_echelle_frame(norders=norders,npixels=npixels,nlines=nlines,
+                                                                 snr=snr,drift=drift,seed=seed)
+    flux_filename = os.path.join(outdir,'arc_flux.fits')
+    fits.HDUList([fits.PrimaryHDU(flux),fits.ImageHDU(variance)]).writeto(flux_filename,overwrite=True)
+    ref_template = os.path.join(outdir,'ref_disp_{0}.txt')
+    for order,(pixels,wavls) in enumerate(zip(line_pixels,line_wavls)):
+        with open(ref_template.format(order),'w') as f:
+            f.write('# Wavelengths Pixel Sigma\n')
+            for w,p in zip(wavls,pixels):
+                f.write('{0} {1} 1\n'.format(w,p))
+    return flux_filename, ref_template
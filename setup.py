@@ -22,7 +22,8 @@ setup(name='WavelengthCalibrationTool',
       entry_points = {
           'console_scripts': ['iidentify=WavelengthCalibrationTool.iidentify:main',
                               'reidentify=WavelengthCalibrationTool.reidentify:main',
-                              'recalibrate=WavelengthCalibrationTool.recalibrate:main'],
+                              'recalibrate=WavelengthCalibrationTool.recalibrate:main',
+                              'autoidentify=WavelengthCalibrationTool.autoidentify:main'],
       },
       install_requires = [
           'numpy',